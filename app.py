@@ -1,8 +1,9 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import pandas as pd
 import pdfplumber
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
 import base64
 import hashlib
@@ -13,6 +14,17 @@ import sys
 import subprocess
 import random
 import string
+import copy
+import functools
+import bisect
+from array import array
+import threading
+import zipfile
+import shutil
+import unicodedata
+import queue
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image, ImageEnhance
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
@@ -22,6 +34,7 @@ from reportlab.lib.utils import ImageReader
 from reportlab.lib.colors import HexColor
 from typing import Any, List, Optional, Union, Literal, overload, Dict
 import smtplib
+import socketserver
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from lunardate import LunarDate
@@ -49,6 +62,11 @@ try:
 except ImportError:
     np = None
 
+try:
+    import zstandard as zstd  # Nén blob trong kho tài liệu (không có thì lưu nguyên bản)
+except ImportError:
+    zstd = None
+
 # --- OCR CONFIGURATION ---
 try:
     import pytesseract
@@ -72,6 +90,7 @@ from docx import Document
 from docx.shared import Pt, Inches, Cm, RGBColor
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.enum.table import WD_TABLE_ALIGNMENT
+from lxml import etree # Đi kèm python-docx, dùng cho DOCX template engine
 HAS_OPENPYXL = True
 HAS_XLSXWRITER = True
 HAS_CV = cv2 is not None and np is not None
@@ -139,6 +158,7 @@ def add_row_to_table(table_name, row_dict):
         sql = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
         c.execute(sql, list(row_dict.values()))
         conn.commit()
+        notify_table_write(table_name)
         success = True
     except Exception as e:
         st.error(f"Lỗi ghi dữ liệu vào {table_name}: {e}")
@@ -276,15 +296,144 @@ if not os.path.exists(UPLOAD_FOLDER):
 
 DB_FILE = "invoice_app.db"
 
+# Thư mục chứa file mẫu Word (.docx) cho các hàm create_*_docx
+DOCX_TEMPLATE_FOLDER = "docx_templates"
+
 # ==========================================
 # 2. XỬ LÝ DATABASE (SQLite)
 # ==========================================
+def fold_vn(text):
+    """[NEW] Bỏ dấu + chữ thường để tìm không dấu: 'Nguyễn Văn Đạt' -> 'nguyen van dat'"""
+    if text is None: return None
+    decomposed = unicodedata.normalize('NFD', str(text).lower()).replace('đ', 'd')
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+def invoice_fingerprint(invoice_number, invoice_symbol, seller_name, total_amount, memo=None):
+    """[NEW] Dấu vân tay hóa đơn: số HĐ | ký hiệu | bên bán (không dấu, bỏ ký tự lạ) | tổng tiền.
+    'HĐ 0000123' / '123', 'Công ty ABC.' / 'CONG TY ABC' cho cùng 1 giá trị. UNC (số tự sinh) -> None, dùng hash file thay thế."""
+    if memo and str(memo).startswith('[UNC]'): return None
+    # Bỏ tiền tố chữ trước phần số ('HĐ', 'No.', 'Số') rồi mới bỏ số 0 đứng đầu
+    num = re.sub(r'^[A-Z]+(?=[0-9])', '', re.sub(r'[^0-9A-Z]', '', fold_vn(invoice_number or '').upper())).lstrip('0')
+    if not num: return None
+    sym = re.sub(r'[^0-9A-Z]', '', str(invoice_symbol or '').upper())
+    seller = re.sub(r'[^0-9a-z]', '', fold_vn(seller_name or ''))
+    try: amount = int(round(float(total_amount or 0)))
+    except (TypeError, ValueError): amount = 0
+    return f"{num}|{sym}|{seller}|{amount}"
+
 @st.cache_resource
 def get_connection():
     conn = sqlite3.connect(DB_FILE, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     return conn
 
+# [NEW] Cột văn bản có bản sao không dấu (<cột>_fold) để tìm bằng LIKE 'abc%' theo index
+FOLD_COLUMNS = {
+    'customers': ['name'],
+    'tours': ['tour_name'],
+    'service_bookings': ['name', 'customer_info'],
+    'invoices': ['seller_name', 'memo'],
+    'transaction_history': ['payer_name', 'note'],
+    'tour_guests': ['name'],
+    'flight_tickets': ['passenger_names'],
+}
+
+# [NEW] Nguồn dữ liệu cho chỉ mục tìm kiếm FTS5: bảng -> (số loại, cột mã, cột tiêu đề, cột nội dung)
+# rowid trong search_fts = id * 8 + số loại -> xóa/cập nhật 1 dòng không cần quét; cột folded = bản không dấu để tìm
+SEARCH_FTS_SOURCES = {
+    'tours': (1, "{R}.tour_code", "{R}.tour_name", "{R}.sale_name"),
+    'customers': (2, "{R}.phone", "{R}.name", "{R}.email"),
+    'invoices': (3, "COALESCE({R}.invoice_number, '') || ' ' || COALESCE({R}.cost_code, '')", "{R}.seller_name", "{R}.memo"),
+    'service_bookings': (4, "{R}.code", "{R}.name", "{R}.customer_info"),
+    'transaction_history': (5, "{R}.ref_code", "{R}.payer_name", "{R}.note"),
+    'tour_guests': (6, "{R}.cccd", "{R}.name", "{R}.hometown"),
+    'flight_tickets': (7, "{R}.ticket_code", "{R}.passenger_names", "{R}.route"),
+}
+
+# [NEW] Cột nguồn của invoices.fingerprint (đúng thứ tự tham số invoice_fingerprint)
+INVOICE_FP_COLUMNS = ('invoice_number', 'invoice_symbol', 'seller_name', 'total_amount', 'memo')
+
+# [NEW] Cột ngày YYYY-MM-DD (so sánh chuỗi = so sánh ngày) tính từ cột dd/mm/yyyy -> lọc theo khoảng dùng được index
+DATE_KEY_COLUMNS = {'tours': {'start_ymd': 'start_date'}}
+
+def date_key(text):
+    """Ngày dd/mm/yyyy (có thể thiếu số 0 đứng đầu) hoặc yyyy-mm-dd -> 'YYYY-MM-DD', không đọc được -> None"""
+    text = str(text or "").strip()[:10]
+    for fmt in ('%d/%m/%Y', '%Y-%m-%d'):
+        try: return datetime.strptime(text, fmt).strftime('%Y-%m-%d')
+        except ValueError: pass
+    return None
+
+def month_range(year, month):
+    """('YYYY-MM-01', ngày đầu tháng sau) cho điều kiện col >= ? AND col < ? trên cột ngày dạng ISO"""
+    return f"{year:04d}-{month:02d}-01", (f"{year + 1:04d}-01-01" if month == 12 else f"{year:04d}-{month + 1:02d}-01")
+
+def _derived_source_columns():
+    """Bảng -> các cột mà *_fold / fingerprint / cột ngày / search_fts được tính từ đó"""
+    cols = {tbl: list(fold_cols) for tbl, fold_cols in FOLD_COLUMNS.items()}
+    cols.setdefault('invoices', []).extend(INVOICE_FP_COLUMNS)
+    for tbl, date_cols in DATE_KEY_COLUMNS.items():
+        cols.setdefault(tbl, []).extend(date_cols.values())
+    for tbl, (_, *exprs) in SEARCH_FTS_SOURCES.items():
+        cols.setdefault(tbl, []).extend(re.findall(r"\{R\}\.(\w+)", " ".join(exprs)))
+    return {tbl: list(dict.fromkeys(c)) for tbl, c in cols.items()}
+
+DERIVED_SOURCE_COLUMNS = _derived_source_columns()
+
+def _ensure_trigger(c, name, spec):
+    """Tạo trigger `name`; đã có nhưng định nghĩa khác (bản cũ) -> xóa rồi tạo lại. Trả về True nếu vừa tạo."""
+    sql = f"CREATE TRIGGER {name} {spec}"
+    row = c.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name=?", (name,)).fetchone()
+    if row and row[0] == sql: return False
+    if row: c.execute(f"DROP TRIGGER {name}")
+    c.execute(sql)
+    return True
+
+def sync_derived_columns(conn=None):
+    """[NEW] Tính lại *_fold, invoices.fingerprint, cột ngày và dòng search_fts cho các dòng đang chờ trong derived_dirty.
+    Chạy sau mỗi lần ghi bảng nguồn (hook), khi khởi động và trong thread nền. Trả về số dòng đã xử lý."""
+    conn = conn or get_connection()
+    max_id = conn.execute("SELECT MAX(rowid) FROM derived_dirty").fetchone()[0]
+    if max_id is None: return 0
+    has_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name='search_fts'").fetchone() is not None
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        by_tbl = {}
+        for tbl, row_id in conn.execute("SELECT tbl, row_id FROM derived_dirty WHERE rowid <= ? GROUP BY tbl, row_id", (max_id,)):
+            by_tbl.setdefault(tbl, []).append(row_id)
+        for tbl, ids in by_tbl.items():
+            fold_cols = FOLD_COLUMNS.get(tbl, [])
+            fp_cols = INVOICE_FP_COLUMNS if tbl == 'invoices' else ()
+            date_cols = DATE_KEY_COLUMNS.get(tbl, {})
+            fts = SEARCH_FTS_SOURCES.get(tbl) if has_fts else None
+            exprs = ([f"{tbl}.{col}" for col in list(fold_cols) + list(fp_cols) + list(date_cols.values())]
+                     + ([e.format(R=tbl) for e in fts[1:]] if fts else []))
+            sets = ([f"{col}_fold = ?" for col in fold_cols] + (["fingerprint = ?"] if fp_cols else [])
+                    + [f"{col} = ?" for col in date_cols])
+            if not exprs: continue
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                updates, fts_rows = [], []
+                for r in conn.execute(f"SELECT {tbl}.id, {', '.join(exprs)} FROM {tbl} WHERE id IN ({','.join(['?'] * len(chunk))})", chunk):
+                    vals = tuple(r)[1:]
+                    n_fold, n_fp, n_date = len(fold_cols), len(fp_cols), len(date_cols)
+                    out = [fold_vn(v) for v in vals[:n_fold]]
+                    if fp_cols: out.append(invoice_fingerprint(*vals[n_fold:n_fold + n_fp]))
+                    out.extend(date_key(v) for v in vals[n_fold + n_fp:n_fold + n_fp + n_date])
+                    if sets: updates.append(out + [r[0]])
+                    if fts:
+                        code, title, body = vals[n_fold + n_fp + n_date:]
+                        folded = fold_vn(f"{'' if code is None else code} {'' if title is None else title} {'' if body is None else body}")
+                        fts_rows.append((r[0] * 8 + fts[0], code, title, body, folded))
+                if updates: conn.executemany(f"UPDATE {tbl} SET {', '.join(sets)} WHERE id = ?", updates)
+                if fts_rows: conn.executemany("INSERT OR REPLACE INTO search_fts (rowid, code, title, body, folded) VALUES (?, ?, ?, ?, ?)", fts_rows)
+        conn.execute("DELETE FROM derived_dirty WHERE rowid <= ?", (max_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return sum(len(ids) for ids in by_tbl.values())
+
 def migrate_db_columns():
     conn = get_connection()
     c = conn.cursor()
@@ -379,6 +528,48 @@ def migrate_db_columns():
     except: pass
     try: c.execute("ALTER TABLE payment_reminders ADD COLUMN bank_holder TEXT")
     except: pass
+    # [NEW] Bộ lập lịch nền: ghi lại số lần gửi / lỗi cuối (lấy từ email_outbox)
+    try: c.execute("ALTER TABLE payment_reminders ADD COLUMN attempts INTEGER DEFAULT 0")
+    except: pass
+    try: c.execute("ALTER TABLE payment_reminders ADD COLUMN last_attempt_at TEXT")
+    except: pass
+    try: c.execute("ALTER TABLE payment_reminders ADD COLUMN last_error TEXT")
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_reminders_status_due ON payment_reminders(status, due_date)")
+    except: pass
+    # Trạng thái 'sending' cũ (nhận việc trực tiếp) -> trả về hàng chờ, giờ việc gửi nằm trong email_outbox
+    try: c.execute("UPDATE payment_reminders SET status='sent_1' WHERE status='sending'")
+    except: pass
+
+    # --- [NEW] Hàng đợi email bền vững: lưu sẵn tiêu đề/nội dung, thử lại có giãn cách, hết lượt -> 'dead' ---
+    # status: queued -> sending -> sent | queued (chờ thử lại) | dead. reminder_id/stage: email thuộc lần nhắc nào.
+    try: c.execute('''CREATE TABLE IF NOT EXISTS email_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        to_email TEXT,
+        cc_emails TEXT,
+        subject TEXT,
+        body_html TEXT,
+        status TEXT DEFAULT 'queued',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at TEXT,
+        last_error TEXT,
+        claimed_by TEXT,
+        claimed_at TEXT,
+        reminder_id INTEGER,
+        stage INTEGER,
+        created_at TEXT,
+        sent_at TEXT
+    )''')
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON email_outbox(status, next_attempt_at)")
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_reminder ON email_outbox(reminder_id) WHERE reminder_id IS NOT NULL")
+    except: pass
+    # Xóa nhắc hẹn -> bỏ luôn email chưa gửi của nhắc đó (cùng giao dịch với lệnh DELETE, mọi nơi xóa đều được áp dụng)
+    try: c.execute('''CREATE TRIGGER IF NOT EXISTS trg_reminders_outbox_del AFTER DELETE ON payment_reminders BEGIN
+        DELETE FROM email_outbox WHERE reminder_id = OLD.id AND status IN ('queued', 'sending');
+    END''')
+    except: pass
     try: c.execute("ALTER TABLE transaction_history ADD COLUMN payer_name TEXT")
     except: pass
 
@@ -557,7 +748,258 @@ def migrate_db_columns():
     )''')
     except: pass
 
+    # --- [NEW] Index NOCASE cho ô tìm gợi ý (LIKE 'abc%' dùng được index; tên dùng name_fold bên dưới) ---
+    try: c.execute("DROP INDEX IF EXISTS idx_customers_name_nc")
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_customers_phone_nc ON customers(phone COLLATE NOCASE)")
+    except: pass
+
+    # --- [NEW] Index cho các truy vấn tổng hợp (Dashboard) ---
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_tour_items_tour ON tour_items(tour_id, item_type)")
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_bookings_created ON service_bookings(created_at)")
+    except: pass
+
+    # --- [NEW] Kho tài liệu theo nội dung: 1 blob / SHA-256, invoices.doc_hash trỏ tới, refcount do trigger giữ ---
+    try: c.execute('''CREATE TABLE IF NOT EXISTS documents (
+        sha256 TEXT PRIMARY KEY,
+        size INTEGER,          -- Kích thước gốc (byte)
+        stored_size INTEGER,   -- Kích thước trên đĩa (sau nén)
+        compression TEXT,      -- NULL hoặc 'zstd'
+        mime TEXT,
+        page_count INTEGER,
+        original_name TEXT,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT,
+        last_ref_at TEXT
+    )''')
+    except: pass
+    try: c.execute("ALTER TABLE invoices ADD COLUMN doc_hash TEXT")
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_doc_hash ON invoices(doc_hash)")
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_documents_refcount ON documents(refcount)")
+    except: pass
+    try: c.execute('''CREATE TRIGGER IF NOT EXISTS trg_doc_ref_ins AFTER INSERT ON invoices
+        WHEN NEW.doc_hash IS NOT NULL BEGIN
+            UPDATE documents SET refcount = refcount + 1, last_ref_at = datetime('now', 'localtime') WHERE sha256 = NEW.doc_hash;
+        END''')
+    except: pass
+    try: c.execute('''CREATE TRIGGER IF NOT EXISTS trg_doc_ref_del AFTER DELETE ON invoices
+        WHEN OLD.doc_hash IS NOT NULL BEGIN
+            UPDATE documents SET refcount = refcount - 1, last_ref_at = datetime('now', 'localtime') WHERE sha256 = OLD.doc_hash;
+        END''')
+    except: pass
+    try: c.execute('''CREATE TRIGGER IF NOT EXISTS trg_doc_ref_upd AFTER UPDATE OF doc_hash ON invoices
+        WHEN OLD.doc_hash IS NOT NEW.doc_hash BEGIN
+            UPDATE documents SET refcount = refcount - 1, last_ref_at = datetime('now', 'localtime') WHERE sha256 = OLD.doc_hash;
+            UPDATE documents SET refcount = refcount + 1, last_ref_at = datetime('now', 'localtime') WHERE sha256 = NEW.doc_hash;
+        END''')
+    except: pass
+
+    # --- [NEW] Sổ công nợ: số dư THU/CHI theo ref_code, cập nhật tăng dần bằng trigger ---
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_txn_ref ON transaction_history(ref_code)")
+    except: pass
+    ledger_exists = c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='debt_ledger'").fetchone()
+    try: c.execute('''CREATE TABLE IF NOT EXISTS debt_ledger (
+        ref_code TEXT PRIMARY KEY,
+        paid_in REAL NOT NULL DEFAULT 0,
+        refund REAL NOT NULL DEFAULT 0,
+        txn_count INTEGER NOT NULL DEFAULT 0
+    )''')
+    except: pass
+    try: c.execute('''CREATE TRIGGER IF NOT EXISTS trg_ledger_txn_ins AFTER INSERT ON transaction_history
+        WHEN NEW.ref_code IS NOT NULL BEGIN
+            INSERT OR IGNORE INTO debt_ledger (ref_code) VALUES (NEW.ref_code);
+            UPDATE debt_ledger SET
+                paid_in = paid_in + (CASE WHEN NEW.type='THU' THEN COALESCE(NEW.amount, 0) ELSE 0 END),
+                refund = refund + (CASE WHEN NEW.type='CHI' THEN COALESCE(NEW.amount, 0) ELSE 0 END),
+                txn_count = txn_count + 1
+            WHERE ref_code = NEW.ref_code;
+        END''')
+    except: pass
+    try: c.execute('''CREATE TRIGGER IF NOT EXISTS trg_ledger_txn_del AFTER DELETE ON transaction_history
+        WHEN OLD.ref_code IS NOT NULL BEGIN
+            UPDATE debt_ledger SET
+                paid_in = paid_in - (CASE WHEN OLD.type='THU' THEN COALESCE(OLD.amount, 0) ELSE 0 END),
+                refund = refund - (CASE WHEN OLD.type='CHI' THEN COALESCE(OLD.amount, 0) ELSE 0 END),
+                txn_count = txn_count - 1
+            WHERE ref_code = OLD.ref_code;
+        END''')
+    except: pass
+    try: c.execute('''CREATE TRIGGER IF NOT EXISTS trg_ledger_txn_upd AFTER UPDATE OF ref_code, type, amount ON transaction_history BEGIN
+            UPDATE debt_ledger SET
+                paid_in = paid_in - (CASE WHEN OLD.type='THU' THEN COALESCE(OLD.amount, 0) ELSE 0 END),
+                refund = refund - (CASE WHEN OLD.type='CHI' THEN COALESCE(OLD.amount, 0) ELSE 0 END),
+                txn_count = txn_count - 1
+            WHERE ref_code = OLD.ref_code;
+            INSERT OR IGNORE INTO debt_ledger (ref_code) SELECT NEW.ref_code WHERE NEW.ref_code IS NOT NULL;
+            UPDATE debt_ledger SET
+                paid_in = paid_in + (CASE WHEN NEW.type='THU' THEN COALESCE(NEW.amount, 0) ELSE 0 END),
+                refund = refund + (CASE WHEN NEW.type='CHI' THEN COALESCE(NEW.amount, 0) ELSE 0 END),
+                txn_count = txn_count + 1
+            WHERE ref_code = NEW.ref_code;
+        END''')
+    except: pass
+    if not ledger_exists:
+        # Lần đầu tạo sổ -> dựng lại số dư từ lịch sử giao dịch sẵn có
+        try: c.execute('''INSERT OR REPLACE INTO debt_ledger (ref_code, paid_in, refund, txn_count)
+            SELECT ref_code,
+                   COALESCE(SUM(CASE WHEN type='THU' THEN amount END), 0),
+                   COALESCE(SUM(CASE WHEN type='CHI' THEN amount END), 0),
+                   COUNT(*)
+            FROM transaction_history WHERE ref_code IS NOT NULL GROUP BY ref_code''')
+        except: pass
+
+    # --- [NEW] Khối báo cáo tài chính (hạng mục x mã x tháng) + hàng đợi mã cần tính lại ---
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_cost_code ON invoices(cost_code)")
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_project_links_invoice ON project_links(invoice_id)")
+    except: pass
+    cube_exists = c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='report_cube'").fetchone()
+    try: c.execute('''CREATE TABLE IF NOT EXISTS report_cube (
+        category TEXT,
+        code TEXT,
+        month TEXT,
+        name TEXT,
+        status TEXT,
+        sale_name TEXT,
+        thu REAL DEFAULT 0,
+        chi REAL DEFAULT 0,
+        PRIMARY KEY (category, code, month)
+    )''')
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_report_cube_month ON report_cube(month)")
+    except: pass
+    try: c.execute("CREATE TABLE IF NOT EXISTS report_cube_dirty (category TEXT, code TEXT)")
+    except: pass
+    # Trigger đánh dấu mã bị ảnh hưởng khi dữ liệu nguồn thay đổi (UPDATE chỉ bắt các cột mà khối báo cáo đọc tới)
+    cube_update_cols = {
+        'tours': "tour_code, tour_name, start_date, status, sale_name, final_tour_price, final_qty, guest_count, child_price, child_qty",
+        'tour_items': "tour_id, item_type, total_amount",
+        'service_bookings': "code, name, created_at, status, sale_name, selling_price, net_price",
+        'invoices': "cost_code, status, type, invoice_number, total_amount, request_edit, date, memo, seller_name",
+        'project_links': "project_id, invoice_id",
+        'projects': "project_name",
+    }
+    cube_marks = {
+        'tours': "INSERT INTO report_cube_dirty (category, code) VALUES ('Tour', {R}.tour_code);",
+        'tour_items': "INSERT INTO report_cube_dirty (category, code) SELECT 'Tour', tour_code FROM tours WHERE id = {R}.tour_id;",
+        'service_bookings': "INSERT INTO report_cube_dirty (category, code) VALUES ('Booking Dịch Vụ', {R}.code);",
+        'invoices': ("INSERT INTO report_cube_dirty (category, code) SELECT 'Tour', {R}.cost_code WHERE COALESCE({R}.cost_code, '') != '';"
+                     " INSERT INTO report_cube_dirty (category, code) SELECT 'Booking Dịch Vụ', {R}.cost_code WHERE COALESCE({R}.cost_code, '') != '';"
+                     " INSERT INTO report_cube_dirty (category, code) VALUES ('Chi phí chung', 'INV_' || {R}.id);"
+                     " INSERT INTO report_cube_dirty (category, code) SELECT 'Dự án (cũ)', 'PROJ_' || project_id FROM project_links WHERE invoice_id = {R}.id;"),
+        'project_links': ("INSERT INTO report_cube_dirty (category, code) VALUES ('Dự án (cũ)', 'PROJ_' || {R}.project_id);"
+                          " INSERT INTO report_cube_dirty (category, code) VALUES ('Chi phí chung', 'INV_' || {R}.invoice_id);"),
+        'projects': "INSERT INTO report_cube_dirty (category, code) VALUES ('Dự án (cũ)', 'PROJ_' || {R}.id);",
+    }
+    for tbl, mark in cube_marks.items():
+        for event, spec, body in [('INSERT', 'INSERT', mark.format(R='NEW')), ('DELETE', 'DELETE', mark.format(R='OLD')),
+                                  ('UPDATE', f"UPDATE OF {cube_update_cols[tbl]}", mark.format(R='OLD') + " " + mark.format(R='NEW'))]:
+            try: _ensure_trigger(c, f"trg_cube_{tbl}_{event.lower()}", f"AFTER {spec} ON {tbl} BEGIN {body} END")
+            except: pass
+    if not cube_exists:
+        # Lần đầu tạo khối -> đánh dấu tính lại toàn bộ
+        try: c.execute("INSERT INTO report_cube_dirty (category, code) VALUES ('*', '*')")
+        except: pass
+
+    # --- [NEW] Cột không dấu (*_fold) + index NOCASE, dấu vân tay chống trùng hóa đơn (fingerprint) + index một phần ---
+    # Giá trị tính bằng Python (fold_vn / invoice_fingerprint) trong sync_derived_columns(). Trigger chỉ ghi (bảng, id)
+    # vào derived_dirty bằng SQL thuần -> công cụ khác ghi thẳng vào DB (không có hàm Python) vẫn chạy được.
+    try: c.execute("CREATE TABLE IF NOT EXISTS derived_dirty (tbl TEXT, row_id INTEGER)")
+    except: pass
+    for tbl, fold_cols in FOLD_COLUMNS.items():
+        for col in fold_cols:
+            try:
+                c.execute(f"ALTER TABLE {tbl} ADD COLUMN {col}_fold TEXT")
+                c.execute(f"INSERT INTO derived_dirty (tbl, row_id) SELECT '{tbl}', id FROM {tbl}")
+            except: pass
+            try: c.execute(f"CREATE INDEX IF NOT EXISTS idx_{tbl}_{col}_fold ON {tbl}({col}_fold COLLATE NOCASE)")
+            except: pass
+    try:
+        c.execute("ALTER TABLE invoices ADD COLUMN fingerprint TEXT")
+        c.execute("INSERT INTO derived_dirty (tbl, row_id) SELECT 'invoices', id FROM invoices")
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_fingerprint ON invoices(fingerprint) WHERE fingerprint IS NOT NULL")
+    except: pass
+    # Bản cũ giữ tiền tố chữ trong số HĐ ('H0000123|...') -> tính lại các dòng đó
+    try: c.execute("""INSERT INTO derived_dirty (tbl, row_id) SELECT 'invoices', id FROM invoices
+        WHERE fingerprint GLOB '[A-Z]*' AND substr(fingerprint, 1, instr(fingerprint, '|') - 1) GLOB '*[0-9]*'""")
+    except: pass
+    for tbl, date_cols in DATE_KEY_COLUMNS.items():
+        for col in date_cols:
+            try:
+                c.execute(f"ALTER TABLE {tbl} ADD COLUMN {col} TEXT")
+                c.execute(f"INSERT INTO derived_dirty (tbl, row_id) SELECT '{tbl}', id FROM {tbl}")
+            except: pass
+            try: c.execute(f"CREATE INDEX IF NOT EXISTS idx_{tbl}_{col} ON {tbl}({col})")
+            except: pass
+    # Bản cũ tính trong trigger bằng vn_fold()/invoice_fp() -> bỏ
+    for tbl in FOLD_COLUMNS:
+        for event in ('insert', 'update'):
+            try: c.execute(f"DROP TRIGGER IF EXISTS trg_fold_{tbl}_{event}")
+            except: pass
+    for event in ('insert', 'update'):
+        try: c.execute(f"DROP TRIGGER IF EXISTS trg_invoices_fp_{event}")
+        except: pass
+    for tbl, cols in DERIVED_SOURCE_COLUMNS.items():
+        mark = f"INSERT INTO derived_dirty (tbl, row_id) VALUES ('{tbl}', NEW.id);"
+        try: _ensure_trigger(c, f"trg_derived_{tbl}_insert", f"AFTER INSERT ON {tbl} BEGIN {mark} END")
+        except: pass
+        try: _ensure_trigger(c, f"trg_derived_{tbl}_update", f"AFTER UPDATE OF {', '.join(cols)} ON {tbl} BEGIN {mark} END")
+        except: pass
+
+    # --- [NEW] Đối soát UNC <-> Hóa đơn: bảng liên kết (1 UNC trả nhiều HĐ / 1 HĐ trả bằng nhiều UNC) ---
+    try: c.execute('''CREATE TABLE IF NOT EXISTS unc_invoice_links (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        unc_id INTEGER NOT NULL,       -- invoices.id của UNC
+        invoice_id INTEGER NOT NULL,   -- invoices.id của hóa đơn
+        amount REAL,                   -- Số tiền phân bổ cho cặp này
+        score REAL,                    -- Độ tin cậy (0..1) khi ghép tự động
+        method TEXT,                   -- 'auto' | 'manual' | 'rejected' (người dùng bỏ, không ghép lại cặp này)
+        cost_code TEXT,
+        created_at TEXT,
+        UNIQUE (unc_id, invoice_id)
+    )''')
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_unc_links_invoice ON unc_invoice_links(invoice_id)")
+    except: pass
+    try: c.execute("CREATE INDEX IF NOT EXISTS idx_unc_links_code ON unc_invoice_links(cost_code)")
+    except: pass
+    # Chứng từ bị xóa / đổi số tiền, mã, trạng thái -> bỏ liên kết tự động của nó để lần đối soát sau ghép lại
+    try: c.execute('''CREATE TRIGGER IF NOT EXISTS trg_unc_links_inv_del AFTER DELETE ON invoices BEGIN
+            DELETE FROM unc_invoice_links WHERE unc_id = OLD.id OR invoice_id = OLD.id;
+        END''')
+    except: pass
+    try: c.execute('''CREATE TRIGGER IF NOT EXISTS trg_unc_links_inv_upd AFTER UPDATE OF status, total_amount, cost_code, type ON invoices
+        WHEN OLD.status IS NOT NEW.status OR OLD.total_amount IS NOT NEW.total_amount OR OLD.cost_code IS NOT NEW.cost_code OR OLD.type IS NOT NEW.type BEGIN
+            DELETE FROM unc_invoice_links WHERE method = 'auto' AND (unc_id = NEW.id OR invoice_id = NEW.id);
+        END''')
+    except: pass
+
+    # --- [NEW] Chỉ mục toàn văn FTS5 (trigram) cho Tra cứu ---
+    # Xóa dòng nguồn -> trigger bỏ dòng khỏi chỉ mục; thêm/sửa -> derived_dirty, sync_derived_columns() ghi lại (1 lần/dòng)
+    fts_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name='search_fts'").fetchone()
+    if fts_exists and 'folded' not in [r[1] for r in c.execute("PRAGMA table_info(search_fts)").fetchall()]:
+        # Chỉ mục bản cũ chưa có cột không dấu -> dựng lại
+        for (trg,) in c.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE 'trg_fts_%'").fetchall():
+            c.execute(f"DROP TRIGGER IF EXISTS {trg}")
+        c.execute("DROP TABLE search_fts")
+        fts_exists = None
+    try:
+        c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(code, title, body, folded, tokenize='trigram')")
+        for tbl, (kind, code_col, title_col, body_col) in SEARCH_FTS_SOURCES.items():
+            for event in ('insert', 'update'):
+                c.execute(f"DROP TRIGGER IF EXISTS trg_fts_{tbl}_{event}")
+            # Trigger vừa tạo (chỉ mục mới / nguồn mới thêm) -> nạp dữ liệu sẵn có 1 lần
+            if _ensure_trigger(c, f"trg_fts_{tbl}_delete", f"AFTER DELETE ON {tbl} BEGIN DELETE FROM search_fts WHERE rowid = OLD.id * 8 + {kind}; END"):
+                c.execute(f"INSERT INTO derived_dirty (tbl, row_id) SELECT '{tbl}', id FROM {tbl}")
+    except: pass  # SQLite < 3.34 không có trigram -> Tra cứu dùng LIKE như cũ
+
     conn.commit()
+    try: sync_derived_columns(conn)
+    except Exception as e: print(f"Lỗi đồng bộ cột không dấu/chỉ mục: {e}")
 
 def init_db():
     conn = get_connection()
@@ -683,29 +1125,124 @@ if not st.session_state.db_initialized:
 migrate_db_columns()
 
 # --- CÁC HÀM HỖ TRỢ ---
+# --- [NEW] GHI DỮ LIỆU -> XÓA CACHE LIÊN QUAN ---
+# Các cache đọc đăng ký danh sách bảng phụ thuộc; mọi lệnh ghi qua run_query / run_query_many / add_row_to_table sẽ báo tên bảng.
+_TABLE_WRITE_HOOKS = []
+# Có thể mở đầu bằng CTE (WITH x AS (SELECT ...) INSERT ...): CTE trong SQLite chỉ là SELECT -> lệnh ghi là từ khóa đầu tiên đứng sau ')'
+_WRITE_TABLE_RE = re.compile(r"^\s*(?:WITH\b.*?\)\s*)?(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+[\"`\[]?(\w+)", re.I | re.S)
+
+# --- [NEW] CACHE KẾT QUẢ run_query THEO PHIÊN ---
+# Chỉ bật khi gọi run_query(..., cache=True). Mỗi bảng có 1 số phiên bản dùng chung mọi phiên đăng nhập;
+# ghi vào bảng nào thì tăng số của bảng đó -> kết quả cache có đọc bảng đó tự hết hạn.
+_READ_TABLE_RE = re.compile(r"\b(?:FROM|JOIN)\s+[\"`\[]?(\w+)", re.I)
+QUERY_CACHE_MAX_ENTRIES = 256
+# Bảng được ghi kèm khi ghi 1 bảng cũng phải tăng phiên bản. Không liệt kê tay: đọc thân mọi trigger trong sqlite_master
+# (debt_ledger, report_cube_dirty, derived_dirty, documents, unc_invoice_links, email_outbox, search_fts khi xóa...),
+# lan truyền qua trigger lồng nhau, cộng thêm search_fts do sync_derived_columns() ghi bằng Python khi bảng nguồn đổi.
+_TRIGGER_BODY_WRITE_RE = re.compile(r"\b(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+[\"`\[]?(\w+)", re.I)
+
+def _trigger_derived_tables(conn=None):
+    """Bảng -> các bảng khác mà trigger (trực tiếp hoặc lồng nhau) và sync_derived_columns ghi kèm"""
+    conn = conn or get_connection()
+    direct = {}
+    for tbl, sql in conn.execute("SELECT tbl_name, sql FROM sqlite_master WHERE type='trigger' AND sql IS NOT NULL"):
+        body = re.split(r"\bBEGIN\b", sql, maxsplit=1, flags=re.I)[-1]
+        direct.setdefault(tbl.lower(), set()).update(t.lower() for t in _TRIGGER_BODY_WRITE_RE.findall(body))
+    for tbl in SEARCH_FTS_SOURCES:
+        direct.setdefault(tbl, set()).add('search_fts')
+    derived = {}
+    for tbl in direct:
+        seen, stack = set(), [tbl]
+        while stack:
+            for t in direct.get(stack.pop(), ()):
+                if t not in seen: seen.add(t); stack.append(t)
+        seen.discard(tbl)
+        derived[tbl] = tuple(sorted(seen))
+    return derived
+
+_TRIGGER_DERIVED_TABLES = _trigger_derived_tables()
+
+@st.cache_resource
+def _table_versions():
+    return {}
+
+@functools.lru_cache(maxsize=512)
+def _query_tables(query):
+    return tuple(sorted({t.lower() for t in _READ_TABLE_RE.findall(query)}))
+
+def _query_cache_key(query, params, fetch_one):
+    if isinstance(params, dict): params = tuple(sorted(params.items()))
+    elif not isinstance(params, tuple): params = tuple(params)
+    return (query, params, bool(fetch_one))
+
+def get_query_cache_stats():
+    return st.session_state.setdefault('_query_cache_stats', {'hit': 0, 'miss': 0})
+
+def clear_query_cache():
+    st.session_state.pop('_query_cache', None)
+    st.session_state['_query_cache_stats'] = {'hit': 0, 'miss': 0}
+
+def register_table_write_hook(tables, callback):
+    _TABLE_WRITE_HOOKS.append(({t.lower() for t in tables}, callback))
+
+def notify_table_write(table_or_sql):
+    """Báo đã ghi 1 bảng (tên bảng hoặc câu SQL ghi). SQL không nhận ra bảng đích (CREATE, PRAGMA...) -> bỏ qua."""
+    if re.fullmatch(r"\s*\w+\s*", table_or_sql): table = table_or_sql.strip().lower()
+    else:
+        m = _WRITE_TABLE_RE.match(table_or_sql)
+        if not m: return
+        table = m.group(1).lower()
+    versions = _table_versions()
+    for t in (table,) + _TRIGGER_DERIVED_TABLES.get(table, ()):
+        versions[t] = versions.get(t, 0) + 1
+    for tables, callback in _TABLE_WRITE_HOOKS:
+        if table in tables:
+            try: callback()
+            except: pass
+
 @overload
-def run_query(query: str, params: Any = ..., fetch_one: Literal[False] = ..., commit: Literal[False] = ...) -> List[Any]: ...
+def run_query(query: str, params: Any = ..., fetch_one: Literal[False] = ..., commit: Literal[False] = ..., cache: bool = ...) -> List[Any]: ...
 
 @overload
-def run_query(query: str, params: Any, fetch_one: Literal[True], commit: Literal[False] = ...) -> Any: ...
+def run_query(query: str, params: Any, fetch_one: Literal[True], commit: Literal[False] = ..., cache: bool = ...) -> Any: ...
 
 @overload
-def run_query(query: str, *, fetch_one: Literal[True], commit: Literal[False] = ...) -> Any: ...
+def run_query(query: str, *, fetch_one: Literal[True], commit: Literal[False] = ..., cache: bool = ...) -> Any: ...
 
 @overload
-def run_query(query: str, params: Any = ..., fetch_one: Any = ..., *, commit: Literal[True]) -> bool: ...
+def run_query(query: str, params: Any = ..., fetch_one: Any = ..., *, commit: Literal[True], cache: bool = ...) -> bool: ...
 
-def run_query(query, params=(), fetch_one=False, commit=False):
+def run_query(query, params=(), fetch_one=False, commit=False, cache=False):
+    cache_key = stamp = None
+    if cache and not commit:
+        try:
+            store = st.session_state.setdefault('_query_cache', {})
+            stats = get_query_cache_stats()
+            cache_key = _query_cache_key(query, params, fetch_one)
+            versions = _table_versions()
+            stamp = tuple(versions.get(t, 0) for t in _query_tables(query))
+            hit = store.get(cache_key)
+            if hit is not None and hit[0] == stamp:
+                stats['hit'] += 1
+                return list(hit[1]) if isinstance(hit[1], list) else hit[1]
+            stats['miss'] += 1
+        except Exception:
+            cache_key = None  # Ngoài phiên Streamlit (thread nền...) -> đọc thẳng DB
     conn = get_connection()
     c = conn.cursor()
     try:
         c.execute(query, params)
         if commit:
             conn.commit()
+            notify_table_write(query)
             return True
-        if fetch_one:
-            return c.fetchone()
-        return c.fetchall()
+        result = c.fetchone() if fetch_one else c.fetchall()
+        if cache_key is not None:
+            store.pop(cache_key, None)
+            while len(store) >= QUERY_CACHE_MAX_ENTRIES: store.pop(next(iter(store)))
+            store[cache_key] = (stamp, result)
+            if isinstance(result, list): result = list(result)
+        return result
     except Exception as e:
         print(f"Lỗi truy vấn DB: {e}")
         if commit: return False
@@ -719,6 +1256,7 @@ def run_query_many(query, data):
     try:
         c.executemany(query, data)
         conn.commit()
+        notify_table_write(query)
         return True
     except Exception as e:
         print(f"Lỗi truy vấn DB (many): {e}")
@@ -739,27 +1277,181 @@ def save_customer_check(name, phone, sale_name=None):
 def hash_pass(password):
     return hashlib.sha256(str.encode(password)).hexdigest()
 
+# --- [NEW] KHO TÀI LIỆU THEO NỘI DUNG (SHA-256) ---
+# File tải lên lưu 1 lần theo hash nội dung: .uploaded_invoices/objects/ab/cd/<sha256>[.zst].
+# Cùng 1 file tải lên nhiều lần chỉ tốn 1 blob; bảng documents giữ size/mime/số trang/refcount, blob hết tham chiếu được gc_documents dọn.
+DOCUMENT_STORE_DIR = os.path.join(UPLOAD_FOLDER, "objects")
+DOCUMENT_GC_GRACE_SECONDS = 3600   # blob chưa ai tham chiếu được giữ lại 1 giờ (đang lưu dở hóa đơn...)
+DOCUMENT_ZSTD_LEVEL = 10
+DOCUMENT_MIN_SAVING = 0.9          # chỉ giữ bản nén khi nhỏ hơn 90% bản gốc (PDF/ảnh thường đã nén sẵn)
+
+def document_blob_path(sha256, compression=None):
+    return os.path.join(DOCUMENT_STORE_DIR, sha256[:2], sha256[2:4], sha256 + (".zst" if compression == 'zstd' else ""))
+
+def _guess_mime(file_bytes, original_name=""):
+    if file_bytes[:5] == b'%PDF-': return 'application/pdf'
+    if file_bytes[:8] == b'\x89PNG\r\n\x1a\n': return 'image/png'
+    if file_bytes[:3] == b'\xff\xd8\xff': return 'image/jpeg'
+    ext = os.path.splitext(original_name or "")[1].lower()
+    return {'.xml': 'application/xml', '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'}.get(ext, 'application/octet-stream')
+
+def _pdf_page_count(file_bytes):
+    try:
+        with pdfplumber.open(io.BytesIO(file_bytes)) as pdf: return len(pdf.pages)
+    except: return None
+
+def _write_blob(path, data):
+    """Ghi nguyên tử (file tạm + os.replace) -> không bao giờ để lại blob ghi dở"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def store_document(file_bytes, original_name="", mime=None):
+    """Lưu file vào kho theo SHA-256 (trùng nội dung -> dùng lại blob cũ), trả về mã hash để ghi vào invoices.doc_hash"""
+    sha = hashlib.sha256(file_bytes).hexdigest()
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    row = run_query("SELECT compression FROM documents WHERE sha256=?", (sha,), fetch_one=True)
+    if row and os.path.exists(document_blob_path(sha, row['compression'])):
+        # Đã có -> chỉ làm mới mốc thời gian để GC không dọn trước khi hóa đơn kịp trỏ tới
+        run_query("UPDATE documents SET last_ref_at=? WHERE sha256=?", (now_str, sha), commit=True)
+        return sha
+
+    data, compression = file_bytes, None
+    if zstd is not None:
+        packed = zstd.ZstdCompressor(level=DOCUMENT_ZSTD_LEVEL).compress(file_bytes)
+        if len(packed) < len(file_bytes) * DOCUMENT_MIN_SAVING: data, compression = packed, 'zstd'
+    _write_blob(document_blob_path(sha, compression), data)
+
+    mime = mime or _guess_mime(file_bytes, original_name)
+    page_count = _pdf_page_count(file_bytes) if mime == 'application/pdf' else (1 if mime.startswith('image/') else None)
+    if row:  # Dòng còn nhưng blob mất (xóa tay...) -> ghi lại thông tin blob mới
+        run_query("UPDATE documents SET stored_size=?, compression=?, last_ref_at=? WHERE sha256=?", (len(data), compression, now_str, sha), commit=True)
+    else:
+        run_query("""INSERT OR IGNORE INTO documents (sha256, size, stored_size, compression, mime, page_count, original_name, refcount, created_at, last_ref_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?, ?)""", (sha, len(file_bytes), len(data), compression, mime, page_count, original_name, now_str, now_str), commit=True)
+    return sha
+
+def read_document(sha256):
+    """Nội dung gốc của 1 tài liệu (giải nén nếu cần), None nếu không có"""
+    if not sha256: return None
+    row = run_query("SELECT compression FROM documents WHERE sha256=?", (sha256,), fetch_one=True)
+    if not row: return None
+    try:
+        with open(document_blob_path(sha256, row['compression']), "rb") as f:
+            data = f.read()
+        if row['compression'] == 'zstd':
+            if zstd is None: return None
+            data = zstd.ZstdDecompressor().decompress(data)
+        return data
+    except OSError:
+        return None
+
 def save_file_local(file_bytes, original_name):
+    """Lưu file vào kho tài liệu, trả về (đường dẫn blob, tên file hiển thị)"""
     try:
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
         clean_name = re.sub(r'[\\/*?:"<>|]', "", original_name)
         if not clean_name.lower().endswith('.pdf'):
             clean_name = os.path.splitext(clean_name)[0] + ".pdf"
-            
-        final_name = f"{ts}_{clean_name}"
-        file_path = os.path.join(UPLOAD_FOLDER, final_name)
-        
-        with open(file_path, "wb") as f:
-            f.write(file_bytes)
-                
-        return file_path, final_name
+        sha = store_document(file_bytes, clean_name)
+        row = run_query("SELECT compression FROM documents WHERE sha256=?", (sha,), fetch_one=True)
+        return document_blob_path(sha, row['compression'] if row else None), clean_name
     except: return None, None
 
+def gc_documents(grace_seconds=DOCUMENT_GC_GRACE_SECONDS, sweep_orphans=False):
+    """Dọn blob không còn hóa đơn nào trỏ tới, trả về (số file đã xóa, số byte giải phóng).
+    sweep_orphans=True: quét thêm thư mục kho để xóa file lạ / file tạm sót lại (chậm hơn, chỉ chạy khi admin yêu cầu)."""
+    cutoff = (datetime.now() - timedelta(seconds=grace_seconds)).strftime('%Y-%m-%d %H:%M:%S')
+    # Đếm lại refcount từ invoices (trigger giữ đúng, đây chỉ là chốt an toàn trước khi xóa)
+    run_query("UPDATE documents SET refcount = (SELECT COUNT(*) FROM invoices WHERE invoices.doc_hash = documents.sha256)", commit=True)
+    dead = run_query("SELECT sha256, compression, stored_size FROM documents WHERE refcount <= 0 AND COALESCE(last_ref_at, created_at) <= ?", (cutoff,))
+    removed, freed = 0, 0
+    for d in dead:
+        try:
+            os.remove(document_blob_path(d['sha256'], d['compression']))
+            removed += 1; freed += d['stored_size'] or 0
+        except FileNotFoundError: pass
+        except OSError: continue
+        run_query("DELETE FROM documents WHERE sha256=? AND refcount <= 0", (d['sha256'],), commit=True)
+
+    if sweep_orphans and os.path.isdir(DOCUMENT_STORE_DIR):
+        known = {r['sha256'] for r in run_query("SELECT sha256 FROM documents")}
+        cutoff_ts = time.time() - grace_seconds
+        for root, _, files in os.walk(DOCUMENT_STORE_DIR):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.split('.')[0] in known and not name.endswith('.tmp'): continue
+                try:
+                    if os.path.getmtime(path) < cutoff_ts:
+                        freed += os.path.getsize(path); os.remove(path); removed += 1
+                except OSError: pass
+    return removed, freed
+
+def find_duplicate_invoices(fingerprint=None, file_hash=None, exclude_id=None):
+    """Hóa đơn/UNC còn hiệu lực trùng dấu vân tay hoặc trùng file (tra theo index, không quét bảng)"""
+    conds, params = [], []
+    if fingerprint: conds.append("fingerprint = ?"); params.append(fingerprint)
+    if file_hash: conds.append("doc_hash = ?"); params.append(file_hash)
+    if not conds: return []
+    params = [fingerprint, file_hash] + params + [exclude_id or 0]
+    return run_query(f"""SELECT id, type, date, invoice_number, invoice_symbol, seller_name, total_amount, memo, created_at,
+        CASE WHEN fingerprint = ? THEN 'fingerprint' ELSE '' END AS by_fp, CASE WHEN doc_hash = ? THEN 'file' ELSE '' END AS by_file
+        FROM invoices WHERE ({' OR '.join(conds)}) AND status != 'deleted' AND id != ? ORDER BY id""", params)
+
+def warn_duplicate_invoice(fingerprint, file_hash):
+    """Trước khi lưu: trùng -> cảnh báo & dừng 1 lần, bấm lưu lần nữa mới lưu. Trả về True nếu vừa cảnh báo"""
+    dups = find_duplicate_invoices(fingerprint, file_hash)
+    if not dups: return False
+    ack_key = f"{fingerprint}|{file_hash}"
+    if st.session_state.get('dup_invoice_ack') == ack_key: return False
+    st.session_state.dup_invoice_ack = ack_key
+    lines = []
+    for d in dups[:5]:
+        reason = " + ".join(r for r in [("cùng số HĐ/bên bán/số tiền" if d['by_fp'] else ""), ("cùng file" if d['by_file'] else "")] if r)
+        lines.append(f"- #{d['id']} · {d['date']} · {d['invoice_number'] or '(Không số)'} · {d['seller_name'] or ''} · {format_vnd(d['total_amount'])} ({reason})")
+    st.warning("⚠️ Chứng từ này có vẻ đã được lưu trước đó:\n" + "\n".join(lines) + "\n\nBấm lưu lần nữa nếu vẫn muốn lưu.")
+    return True
+
+def scan_duplicate_invoices(refresh=True):
+    """Quét toàn bộ dữ liệu cũ: tính lại fingerprint rồi gom nhóm trùng (fingerprint / file) -> DataFrame"""
+    if refresh:
+        rows = run_query(f"SELECT id, {', '.join(INVOICE_FP_COLUMNS)} FROM invoices")
+        run_query_many("UPDATE invoices SET fingerprint = ? WHERE id = ?", [(invoice_fingerprint(*tuple(r)[1:]), r['id']) for r in rows])
+    rows = run_query("""
+        SELECT 'Số HĐ/bên bán/số tiền' AS kind, fingerprint AS k, COUNT(*) AS n, GROUP_CONCAT(id, ', ') AS ids,
+               MIN(invoice_number) AS invoice_number, MIN(seller_name) AS seller_name, MIN(total_amount) AS total_amount
+        FROM invoices WHERE fingerprint IS NOT NULL AND status != 'deleted' GROUP BY fingerprint HAVING COUNT(*) > 1
+        UNION ALL
+        SELECT 'Cùng file', doc_hash, COUNT(*), GROUP_CONCAT(id, ', '), MIN(invoice_number), MIN(seller_name), MIN(total_amount)
+        FROM invoices WHERE doc_hash IS NOT NULL AND status != 'deleted' GROUP BY doc_hash HAVING COUNT(*) > 1
+    """)
+    return pd.DataFrame([dict(r) for r in rows], columns=['kind', 'k', 'n', 'ids', 'invoice_number', 'seller_name', 'total_amount'])
+
+def get_document_store_stats():
+    row = run_query("""SELECT COUNT(*) AS docs, COALESCE(SUM(size), 0) AS size, COALESCE(SUM(stored_size), 0) AS stored,
+        COALESCE(SUM(size * MAX(refcount - 1, 0)), 0) AS dedup_saved, SUM(CASE WHEN refcount <= 0 THEN 1 ELSE 0 END) AS unreferenced
+        FROM documents""", fetch_one=True)
+    return dict(row) if row else {'docs': 0, 'size': 0, 'stored': 0, 'dedup_saved': 0, 'unreferenced': 0}
+
 def format_vnd(amount):
     if amount is None: return "0"
     try: return "{:,.0f}".format(float(amount)).replace(",", ".")
     except: return "0"
 
+def format_vnd_series(values, suffix=""):
+    """Bản vector hóa của format_vnd cho cả cột: ép số 1 lần, mỗi giá trị khác nhau chỉ format 1 lần"""
+    nums = pd.to_numeric(pd.Series(values), errors='coerce').fillna(0).round(0)
+    lookup = {v: "{:,.0f}".format(v).replace(",", ".") + suffix for v in pd.unique(nums)}
+    return nums.map(lookup)
+
+def format_vnd_frame(df, columns, suffix=""):
+    """Format nhiều cột tiền của DataFrame (trả về bản copy)"""
+    out = df.copy()
+    for col in columns:
+        if col in out.columns: out[col] = format_vnd_series(out[col], suffix)
+    return out
+
 @st.cache_data
 def get_company_data():
     row = run_query("SELECT * FROM company_info WHERE id = 1", fetch_one=True)
@@ -774,112 +1466,524 @@ def update_company_info(name, address, phone, logo_bytes=None):
         if isinstance(old, sqlite3.Row): b64_str = old['logo_base64'] # type: ignore
     run_query("UPDATE company_info SET name=?, address=?, phone=?, logo_base64=? WHERE id=1", (name, address, phone, b64_str), commit=True)
     get_company_data.clear()# type: ignore
+    _build_logo_assets.clear() # type: ignore
+    _build_logo_watermark.clear() # type: ignore
+
+# --- [NEW] LOGO XỬ LÝ SẴN (dùng chung cho PDF / DOCX / Excel) ---
+# Cache theo nội dung logo_base64 -> đổi logo là tự sinh bản mới, update_company_info dọn bản cũ.
+# Cache chỉ giữ bytes bất biến (dùng chung giữa các thread an toàn); ImageReader có trạng thái nên mỗi tài liệu tạo cái mới.
+@st.cache_resource(show_spinner=False)
+def _build_logo_assets(logo_b64_str):
+    if not logo_b64_str: return None
+    try:
+        raw = base64.b64decode(logo_b64_str)
+        with Image.open(io.BytesIO(raw)) as img:
+            size = img.size
+        return {'bytes': raw, 'size': size, 'aspect': size[0] / float(size[1])}
+    except Exception as e:
+        print(f"Lỗi đọc logo: {e}")
+        return None
+
+@st.cache_resource(show_spinner=False)
+def _build_logo_watermark(logo_b64_str, alpha, max_width=800):
+    assets = _build_logo_assets(logo_b64_str)
+    if not assets: return None
+    with Image.open(io.BytesIO(assets['bytes'])) as src:
+        img = src.convert('RGBA')
+    if img.width > max_width:
+        img = img.resize((max_width, max(1, int(max_width / assets['aspect']))), Image.LANCZOS)
+    # Áp độ mờ thẳng vào kênh alpha -> lúc vẽ không cần setFillAlpha
+    img.putalpha(img.getchannel('A').point(lambda v: int(v * alpha)))
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return {'aspect': assets['aspect'], 'bytes': buf.getvalue()}
+
+def get_logo_assets(comp=None):
+    """Logo gốc: bytes, size, aspect, reader (ImageReader mới cho ReportLab, riêng cho tài liệu đang tạo)"""
+    comp = comp or get_company_data()
+    assets = _build_logo_assets(comp.get('logo_b64_str') or "")
+    return dict(assets, reader=ImageReader(io.BytesIO(assets['bytes']))) if assets else None
+
+def get_logo_watermark(alpha, comp=None):
+    """Logo chìm đã áp độ mờ: aspect, reader (ImageReader mới cho mỗi tài liệu)"""
+    comp = comp or get_company_data()
+    wm = _build_logo_watermark(comp.get('logo_b64_str') or "", alpha)
+    return {'aspect': wm['aspect'], 'reader': ImageReader(io.BytesIO(wm['bytes']))} if wm else None
 
 # --- HÀM GỬI EMAIL ---
-def send_email_notification(to_email, subject, body_html, cc_emails=None):
-    """Hàm gửi email qua SMTP Gmail"""
+# [NEW] 1 kết nối SMTP đã STARTTLS + đăng nhập, dùng lại cho mọi email trong tiến trình (khóa để các thread gửi lần lượt).
+# Rảnh quá SMTP_IDLE_SECONDS thì mở lại; mất kết nối giữa chừng thì tự kết nối lại và gửi lại đúng email đó 1 lần.
+SMTP_IDLE_SECONDS = 240   # Gmail tự ngắt kết nối rảnh sau vài phút
+SMTP_TIMEOUT = 30
+
+def get_smtp_settings():
+    """Cấu hình SMTP từ secrets.toml; có [email] debug_port hoặc biến môi trường SMTP_DEBUG_PORT -> gửi vào máy chủ giả cục bộ"""
+    debug_port = os.environ.get("SMTP_DEBUG_PORT")
+    if debug_port:  # Không cần secrets.toml khi thử với máy chủ giả
+        return {'host': '127.0.0.1', 'port': int(debug_port), 'tls': False, 'sender': "debug@localhost", 'password': None}
+    cfg = st.secrets["email"]
+    debug_port = cfg.get("debug_port")
+    if debug_port:
+        return {'host': '127.0.0.1', 'port': int(debug_port), 'tls': False, 'sender': cfg.get("sender", "debug@localhost"), 'password': None}
+    return {'host': cfg.get("host", "smtp.gmail.com"), 'port': int(cfg.get("port", 587)), 'tls': True,
+            'sender': cfg["sender"], 'password': cfg["password"]}
+
+@st.cache_resource
+def get_mail_transport():
+    return {'lock': threading.Lock(), 'server': None, 'settings': None, 'last_used': 0.0,
+            'stats': {'sent': 0, 'failed': 0, 'connects': 0, 'reconnects': 0, 'batches': 0, 'send_seconds': 0.0}}
+
+def _smtp_close(transport):
+    server, transport['server'] = transport['server'], None
+    if server is not None:
+        try: server.quit()
+        except: pass
+
+def _smtp_server(transport, settings):
+    """Trả về kết nối đang mở (hoặc mở mới) cho cấu hình hiện tại"""
+    if transport['server'] is not None and (transport['settings'] != settings or time.time() - transport['last_used'] > SMTP_IDLE_SECONDS):
+        _smtp_close(transport)
+    if transport['server'] is None:
+        server = smtplib.SMTP(settings['host'], settings['port'], timeout=SMTP_TIMEOUT)
+        if settings['tls']:
+            server.starttls()
+            server.login(settings['sender'], settings['password'])
+        transport['server'], transport['settings'] = server, settings
+        transport['stats']['connects'] += 1
+    return transport['server']
+
+def build_email_message(sender, to_email, subject, body_html, cc_emails=None):
+    """MIME message + danh sách người nhận (To + Cc)"""
+    msg = MIMEMultipart()
+    msg['From'] = f"Bali Tourist System <{sender}>"
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    if cc_emails:
+        msg['Cc'] = cc_emails if isinstance(cc_emails, str) else ", ".join(cc_emails)
+    msg.attach(MIMEText(body_html, 'html'))
+
+    # Xử lý danh sách người nhận (To + Cc)
+    recipients = [to_email]
+    if cc_emails:
+        if isinstance(cc_emails, str):
+            recipients.extend([e.strip() for e in cc_emails.split(',') if e.strip()])
+        elif isinstance(cc_emails, list):
+            recipients.extend(cc_emails)
+    return msg, recipients
+
+def send_email_batch(emails):
+    """Gửi nhiều email qua 1 phiên SMTP. emails: [(to, subject, body_html, cc)], trả về [(ok, thông báo)] theo đúng thứ tự"""
+    if not emails: return []
     try:
-        # Lấy cấu hình từ secrets.toml
-        email_sender = st.secrets["email"]["sender"]
-        email_password = st.secrets["email"]["password"]
-        
-        msg = MIMEMultipart()
-        msg['From'] = f"Bali Tourist System <{email_sender}>"
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        if cc_emails:
-            msg['Cc'] = cc_emails
-        msg.attach(MIMEText(body_html, 'html'))
-
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(email_sender, email_password)
-        
-        # Xử lý danh sách người nhận (To + Cc)
-        recipients = [to_email]
-        if cc_emails:
-            if isinstance(cc_emails, str):
-                recipients.extend([e.strip() for e in cc_emails.split(',') if e.strip()])
-            elif isinstance(cc_emails, list):
-                recipients.extend(cc_emails)
-        
-        server.send_message(msg, to_addrs=recipients)
-        server.quit()
-        return True, "Đã gửi mail thành công!"
+        settings = get_smtp_settings()
     except Exception as e:
-        return False, f"Lỗi gửi mail: {str(e)}"
+        return [(False, f"Lỗi gửi mail: thiếu cấu hình email ({e})")] * len(emails)
+    transport = get_mail_transport()
+    stats = transport['stats']
+    results = []
+    with transport['lock']:
+        t0 = time.perf_counter()
+        stats['batches'] += 1
+        for to_email, subject, body_html, cc_emails in emails:
+            try:
+                msg, recipients = build_email_message(settings['sender'], to_email, subject, body_html, cc_emails)
+            except Exception as e:
+                stats['failed'] += 1
+                results.append((False, f"Lỗi gửi mail: {str(e)}")); continue
+            for retry in (False, True):
+                try:
+                    if retry: stats['reconnects'] += 1
+                    _smtp_server(transport, settings).send_message(msg, to_addrs=recipients)
+                    transport['last_used'] = time.time()
+                    stats['sent'] += 1
+                    results.append((True, "Đã gửi mail thành công!"))
+                    break
+                except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError) as e:
+                    # Kết nối hỏng -> bỏ kết nối cũ, lượt sau mở lại
+                    _smtp_close(transport)
+                    if retry:
+                        stats['failed'] += 1
+                        results.append((False, f"Lỗi gửi mail: {str(e)}"))
+                except smtplib.SMTPException as e:
+                    # Máy chủ từ chối email này (người nhận, nội dung...) -> không gửi lại, kết nối vẫn dùng tiếp.
+                    # Phải bắt trước OSError: SMTPException là lớp con của OSError. Mã 421 = máy chủ sắp đóng kết nối.
+                    if getattr(e, 'smtp_code', None) == 421: _smtp_close(transport)
+                    stats['failed'] += 1
+                    results.append((False, f"Lỗi gửi mail: {str(e)}"))
+                    break
+                except OSError as e:
+                    # Lỗi socket (mất mạng, hết thời gian chờ) -> mở kết nối mới và thử lại 1 lần
+                    _smtp_close(transport)
+                    if retry:
+                        stats['failed'] += 1
+                        results.append((False, f"Lỗi gửi mail: {str(e)}"))
+                except Exception as e:
+                    stats['failed'] += 1
+                    results.append((False, f"Lỗi gửi mail: {str(e)}"))
+                    break
+        stats['send_seconds'] += time.perf_counter() - t0
+    return results
+
+def send_email_notification(to_email, subject, body_html, cc_emails=None):
+    """Hàm gửi email qua SMTP Gmail (dùng chung kết nối của get_mail_transport)"""
+    return send_email_batch([(to_email, subject, body_html, cc_emails)])[0]
+
+def get_mail_stats():
+    """Số liệu gửi mail của tiến trình: đã gửi, lỗi, số lần kết nối, tốc độ (email/giây)"""
+    stats = dict(get_mail_transport()['stats'])
+    stats['per_second'] = stats['sent'] / stats['send_seconds'] if stats['send_seconds'] else 0.0
+    return stats
+
+class _DebugSMTPHandler(socketserver.StreamRequestHandler):
+    """Máy chủ SMTP giả: nhận thư, lưu vào server.messages (không gửi đi đâu); địa chỉ trong server.rejected bị trả 550"""
+    def handle(self):
+        self.wfile.write(b"220 localhost debug SMTP\r\n")
+        envelope = {'from': None, 'to': []}
+        while True:
+            line = self.rfile.readline()
+            if not line: return
+            cmd = line.decode('utf-8', 'replace').strip()
+            verb = cmd[:4].upper()
+            if verb in ("HELO", "EHLO"):
+                self.wfile.write(b"250 localhost\r\n")
+            elif verb == "MAIL":
+                envelope = {'from': cmd[10:].strip(' <>'), 'to': []}
+                self.wfile.write(b"250 OK\r\n")
+            elif verb == "RCPT":
+                rcpt = cmd[8:].strip(' <>')
+                if rcpt in self.server.rejected:
+                    self.wfile.write(b"550 No such user\r\n"); continue
+                envelope['to'].append(rcpt)
+                self.wfile.write(b"250 OK\r\n")
+            elif verb == "DATA":
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                data = []
+                for raw in iter(self.rfile.readline, b""):
+                    if raw in (b".\r\n", b".\n"): break
+                    data.append(raw[1:] if raw.startswith(b"..") else raw)
+                self.server.messages.append(dict(envelope, data=b"".join(data)))
+                self.wfile.write(b"250 OK queued\r\n")
+            elif verb == "QUIT":
+                self.wfile.write(b"221 Bye\r\n"); return
+            else:  # RSET, NOOP...
+                self.wfile.write(b"250 OK\r\n")
+
+def start_debug_smtp_server(port=0):
+    """Chạy máy chủ SMTP giả trên 127.0.0.1 (thread nền) để thử gửi mail; đặt SMTP_DEBUG_PORT = server.server_address[1]"""
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", port), _DebugSMTPHandler)
+    server.daemon_threads = True
+    server.messages = []
+    server.rejected = set()
+    threading.Thread(target=server.serve_forever, name="debug-smtp", daemon=True).start()
+    return server
 
 # --- HÀM TỰ ĐỘNG QUÉT & GỬI LẦN 2 ---
-def check_and_send_due_reminders():
-    """Kiểm tra các lịch hẹn đến ngày hôm nay để gửi email lần 2"""
-    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    # Tìm các nhắc hẹn có ngày = hôm nay (hoặc quá khứ) VÀ mới chỉ gửi lần 1 ('sent_1')
-    reminders = run_query("SELECT * FROM payment_reminders WHERE status='sent_1' AND due_date <= ?", (now_str,))
-    
-    count = 0
-    if reminders:
-        for row in reminders:
-            r = dict(row)
-            # Gửi email lần 2
-            cc = r.get('cc_email', '')
-            sender = r.get('sender_name', 'Bali Tourist System')
-            
-            # [FIX] Format ngày hiển thị trong mail (DD/MM/YYYY HH:MM)
+def build_second_reminder_email(r):
+    """Tiêu đề + nội dung HTML email nhắc lần 2 từ 1 dòng payment_reminders"""
+    sender = r.get('sender_name') or 'Bali Tourist System'
+    # [FIX] Format ngày hiển thị trong mail (DD/MM/YYYY HH:MM)
+    try:
+        d_obj = datetime.strptime(r['due_date'], '%Y-%m-%d %H:%M:%S')
+        date_display = d_obj.strftime('%H:%M %d/%m/%Y')
+    except:
+        try:
+            d_obj = datetime.strptime(r['due_date'], '%Y-%m-%d')
+            date_display = d_obj.strftime('%d/%m/%Y')
+        except:
+            date_display = r['due_date']
+
+    # [NEW] Bank Info for Automated Email
+    bank_info_html = ""
+    if r.get('bank_name') and r.get('bank_account'):
+        bank_info_html = f"""
+        <div style="background-color: #f8f9fa; padding: 15px; border-radius: 5px; margin: 15px 0;">
+            <h4 style="margin-top: 0;">🏦 THÔNG TIN CHUYỂN KHOẢN</h4>
+            <p><strong>Ngân hàng:</strong> {r['bank_name']}</p>
+            <p><strong>Số tài khoản:</strong> {r['bank_account']}</p>
+            <p><strong>Chủ tài khoản:</strong> {r.get('bank_holder', '')}</p>
+        </div>
+        """
+
+    subject = f"🔔 [NHẮC HẸN LẦN 2] Thanh toán cho mã {r['ref_code']}"
+    content = f"""
+    <h3>🔔 NHẮC HẸN THANH TOÁN (LẦN 2)</h3>
+    <p>Hệ thống tự động nhắc bạn về khoản thanh toán đã đến hẹn:</p>
+    <ul>
+        <li><strong>Mã hồ sơ:</strong> {r['ref_code']}</li>
+        <li><strong>Tên:</strong> {r['ref_name']}</li>
+        <li><strong>Số tiền:</strong> {format_vnd(r['amount'])} VND</li>
+        <li><strong>Nội dung:</strong> {r['content']}</li>
+        <li><strong>Ngày hẹn:</strong> {date_display}</li>
+    </ul>
+    {bank_info_html}
+    <p>Vui lòng kiểm tra và xử lý.</p>
+    <p>Trân trọng,<br>{sender}</p>
+    """
+    return subject, content
+
+# [NEW] Lập lịch nền: 1 thread/tiến trình quét payment_reminders theo (status, due_date) rồi xả email_outbox.
+# Nhắc đến hạn được chuyển thành email trong outbox bằng 1 giao dịch BEGIN IMMEDIATE; email trong outbox được "nhận"
+# bằng 1 lệnh UPDATE (queued -> sending) -> nhiều tiến trình chạy cùng DB không gửi trùng.
+REMINDER_POLL_SECONDS = 30
+REMINDER_BATCH_SIZE = 20
+OUTBOX_CLAIM_TIMEOUT = 600     # giây: email 'sending' quá lâu (tiến trình chết giữa chừng) được trả lại hàng chờ
+OUTBOX_MAX_ATTEMPTS = 6        # quá số lần gửi lỗi -> 'dead', chờ admin xử lý
+OUTBOX_BACKOFF_BASE = 60       # giây: lần thử lại thứ n chờ BASE * 2^(n-1) (+ ngẫu nhiên), tối đa OUTBOX_BACKOFF_MAX
+OUTBOX_BACKOFF_MAX = 6 * 3600
+OUTBOX_SENT_RETENTION_DAYS = int(os.environ.get("OUTBOX_SENT_RETENTION_DAYS", 30))  # email đã gửi giữ lại bao lâu (nội dung HTML khá nặng)
+REMINDER_WORKER_ID = f"{os.getpid()}-{''.join(random.choices(string.ascii_lowercase + string.digits, k=6))}"
+
+def open_worker_connection():
+    """Kết nối riêng cho thread nền (không dùng chung get_connection với luồng giao diện)"""
+    conn = sqlite3.connect(DB_FILE, timeout=30, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _db_now(now=None):
+    return (now or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+
+def _insert_outbox(conn, to_email, subject, body_html, cc_emails=None, reminder_id=None, stage=None, now=None):
+    now_str = _db_now(now)
+    cur = conn.execute("""INSERT INTO email_outbox (to_email, cc_emails, subject, body_html, status, attempts, next_attempt_at, reminder_id, stage, created_at)
+        VALUES (?, ?, ?, ?, 'queued', 0, ?, ?, ?, ?)""", (to_email, cc_emails or '', subject, body_html, now_str, reminder_id, stage, now_str))
+    return cur.lastrowid
+
+def enqueue_email(to_email, subject, body_html, cc_emails=None, reminder_id=None, stage=None):
+    """Đưa 1 email vào email_outbox (thread nền sẽ gửi), trả về id"""
+    conn = get_connection()
+    with conn:
+        outbox_id = _insert_outbox(conn, to_email, subject, body_html, cc_emails, reminder_id, stage)
+    notify_table_write('email_outbox')
+    wake_reminder_scheduler()
+    return outbox_id
+
+def queue_payment_request(reminder_row, subject, body_html):
+    """Lưu nhắc hẹn (chờ gửi lần 1) + email lần 1 vào outbox trong cùng 1 giao dịch"""
+    conn = get_connection()
+    with conn:
+        cols = ', '.join(reminder_row.keys())
+        cur = conn.execute(f"INSERT INTO payment_reminders ({cols}) VALUES ({', '.join(['?'] * len(reminder_row))})", list(reminder_row.values()))
+        _insert_outbox(conn, reminder_row['receiver_email'], subject, body_html, reminder_row.get('cc_email'), cur.lastrowid, 1)
+    notify_table_write('payment_reminders')
+    notify_table_write('email_outbox')
+    wake_reminder_scheduler()
+
+def enqueue_due_reminders(conn, limit=REMINDER_BATCH_SIZE, now=None):
+    """Chuyển các nhắc đã gửi lần 1 và đến hạn thành email lần 2 trong outbox (sent_1 -> queued_2), trả về số email"""
+    now_str = _db_now(now)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        due = [dict(r) for r in conn.execute("SELECT * FROM payment_reminders WHERE status='sent_1' AND due_date <= ? ORDER BY due_date LIMIT ?", (now_str, limit))]
+        for r in due:
             try:
-                d_obj = datetime.strptime(r['due_date'], '%Y-%m-%d %H:%M:%S')
-                date_display = d_obj.strftime('%H:%M %d/%m/%Y')
-            except:
-                try:
-                    d_obj = datetime.strptime(r['due_date'], '%Y-%m-%d')
-                    date_display = d_obj.strftime('%d/%m/%Y')
-                except:
-                    date_display = r['due_date']
-
-            # [NEW] Bank Info for Automated Email
-            bank_info_html = ""
-            if r.get('bank_name') and r.get('bank_account'):
-                bank_info_html = f"""
-                <div style="background-color: #f8f9fa; padding: 15px; border-radius: 5px; margin: 15px 0;">
-                    <h4 style="margin-top: 0;">🏦 THÔNG TIN CHUYỂN KHOẢN</h4>
-                    <p><strong>Ngân hàng:</strong> {r['bank_name']}</p>
-                    <p><strong>Số tài khoản:</strong> {r['bank_account']}</p>
-                    <p><strong>Chủ tài khoản:</strong> {r.get('bank_holder', '')}</p>
-                </div>
-                """
-
-            subject = f"🔔 [NHẮC HẸN LẦN 2] Thanh toán cho mã {r['ref_code']}"
-            content = f"""
-            <h3>🔔 NHẮC HẸN THANH TOÁN (LẦN 2)</h3>
-            <p>Hệ thống tự động nhắc bạn về khoản thanh toán đã đến hẹn:</p>
-            <ul>
-                <li><strong>Mã hồ sơ:</strong> {r['ref_code']}</li>
-                <li><strong>Tên:</strong> {r['ref_name']}</li>
-                <li><strong>Số tiền:</strong> {format_vnd(r['amount'])} VND</li>
-                <li><strong>Nội dung:</strong> {r['content']}</li>
-                <li><strong>Ngày hẹn:</strong> {date_display}</li>
-            </ul>
-            {bank_info_html}
-            <p>Vui lòng kiểm tra và xử lý.</p>
-            <p>Trân trọng,<br>{sender}</p>
-            """
-            success, msg = send_email_notification(r['receiver_email'], subject, content, cc_emails=cc)
-            if success:
-                # Cập nhật trạng thái thành sent_2 (đã xong)
-                run_query("UPDATE payment_reminders SET status='sent_2' WHERE id=?", (r['id'],), commit=True)
-                count += 1
+                subject, content = build_second_reminder_email(r)
+            except Exception as e:
+                conn.execute("UPDATE payment_reminders SET status='failed', last_error=? WHERE id=?", (str(e), r['id']))
+                continue
+            _insert_outbox(conn, r['receiver_email'], subject, content, r.get('cc_email'), r['id'], 2, now)
+            conn.execute("UPDATE payment_reminders SET status='queued_2' WHERE id=?", (r['id'],))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(due)
+
+def outbox_backoff_seconds(attempts):
+    """Giãn cách thử lại theo cấp số nhân, cộng ngẫu nhiên tới 10% để các tiến trình không dồn cùng lúc"""
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** max(0, attempts - 1))
+    return delay + random.uniform(0, delay * 0.1)
+
+def claim_outbox(conn, limit=REMINDER_BATCH_SIZE, now=None):
+    """Nhận nguyên tử tối đa `limit` email đến lượt gửi cho tiến trình này"""
+    now = now or datetime.now()
+    now_str = _db_now(now)
+    token = f"{REMINDER_WORKER_ID}:{time.time_ns()}"
+    with conn:
+        conn.execute("UPDATE email_outbox SET status='queued', claimed_by=NULL WHERE status='sending' AND claimed_at < ?",
+                     (_db_now(now - timedelta(seconds=OUTBOX_CLAIM_TIMEOUT)),))
+        conn.execute("""UPDATE email_outbox SET status='sending', claimed_by=?, claimed_at=?, attempts=COALESCE(attempts, 0) + 1
+            WHERE id IN (SELECT id FROM email_outbox WHERE status='queued' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?)""",
+            (token, now_str, now_str, limit))
+    return [dict(r) for r in conn.execute("SELECT * FROM email_outbox WHERE status='sending' AND claimed_by=?", (token,))]
+
+def finish_outbox(conn, item, success, error=None, now=None):
+    """Ghi kết quả gửi 1 email + cập nhật nhắc hẹn liên quan (lần 1 -> sent_1, lần 2 -> sent_2, hết lượt -> failed)"""
+    now = now or datetime.now()
+    attempts = item.get('attempts') or 0
+    if success:
+        status, next_at = 'sent', None
+    elif attempts >= OUTBOX_MAX_ATTEMPTS:
+        status, next_at = 'dead', None
+    else:
+        status, next_at = 'queued', _db_now(now + timedelta(seconds=outbox_backoff_seconds(attempts)))
+    with conn:
+        conn.execute("""UPDATE email_outbox SET status=?, claimed_by=NULL, last_error=?, next_attempt_at=COALESCE(?, next_attempt_at), sent_at=?
+            WHERE id=? AND claimed_by=?""",
+            (status, None if success else error, next_at, _db_now(now) if success else None, item['id'], item['claimed_by']))
+        if item.get('reminder_id'):
+            r_status = {'sent': 'sent_1' if item.get('stage') == 1 else 'sent_2', 'dead': 'failed'}.get(status)
+            conn.execute("UPDATE payment_reminders SET status=COALESCE(?, status), attempts=?, last_attempt_at=?, last_error=? WHERE id=?",
+                         (r_status, attempts, _db_now(now), None if success else error, item['reminder_id']))
+
+def prune_email_outbox(conn, now=None):
+    """Xóa email đã gửi quá OUTBOX_SENT_RETENTION_DAYS ngày, trả về số dòng đã xóa"""
+    cutoff = _db_now((now or datetime.now()) - timedelta(days=OUTBOX_SENT_RETENTION_DAYS))
+    with conn:
+        return conn.execute("DELETE FROM email_outbox WHERE status='sent' AND sent_at < ?", (cutoff,)).rowcount
+
+def drain_email_outbox(conn, limit=REMINDER_BATCH_SIZE):
+    """Gửi các email đến lượt trong outbox qua 1 phiên SMTP, trả về số email gửi thành công"""
+    items = claim_outbox(conn, limit)
+    if not items: return 0
+    results = send_email_batch([(i['to_email'], i['subject'], i['body_html'], i['cc_emails']) for i in items])
+    for item, (success, msg) in zip(items, results):
+        finish_outbox(conn, item, success, msg)
+    return sum(1 for ok, _ in results if ok)
+
+def check_and_send_due_reminders(conn=None):
+    """1 lượt của bộ lập lịch: đưa nhắc đến hạn vào outbox rồi xả outbox, trả về số email gửi thành công"""
+    own_conn = conn is None
+    conn = conn or open_worker_connection()
+    try:
+        queued = enqueue_due_reminders(conn)
+        count = 0
+        while True:
+            sent_batch = drain_email_outbox(conn)
+            count += sent_batch
+            if sent_batch < REMINDER_BATCH_SIZE: break
+        prune_email_outbox(conn)
+        notify_table_write('email_outbox')
+        if queued or count: notify_table_write('payment_reminders')
+    finally:
+        if own_conn: conn.close()
     return count
 
+def get_outbox_stats():
+    """Độ dài hàng đợi theo trạng thái + thời điểm email chờ lâu nhất"""
+    counts = {r['status']: r['n'] for r in run_query("SELECT status, COUNT(*) AS n FROM email_outbox GROUP BY status")}
+    oldest = run_query("SELECT MIN(created_at) AS t FROM email_outbox WHERE status IN ('queued', 'sending')", fetch_one=True)
+    return counts, (oldest['t'] if oldest else None)
+
+def run_reminder_worker(state):
+    """Vòng lặp của thread nền: quét mỗi REMINDER_POLL_SECONDS hoặc ngay khi state['wake'] được bật"""
+    conn = open_worker_connection()
+    while not state['stop'].is_set():
+        try:
+            sync_derived_columns(conn)  # dòng do chương trình khác ghi thẳng vào DB
+            state['sent'] += check_and_send_due_reminders(conn)
+            state['last_error'] = None
+        except Exception as e:
+            state['last_error'] = str(e)
+            print(f"Lỗi lập lịch nhắc hẹn: {e}")
+        state['last_run'] = datetime.now()
+        state['wake'].wait(REMINDER_POLL_SECONDS)
+        state['wake'].clear()
+    conn.close()
+
+def wake_reminder_scheduler():
+    """Đánh thức thread nền quét ngay (không chờ hết REMINDER_POLL_SECONDS)"""
+    try: start_reminder_scheduler()['wake'].set()
+    except: pass
+
+@st.cache_resource
+def start_reminder_scheduler():
+    """Khởi động 1 thread nền duy nhất cho mỗi tiến trình (tắt bằng biến môi trường REMINDER_SCHEDULER=0)"""
+    state = {'stop': threading.Event(), 'wake': threading.Event(), 'sent': 0, 'last_run': None, 'last_error': None,
+             'enabled': os.environ.get('REMINDER_SCHEDULER', '1') != '0'}
+    if state['enabled']:
+        state['thread'] = threading.Thread(target=run_reminder_worker, args=(state,), name="reminder-scheduler", daemon=True)
+        state['thread'].start()
+    return state
+
 # --- HÀM HỖ TRỢ LỊCH ÂM/DƯƠNG ---
+# [NEW] Bảng tra Âm/Dương dựng sẵn cho LUNAR_TABLE_START_YEAR..LUNAR_TABLE_END_YEAR (nạp lần đầu dùng, 1 lần/tiến trình).
+# Mỗi ngày dương = 1 số nguyên 32-bit: năm<<10 | tháng<<6 | nhuận<<5 | ngày âm -> tra bằng chỉ số (ordinal - ordinal đầu bảng).
+# Ngoài khoảng này vẫn tính bằng LunarDate, có LRU cache.
+LUNAR_TABLE_START_YEAR = int(os.environ.get("LUNAR_TABLE_START_YEAR", 1990))
+LUNAR_TABLE_END_YEAR = int(os.environ.get("LUNAR_TABLE_END_YEAR", 2050))
+
+def _pack_lunar(year, month, day, is_leap):
+    return (year << 10) | (month << 6) | (int(bool(is_leap)) << 5) | day
+
+def _unpack_lunar(v):
+    return v >> 10, (v >> 6) & 0xF, v & 0x1F, bool((v >> 5) & 1)
+
+def _lunar_months(year):
+    """Các tháng âm của 1 năm theo thứ tự (tháng, nhuận) kèm ordinal ngày mùng 1"""
+    months = []
+    for m in range(1, 13):
+        months.append((m, False, LunarDate(year, m, 1, False).toSolarDate().toordinal()))
+        try: months.append((m, True, LunarDate(year, m, 1, True).toSolarDate().toordinal()))
+        except ValueError: pass
+    return months
+
+@st.cache_resource(show_spinner=False)
+def get_lunar_table(start_year=LUNAR_TABLE_START_YEAR, end_year=LUNAR_TABLE_END_YEAR):
+    """Bảng tra dựng từ ~13 lần gọi LunarDate mỗi năm (đầu tháng âm), không gọi cho từng ngày"""
+    starts = []
+    for y in range(start_year - 1, end_year + 2):  # thêm 1 năm 2 đầu để phủ trọn năm dương đầu/cuối
+        try: starts.extend((ordinal, _pack_lunar(y, m, 0, leap)) for m, leap, ordinal in _lunar_months(y))
+        except ValueError: pass  # ngoài phạm vi thư viện lunardate
+    first = datetime(start_year, 1, 1).toordinal()
+    last = datetime(end_year, 12, 31).toordinal()
+    solar = array('I', bytes(4 * (last - first + 1)))
+    month_keys, month_starts, month_lengths = array('I'), array('I'), array('H')
+    for (ordinal, key), (next_ordinal, _) in zip(starts, starts[1:]):
+        month_keys.append(key); month_starts.append(ordinal); month_lengths.append(next_ordinal - ordinal)
+        for o in range(max(ordinal, first), min(next_ordinal, last + 1)):
+            solar[o - first] = key + (o - ordinal + 1)
+    return {'first': first, 'solar': solar, 'month_keys': month_keys, 'month_starts': month_starts,
+            'month_lengths': month_lengths, 'month_index': {k: i for i, k in enumerate(month_keys)}}
+
+@functools.lru_cache(maxsize=4096)
+def _solar_to_lunar_lru(ordinal):
+    d = datetime.fromordinal(ordinal)
+    ld = LunarDate.fromSolarDate(d.year, d.month, d.day)
+    return ld.year, ld.month, ld.day, bool(ld.isLeapMonth)
+
+def solar_to_lunar_tuple(solar_date):
+    """(năm, tháng, ngày, nhuận) âm lịch của 1 ngày dương (date/datetime/Timestamp)"""
+    ordinal = solar_date.toordinal()
+    table = get_lunar_table()
+    idx = ordinal - table['first']
+    if 0 <= idx < len(table['solar']) and table['solar'][idx]:
+        return _unpack_lunar(table['solar'][idx])
+    return _solar_to_lunar_lru(ordinal)
+
+def _format_lunar(lunar, suffix=" (Âm lịch)"):
+    year, month, day, _ = lunar
+    return f"{day:02d}/{month:02d}/{year}{suffix}"
+
 def convert_solar_to_lunar(solar_date):
     """Chuyển Dương lịch -> Âm lịch"""
     try:
-        ld = LunarDate.fromSolarDate(solar_date.year, solar_date.month, solar_date.day)
-        return f"{ld.day:02d}/{ld.month:02d}/{ld.year} (Âm lịch)"
+        return _format_lunar(solar_to_lunar_tuple(solar_date))
     except:
         return "Không xác định"
 
+def convert_solar_to_lunar_batch(dates, suffix=" (Âm lịch)"):
+    """[NEW] Chuyển cả 1 cột ngày dương -> chuỗi âm lịch (list hoặc pd.Series; mỗi ngày khác nhau chỉ tra 1 lần)"""
+    is_series = isinstance(dates, pd.Series)
+    values = pd.to_datetime(dates, errors='coerce') if is_series else list(dates)
+    memo = {}
+    out = []
+    for d in values:
+        if d is None or pd.isna(d):
+            out.append(None); continue
+        key = d.toordinal()
+        if key not in memo:
+            try: memo[key] = _format_lunar(solar_to_lunar_tuple(d), suffix)
+            except: memo[key] = "Không xác định"
+        out.append(memo[key])
+    return pd.Series(out, index=dates.index) if is_series else out
+
 def convert_lunar_to_solar(day, month, year, is_leap=False):
     """Chuyển Âm lịch -> Dương lịch"""
+    table = get_lunar_table()
+    i = table['month_index'].get(_pack_lunar(year, month, 0, is_leap))
+    if i is not None:
+        if not 1 <= day <= table['month_lengths'][i]: return None
+        return datetime.fromordinal(table['month_starts'][i] + day - 1).date()
     try:
         sd = LunarDate(year, month, day, is_leap).toSolarDate()
         return sd # Trả về object date
@@ -919,6 +2023,450 @@ def get_tour_financials(tour_id, tour_info):
         cost = est_cost
 
     return revenue, cost
+
+# Giá trị hợp đồng tour (alias t): giá chốt * SL (SL = 0 -> số khách) + giá trẻ em * SL trẻ em
+TOUR_CONTRACT_SQL = "(COALESCE(t.final_tour_price, 0) * COALESCE(NULLIF(t.final_qty, 0), t.guest_count, 1) + COALESCE(t.child_price, 0) * COALESCE(t.child_qty, 0))"
+
+# --- [NEW] SỔ CÔNG NỢ (debt_ledger) ---
+def get_paid_amounts():
+    """{ref_code: đã thu thực tế (THU - CHI)} đọc từ sổ công nợ"""
+    rows = run_query("SELECT ref_code, paid_in - refund AS paid FROM debt_ledger")
+    return {r['ref_code']: r['paid'] or 0.0 for r in rows}
+
+def get_ref_balance(ref_code):
+    """(tổng THU, tổng CHI) của 1 mã Tour/Booking"""
+    row = run_query("SELECT paid_in, refund FROM debt_ledger WHERE ref_code=?", (ref_code,), fetch_one=True)
+    if not row: return 0.0, 0.0
+    return row['paid_in'] or 0.0, row['refund'] or 0.0
+
+DEBT_AGING_BUCKETS = ["0-30 ngày", "31-60 ngày", "Trên 60 ngày"]
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_debt_ledger(role, username):
+    """Giá trị HĐ / đã thu / còn lại / tuổi nợ của mọi Tour & Booking chưa xóa (1 truy vấn JOIN sổ công nợ)"""
+    tour_filter = " AND t.sale_name=?" if role == 'sale' and username else ""
+    bk_filter = " AND b.sale_name=?" if role == 'sale' and username else ""
+    params = (username, username) if role == 'sale' and username else ()
+    rows = run_query(f"""
+        SELECT 'Tour' AS type, 0 AS kind, t.id AS id, t.tour_code AS ref_code, t.tour_name AS ref_name,
+               t.customer_name AS customer_name, t.start_date AS ref_date,
+               {TOUR_CONTRACT_SQL} AS contract_value,
+               COALESCE(l.paid_in - l.refund, 0) AS paid
+        FROM tours t LEFT JOIN debt_ledger l ON l.ref_code = t.tour_code
+        WHERE COALESCE(t.status, 'running') NOT IN ('deleted'){tour_filter}
+        UNION ALL
+        SELECT 'Booking', 1, b.id, b.code, b.name, b.customer_info, b.created_at,
+               COALESCE(b.selling_price, 0),
+               COALESCE(l.paid_in - l.refund, 0)
+        FROM service_bookings b LEFT JOIN debt_ledger l ON l.ref_code = b.code
+        WHERE COALESCE(b.status, 'active') NOT IN ('deleted'){bk_filter}
+        ORDER BY kind, id
+    """, params)
+    cols = ['type', 'kind', 'id', 'ref_code', 'ref_name', 'customer_name', 'ref_date', 'contract_value', 'paid']
+    df = pd.DataFrame([dict(r) for r in rows], columns=cols)
+    df['contract_value'] = pd.to_numeric(df['contract_value'], errors='coerce').fillna(0)
+    df['paid'] = pd.to_numeric(df['paid'], errors='coerce').fillna(0)
+    df['remaining'] = df['contract_value'] - df['paid']
+
+    # Booking lưu "Tên - SĐT" -> chỉ lấy tên
+    is_bk = df['type'] == 'Booking'
+    df.loc[is_bk, 'customer_name'] = df.loc[is_bk, 'customer_name'].fillna('N/A').astype(str).str.split(' - ').str[0]
+
+    # Tuổi nợ tính từ ngày đi (Tour, dd/mm/yyyy) hoặc ngày tạo (Booking, yyyy-mm-dd)
+    ref_dt = pd.to_datetime(df['ref_date'].where(~is_bk), format='%d/%m/%Y', errors='coerce')
+    ref_dt = ref_dt.fillna(pd.to_datetime(df['ref_date'].where(is_bk).astype(str).str[:10], format='%Y-%m-%d', errors='coerce'))
+    df['age_days'] = (pd.Timestamp.now().normalize() - ref_dt).dt.days.clip(lower=0).fillna(0).astype(int)
+    df['aging'] = pd.cut(df['age_days'], bins=[-1, 30, 60, float('inf')], labels=DEBT_AGING_BUCKETS).astype(str)
+    return df.drop(columns=['kind'])
+
+def get_open_debts(role, username):
+    """Chỉ các mã còn phải thu (giá trị HĐ > 0 và còn lại > 0.1)"""
+    df = get_debt_ledger(role, username)
+    return df[(df['contract_value'] > 0) & (df['remaining'] > 0.1)]
+
+register_table_write_hook(['transaction_history', 'tours', 'service_bookings'], get_debt_ledger.clear)
+register_table_write_hook(list(DERIVED_SOURCE_COLUMNS), sync_derived_columns)
+
+# --- [NEW] TÌM KIẾM GỢI Ý (TYPEAHEAD) PHÍA SERVER: chỉ trả về TOP N kết quả thay vì cả bảng ---
+TYPEAHEAD_LIMIT = 20
+
+def _typeahead_patterns(term):
+    """(mẫu tiền tố, mẫu chứa) không dấu cho LIKE; bỏ ký tự đại diện do người dùng gõ"""
+    term = fold_vn(re.sub(r"[%_]", "", str(term or "")).strip())
+    return term + "%", "%" + term + "%"
+
+def search_customers(term, sale_name=None, limit=TYPEAHEAD_LIMIT):
+    """Khách hàng khớp tên (không dấu)/SĐT: ưu tiên khớp đầu chuỗi (dùng index NOCASE), thiếu thì bổ sung khớp giữa chuỗi.
+    Ô tìm trống -> N khách mới nhất. Trả về list (name, phone)."""
+    owner_sql, owner_params = (" AND sale_name=?", (sale_name,)) if sale_name else ("", ())
+    prefix, contains = _typeahead_patterns(term)
+    if prefix == "%":
+        rows = run_query(f"SELECT name, phone FROM customers WHERE 1=1{owner_sql} ORDER BY id DESC LIMIT ?", owner_params + (limit,), cache=True)
+        return [(r['name'], r['phone']) for r in rows]
+    rows = run_query(f"""SELECT name, phone FROM customers WHERE (name_fold LIKE ? OR phone LIKE ?){owner_sql}
+                         ORDER BY name_fold LIMIT ?""", (prefix, prefix) + owner_params + (limit,), cache=True)
+    results = [(r['name'], r['phone']) for r in rows]
+    if len(results) < limit:
+        more = run_query(f"""SELECT name, phone FROM customers WHERE (name_fold LIKE ? OR phone LIKE ?) AND NOT (name_fold LIKE ? OR phone LIKE ?){owner_sql}
+                             ORDER BY id DESC LIMIT ?""", (contains, contains, prefix, prefix) + owner_params + (limit - len(results),), cache=True)
+        results += [(r['name'], r['phone']) for r in more]
+    return results
+
+def search_open_refs(term, sale_name=None, limit=TYPEAHEAD_LIMIT):
+    """Tour đang chạy + Booking đang hoạt động khớp mã/tên. Trả về list (loại 'TOUR'/'BOOK', mã, tên)."""
+    owner_sql, owner_params = (" AND sale_name=?", (sale_name,)) if sale_name else ("", ())
+    prefix, contains = _typeahead_patterns(term)
+    pattern = contains if prefix != "%" else "%"
+    rows = run_query(f"""
+        SELECT kind, code, name FROM (
+            SELECT 'TOUR' AS kind, tour_code AS code, tour_name AS name, id FROM tours
+            WHERE status='running' AND (tour_code LIKE ? OR tour_name_fold LIKE ?){owner_sql}
+            UNION ALL
+            SELECT 'BOOK', code, name, id FROM service_bookings
+            WHERE status='active' AND (code LIKE ? OR name_fold LIKE ?){owner_sql}
+        ) ORDER BY (code LIKE ?) DESC, id DESC LIMIT ?
+    """, (pattern, pattern) + owner_params + (pattern, pattern) + owner_params + (prefix, limit), cache=True)
+    return [(r['kind'], r['code'], r['name']) for r in rows]
+
+# --- [NEW] TRA CỨU TOÀN VĂN: FTS5 trigram (search_fts), thiếu FTS hoặc từ khóa < 3 ký tự thì dùng LIKE ---
+SEARCH_GROUP_LIMIT = 50
+SEARCH_POOL_SIZE = 4
+SEARCH_SNIPPET_COLUMNS = {
+    'tours': ['tour_name', 'tour_code', 'sale_name'],
+    'customers': ['name', 'phone', 'email'],
+    'invoices': ['memo', 'seller_name', 'invoice_number', 'cost_code'],
+    'service_bookings': ['name', 'code', 'customer_info'],
+    'transaction_history': ['ref_code', 'payer_name', 'note'],
+    'tour_guests': ['name', 'cccd', 'hometown'],
+    'flight_tickets': ['ticket_code', 'passenger_names', 'route'],
+}
+# Điều kiện "thuộc về sale" cho từng nhóm (None = không giới hạn, như Hóa đơn trước đây)
+SEARCH_OWNER_FILTERS = {
+    'tours': ("t.sale_name=?", 1),
+    'customers': ("t.sale_name=?", 1),
+    'service_bookings': ("t.sale_name=?", 1),
+    'invoices': None,
+    'transaction_history': ("t.ref_code IN (SELECT tour_code FROM tours WHERE sale_name=? UNION SELECT code FROM service_bookings WHERE sale_name=?)", 2),
+    'tour_guests': ("t.tour_id IN (SELECT id FROM tours WHERE sale_name=?)", 1),
+    'flight_tickets': None,
+}
+SEARCH_EXTRA_COLUMNS = {
+    'tour_guests': ", (SELECT tour_code || ' - ' || tour_name FROM tours WHERE tours.id = t.tour_id) AS tour_label",
+}
+
+def search_fts_available():
+    return bool(run_query("SELECT 1 FROM sqlite_master WHERE name='search_fts'", fetch_one=True))
+
+@st.cache_resource
+def get_read_pool(size=SEARCH_POOL_SIZE):
+    """[NEW] Hàng đợi các kết nối SQLite chỉ-đọc để chạy song song các truy vấn tìm kiếm"""
+    pool = queue.Queue()
+    for _ in range(size):
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only = ON")
+        pool.put(conn)
+    return pool
+
+@contextlib.contextmanager
+def pooled_read_connection():
+    pool = get_read_pool()
+    conn = pool.get()
+    try: yield conn
+    finally: pool.put(conn)
+
+def fts_match_condition(table, term):
+    """Điều kiện WHERE tìm không dấu cho 1 bảng: >= 3 ký tự dùng search_fts (trigram), ngắn hơn thì LIKE tiền tố trên *_fold"""
+    term_fold = fold_vn(str(term or "").strip())
+    kind = SEARCH_FTS_SOURCES[table][0]
+    if len(term_fold) >= 3 and search_fts_available():
+        return (f"id IN (SELECT rowid / 8 FROM search_fts WHERE search_fts MATCH ? AND rowid % 8 = {kind})",
+                ['folded : "' + term_fold.replace('"', '""') + '"'])
+    term_fold = re.sub(r"[%_]", "", term_fold)
+    col = FOLD_COLUMNS[table][0] + "_fold"
+    return f"({col} LIKE ? OR {SEARCH_SNIPPET_COLUMNS[table][1]} LIKE ?)", [term_fold + "%", term_fold + "%"]
+
+def highlight_folded(texts, term, width=30):
+    """Đoạn trích quanh vị trí khớp (so khớp không dấu), tô đậm phần khớp trên chữ gốc có dấu"""
+    needle = fold_vn(term)
+    for text in texts:
+        if not text: continue
+        text = str(text)
+        folded, index_map = "", []
+        for i, ch in enumerate(text):
+            f = fold_vn(ch)
+            folded += f
+            index_map += [i] * len(f)
+        pos = folded.find(needle)
+        if pos < 0 or not needle: continue
+        start, end = index_map[pos], index_map[pos + len(needle) - 1] + 1
+        left, right = max(0, start - width), min(len(text), end + width)
+        return ("…" if left > 0 else "") + text[left:start] + "**" + text[start:end] + "**" + text[end:right] + ("…" if right < len(text) else "")
+    return ""
+
+def search_group(conn, table, term, sale_name=None, use_fts=True, limit=SEARCH_GROUP_LIMIT):
+    """Tìm trong 1 nhóm (không phân biệt dấu) trên kết nối conn -> [(row, snippet)] xếp theo độ liên quan, tối đa limit.
+    Không gọi st.* để chạy được trong luồng phụ."""
+    term_fold = fold_vn(str(term or "").strip())
+    if not term_fold: return []
+    owner_sql, owner_params = "", ()
+    owner = SEARCH_OWNER_FILTERS.get(table)
+    if sale_name and owner:
+        owner_sql, owner_params = " AND " + owner[0], (sale_name,) * owner[1]
+    extra = SEARCH_EXTRA_COLUMNS.get(table, "")
+
+    if use_fts and len(term_fold) >= 3:
+        kind = SEARCH_FTS_SOURCES[table][0]
+        rows = conn.execute(f"""
+            SELECT t.*{extra} FROM search_fts f JOIN {table} t ON t.id = f.rowid / 8
+            WHERE search_fts MATCH ? AND f.rowid % 8 = {kind}{owner_sql}
+            ORDER BY f.rank LIMIT ?
+        """, ('folded : "' + term_fold.replace('"', '""') + '"',) + owner_params + (limit,)).fetchall()
+    else:
+        like = f"%{term_fold}%"
+        code_col = SEARCH_FTS_SOURCES[table][1].replace("{R}.", "t.")
+        match_cols = [code_col] + [f"t.{col}_fold" for col in FOLD_COLUMNS[table]]
+        if table == 'customers': match_cols.append("t.phone")
+        if table == 'tour_guests': match_cols.append("t.cccd")
+        rows = conn.execute(f"""
+            SELECT t.*{extra} FROM {table} t
+            WHERE ({' OR '.join(c + ' LIKE ?' for c in match_cols)}){owner_sql}
+            ORDER BY t.id DESC LIMIT ?
+        """, (like,) * len(match_cols) + owner_params + (limit,)).fetchall()
+    return [(r, highlight_folded([r[c] for c in SEARCH_SNIPPET_COLUMNS[table]], term)) for r in rows]
+
+def iter_search_groups(term, sale_name=None, tables=None, limit=SEARCH_GROUP_LIMIT):
+    """Chạy song song truy vấn của từng nhóm trên các kết nối đọc trong pool; trả về (bảng, kết quả) theo thứ tự xong trước."""
+    tables = list(tables or SEARCH_FTS_SOURCES.keys())
+    use_fts = search_fts_available()
+
+    def _run(table):
+        with pooled_read_connection() as conn:
+            return search_group(conn, table, term, sale_name, use_fts, limit)
+
+    with ThreadPoolExecutor(max_workers=SEARCH_POOL_SIZE) as executor:
+        futures = {executor.submit(_run, tbl): tbl for tbl in tables}
+        for fut in as_completed(futures):
+            try: yield futures[fut], fut.result()
+            except Exception as e:
+                print(f"Lỗi tìm kiếm nhóm {futures[fut]}: {e}")
+                yield futures[fut], []
+
+def get_tour_item_totals(tour_ids=None):
+    """Tổng EST/ACT của tất cả tour (hoặc chỉ các tour_ids) trong 1 truy vấn GROUP BY -> DataFrame (tour_id, est_cost, act_cost)"""
+    where, params = "", ()
+    if tour_ids is not None:
+        if not tour_ids: return pd.DataFrame(columns=['tour_id', 'est_cost', 'act_cost'])
+        where, params = f" WHERE tour_id IN ({','.join('?' * len(tour_ids))})", tuple(tour_ids)
+    rows = run_query(f"""
+        SELECT tour_id,
+               SUM(CASE WHEN item_type='EST' THEN total_amount ELSE 0 END) AS est_cost,
+               SUM(CASE WHEN item_type='ACT' THEN total_amount ELSE 0 END) AS act_cost
+        FROM tour_items{where} GROUP BY tour_id
+    """, params)
+    df = pd.DataFrame([dict(r) for r in rows], columns=['tour_id', 'est_cost', 'act_cost'])
+    df['tour_id'] = pd.to_numeric(df['tour_id'], errors='coerce')
+    return df
+
+def compute_tour_profit_frame(tours_df, totals_df):
+    """Tính Doanh thu thuần / Chi phí TT / Lợi nhuận TT cho toàn bộ tour theo cột (không lặp từng dòng)"""
+    df = tours_df.merge(totals_df, how='left', left_on='id', right_on='tour_id')
+    num = lambda col, default=0: pd.to_numeric(df[col], errors='coerce').fillna(default) if col in df.columns else pd.Series(default, index=df.index, dtype=float)
+    est_cost = num('est_cost')
+    act_cost = num('act_cost')
+    p_pct = num('est_profit_percent')
+    t_pct = num('est_tax_percent')
+    final_qty = num('final_qty')
+    final_qty = final_qty.where(final_qty != 0, num('guest_count', 1))
+
+    # Ưu tiên giá chốt tay, nếu chưa có thì tính từ dự toán
+    manual_revenue = num('final_tour_price') * final_qty + num('child_price') * num('child_qty')
+    est_revenue = (est_cost + est_cost * p_pct / 100) * (1 + t_pct / 100)
+    final_sale = manual_revenue.where(manual_revenue > 0, est_revenue)
+    tax_div = 1 + t_pct / 100
+    net_revenue = (final_sale / tax_div).where(tax_div != 0, final_sale)
+
+    df['Tên Đoàn'] = df['tour_name']
+    df['Sales'] = df['sale_name']
+    df['Ngày đi'] = df['start_date']
+    df['Doanh Thu Thuần'] = net_revenue
+    df['Chi Phí TT'] = act_cost
+    df['Lợi Nhuận TT'] = net_revenue - act_cost
+    return df.drop(columns=['tour_id', 'est_cost', 'act_cost'])
+
+def profit_margin_pct(profit, revenue):
+    """Tỷ suất LN (%) theo cột, doanh thu = 0 -> 0"""
+    return (profit / revenue * 100).where(revenue != 0, 0)
+
+# --- [NEW] KHỐI BÁO CÁO TÀI CHÍNH (report_cube: hạng mục x mã x tháng) ---
+# Trigger ghi các mã bị ảnh hưởng vào report_cube_dirty, refresh_report_cube() chỉ tính lại các mã đó.
+REPORT_SHARED_CATEGORIES = ('Dự án (cũ)', 'Chi phí chung') # Không lọc theo sale
+
+def _report_month_key(date_str):
+    """Chuỗi ngày (dd/mm/yyyy, yyyy-mm-dd...) -> 'YYYY-MM', không đọc được -> None"""
+    raw = str(date_str or '').strip().split(' ')[0]
+    if not raw: return None
+    for fmt in ('%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y', '%Y/%m/%d', '%d/%m/%y'):
+        try: return datetime.strptime(raw, fmt).strftime('%Y-%m')
+        except ValueError: pass
+    try: return pd.to_datetime(raw, dayfirst=True).strftime('%Y-%m')
+    except: return None
+
+def _report_in_clause(column, values):
+    return f"{column} IN ({','.join(['?'] * len(values))})", tuple(values)
+
+def _compute_report_rows(category, codes):
+    """Tính lại các dòng (mã, tháng) cho 1 hạng mục. codes=None -> toàn bộ."""
+    rows = []
+    for i in range(0, max(len(codes or []), 1), 500):
+        chunk = None if codes is None else codes[i:i + 500]
+        if category == 'Tour':
+            where, params = _report_in_clause("t.tour_code", chunk) if chunk else ("1=1", ())
+            for r in run_query(f"""
+                SELECT t.tour_code AS code, t.tour_name AS name, t.start_date AS date_str, t.status, t.sale_name,
+                       {TOUR_CONTRACT_SQL} AS thu,
+                       COALESCE((SELECT SUM(total_amount) FROM tour_items WHERE tour_id=t.id AND item_type='ACT'), 0)
+                         + COALESCE((SELECT SUM(total_amount) FROM invoices WHERE cost_code=t.tour_code AND status='active' AND type='IN' AND invoice_number NOT LIKE '%UNC%'), 0) AS act_cost,
+                       COALESCE((SELECT SUM(total_amount) FROM tour_items WHERE tour_id=t.id AND item_type='EST'), 0) AS est_cost
+                FROM tours t WHERE t.status != 'deleted' AND {where}""", params):
+                # Chưa quyết toán -> dùng tạm chi phí dự toán (giống get_tour_financials)
+                chi = r['act_cost'] if r['act_cost'] != 0 else r['est_cost']
+                rows.append((r['code'], r['name'], r['date_str'], r['status'], r['sale_name'], max(r['thu'], 0), max(chi, 0)))
+        elif category == 'Booking Dịch Vụ':
+            where, params = _report_in_clause("b.code", chunk) if chunk else ("1=1", ())
+            for r in run_query(f"""
+                SELECT b.code, b.name, b.created_at AS date_str, b.status, b.sale_name,
+                       COALESCE(b.selling_price, 0) AS thu, COALESCE(b.net_price, 0) AS net_price,
+                       COALESCE((SELECT SUM(total_amount) FROM invoices WHERE cost_code=b.code AND status='active' AND request_edit=0 AND type='IN' AND COALESCE(invoice_number, '') NOT LIKE '%UNC%'), 0) AS inv_cost
+                FROM service_bookings b WHERE b.status != 'deleted' AND {where}""", params):
+                # Chỉ tính chi phí từ hóa đơn (không tính UNC), chưa có hóa đơn -> giá net
+                chi = r['inv_cost'] if r['inv_cost'] != 0 else r['net_price']
+                rows.append((r['code'], r['name'], r['date_str'], r['status'], r['sale_name'], max(r['thu'], 0), max(chi, 0)))
+        elif category == 'Dự án (cũ)':
+            ids = [c[5:] for c in chunk] if chunk else None
+            where, params = _report_in_clause("p.id", ids) if ids else ("1=1", ())
+            for r in run_query(f"""
+                SELECT 'PROJ_' || p.id AS code, p.project_name AS name, i.date AS date_str, i.type, i.total_amount
+                FROM projects p JOIN project_links l ON p.id = l.project_id JOIN invoices i ON l.invoice_id = i.id
+                WHERE i.status = 'active' AND i.request_edit = 0 AND {where}""", params):
+                amt = r['total_amount'] or 0
+                rows.append((r['code'], r['name'], r['date_str'], None, None, amt if r['type'] == 'OUT' else 0, 0 if r['type'] == 'OUT' else amt))
+        elif category == 'Chi phí chung':
+            ids = [c[4:] for c in chunk] if chunk else None
+            where, params = _report_in_clause("i.id", ids) if ids else ("1=1", ())
+            for r in run_query(f"""
+                SELECT 'INV_' || i.id AS code, COALESCE(NULLIF(i.memo, ''), NULLIF(i.seller_name, ''), 'Chi phí chung') AS name,
+                       i.date AS date_str, i.type, i.total_amount
+                FROM invoices i
+                WHERE i.status = 'active' AND i.request_edit = 0 AND (i.cost_code IS NULL OR i.cost_code = '')
+                  AND NOT EXISTS (SELECT 1 FROM project_links pl WHERE pl.invoice_id = i.id) AND {where}""", params):
+                amt = r['total_amount'] or 0
+                rows.append((r['code'], r['name'], r['date_str'], None, None, amt if r['type'] == 'OUT' else 0, 0 if r['type'] == 'OUT' else amt))
+        if codes is None: break
+
+    # Gộp theo (mã, tháng)
+    cube = {}
+    for code, name, date_str, status, sale_name, thu, chi in rows:
+        month = _report_month_key(date_str)
+        if month is None or code is None or (thu == 0 and chi == 0): continue
+        key = (code, month)
+        if key not in cube: cube[key] = [category, code, month, name, status or 'N/A', sale_name, 0.0, 0.0]
+        try: cube[key][6] += float(thu or 0)
+        except (TypeError, ValueError): pass
+        try: cube[key][7] += float(chi or 0)
+        except (TypeError, ValueError): pass
+    return list(cube.values())
+
+def refresh_report_cube():
+    """Tính lại các mã đang chờ trong report_cube_dirty. Trả về số mã đã xử lý."""
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        max_id = c.execute("SELECT MAX(rowid) FROM report_cube_dirty").fetchone()[0]
+        if max_id is None: return 0
+        dirty = c.execute("SELECT DISTINCT category, code FROM report_cube_dirty WHERE rowid <= ? AND code IS NOT NULL", (max_id,)).fetchall()
+        full = any(r[0] == '*' for r in dirty)
+        by_cat = {}
+        if not full:
+            for cat, code in dirty: by_cat.setdefault(cat, []).append(code)
+        new_rows = []
+        for cat in ['Tour', 'Booking Dịch Vụ', 'Dự án (cũ)', 'Chi phí chung']:
+            if full or cat in by_cat:
+                new_rows += _compute_report_rows(cat, None if full else by_cat[cat])
+        if full:
+            c.execute("DELETE FROM report_cube")
+        else:
+            c.executemany("DELETE FROM report_cube WHERE category=? AND code=?", [(cat, code) for cat, code in dirty])
+        c.executemany("INSERT OR REPLACE INTO report_cube (category, code, month, name, status, sale_name, thu, chi) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", new_rows)
+        c.execute("DELETE FROM report_cube_dirty WHERE rowid <= ?", (max_id,))
+        conn.commit()
+        notify_table_write('report_cube')
+        return len(dirty)
+    except Exception as e:
+        conn.rollback()
+        print(f"Lỗi cập nhật report_cube: {e}")
+        return 0
+
+def _report_cube_filter(role, username, period_type=None, period=None, statuses=None):
+    clauses, params = [], []
+    if role == 'sale' and username:
+        clauses.append(f"(sale_name=? OR category IN ({','.join(['?'] * len(REPORT_SHARED_CATEGORIES))}))")
+        params += [username, *REPORT_SHARED_CATEGORIES]
+    if period and period != "Tất cả":
+        if period_type == "Tháng":
+            clauses.append("month=?"); params.append(period)
+        elif period_type == "Quý":
+            q, y = period[1:].split('/')
+            clauses.append("month IN (?, ?, ?)"); params += [f"{y}-{m:02d}" for m in range(int(q) * 3 - 2, int(q) * 3 + 1)]
+        elif period_type == "Năm":
+            clauses.append("month LIKE ?"); params.append(f"{period}-%")
+    if statuses:
+        clauses.append(f"(status IN ({','.join(['?'] * len(statuses))}) OR status='N/A')"); params += list(statuses)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", tuple(params)
+
+def get_report_periods(role, username):
+    """Danh sách kỳ (tháng / quý / năm) có dữ liệu, mới nhất trước"""
+    where, params = _report_cube_filter(role, username)
+    months = sorted({r['month'] for r in run_query(f"SELECT DISTINCT month FROM report_cube{where}", params)}, reverse=True)
+    ym = [(int(m[:4]), int(m[5:7])) for m in months]
+    quarters = sorted({(y, (m - 1) // 3 + 1) for y, m in ym}, reverse=True)
+    return {
+        "Tháng": months,
+        "Quý": [f"Q{q}/{y}" for y, q in quarters],
+        "Năm": sorted({y for y, _ in ym}, reverse=True),
+    }
+
+def get_report_category_totals(role, username, period_type, period, statuses):
+    where, params = _report_cube_filter(role, username, period_type, period, statuses)
+    rows = run_query(f"SELECT category, SUM(thu) AS thu, SUM(chi) AS chi FROM report_cube{where} GROUP BY category", params)
+    df = pd.DataFrame([dict(r) for r in rows], columns=['category', 'thu', 'chi'])
+    df['lợi nhuận'] = df['thu'] - df['chi']
+    return df.sort_values('lợi nhuận', ascending=False)
+
+REPORT_CARD_PAGE_SIZE = 20
+REPORT_DETAIL_SORTS = {
+    "Lợi nhuận cao nhất": '"lợi nhuận" DESC',
+    "Lỗ nhiều nhất": '"lợi nhuận" ASC',
+    "Doanh thu cao nhất": "thu DESC",
+    "Chi phí cao nhất": "chi DESC",
+    "Mã (A-Z)": "code ASC",
+}
+
+def get_report_details(role, username, period_type, period, statuses, category, sort_label=None, limit=None):
+    """Chi tiết từng mã trong 1 hạng mục - chỉ gọi khi người dùng mở xem. Sắp xếp & cắt trang ngay trong SQL.
+    Trả về (DataFrame, tổng số mã)."""
+    where, params = _report_cube_filter(role, username, period_type, period, statuses)
+    where = (where + " AND" if where else " WHERE") + " category=?"
+    params = params + (category,)
+    order_by = REPORT_DETAIL_SORTS.get(sort_label, '"lợi nhuận" DESC')
+    limit_sql = f" LIMIT {int(limit)}" if limit else ""
+    rows = run_query(f"""
+        SELECT category, code, MAX(name) AS name, SUM(thu) AS thu, SUM(chi) AS chi, SUM(thu) - SUM(chi) AS "lợi nhuận"
+        FROM report_cube{where} GROUP BY code ORDER BY {order_by}, code{limit_sql}
+    """, params)
+    total = run_query(f"SELECT COUNT(DISTINCT code) AS n FROM report_cube{where}", params, fetch_one=True)
+    df = pd.DataFrame([dict(r) for r in rows], columns=['category', 'code', 'name', 'thu', 'chi', 'lợi nhuận'])
+    return df, (total['n'] if total else len(df))
 # ==========================================
 # 3. CSS & GIAO DIỆN HIỆN ĐẠI
 # ==========================================
@@ -1078,20 +2626,40 @@ div[data-testid="stDataEditor"] {
 }
 </style>""", unsafe_allow_html=True)
 
-def convert_image_to_pdf(image_file):
+IMAGE_PDF_TARGET_DPI = 200        # đủ nét cho hóa đơn/UNC chụp, PDF nhẹ hơn nhiều so với ảnh gốc 12MP
+IMAGE_PDF_MAX_PAGE = (595, 842)   # ảnh không có DPI mà lớn hơn A4 (point) -> đặt vừa khổ A4
+
+def convert_image_to_pdf(image_files, target_dpi=None, jpeg_quality=85):
+    """Chuyển 1 ảnh hoặc danh sách ảnh thành PDF (mỗi ảnh 1 trang), xử lý hoàn toàn trong bộ nhớ.
+    target_dpi: số pixel trên mỗi inch của trang vượt quá mức này thì thu nhỏ ảnh (giữ nguyên khổ giấy) để PDF nhẹ hơn."""
+    if not isinstance(image_files, (list, tuple)): image_files = [image_files]
     try:
-        img = Image.open(image_file)
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        img_width, img_height = img.size
         pdf_buffer = io.BytesIO()
-        c = canvas.Canvas(pdf_buffer, pagesize=(img_width, img_height))
-        temp_img_path = f"temp_img_{int(time.time())}.jpg"
-        img.save(temp_img_path)
-        c.drawImage(temp_img_path, 0, 0, img_width, img_height)
+        c = canvas.Canvas(pdf_buffer)
+        for image_file in image_files:
+            img = Image.open(image_file)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            src_dpi = float((img.info.get('dpi') or (0, 0))[0] or 0)
+            if src_dpi > 72:
+                # Khổ trang (point) theo kích thước thật của ảnh
+                page_w, page_h = img.width * 72 / src_dpi, img.height * 72 / src_dpi
+            else:
+                # Ảnh điện thoại thường không có DPI (hoặc ghi 72): 1 pixel = 1 point, ảnh lớn thì thu về vừa khổ A4
+                fit = min(1.0, min(IMAGE_PDF_MAX_PAGE) / min(img.size), max(IMAGE_PDF_MAX_PAGE) / max(img.size))
+                page_w, page_h = img.width * fit, img.height * fit
+            # Thu nhỏ theo số pixel thực tế trên trang, không theo DPI ghi trong file
+            if target_dpi and img.width * 72 / page_w > target_dpi:
+                scale = target_dpi * page_w / 72 / img.width
+                img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+            # Nén JPEG trong RAM -> ReportLab nhúng thẳng luồng DCT, không cần file tạm
+            jpg = io.BytesIO()
+            img.save(jpg, format='JPEG', quality=jpeg_quality)
+            jpg.seek(0)
+            c.setPageSize((page_w, page_h))
+            c.drawImage(ImageReader(jpg), 0, 0, page_w, page_h)
+            c.showPage()
         c.save()
-        if os.path.exists(temp_img_path): os.remove(temp_img_path)
-        pdf_buffer.seek(0)
         return pdf_buffer.getvalue()
     except Exception as e:
         return None
@@ -1359,12 +2927,127 @@ def extract_data_smart(file_obj, is_image, doc_type="Hóa đơn"):
     info["raw_text"] = text_content
     return info, msg
 
+# --- [NEW] DOCX TEMPLATE ENGINE ---
+# File mẫu đặt trong DOCX_TEMPLATE_FOLDER (handover.docx, voucher.docx, booking_cfm.docx).
+# Placeholder dạng {{ten_truong}}. Dòng bảng chứa {{danh_sach.truong}} (vd: {{guests.name}})
+# sẽ được nhân bản theo từng phần tử của danh sách. Không có file mẫu -> dựng Document như cũ.
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+_TPL_FIELD_RE = re.compile(r"\{\{\s*([\w\.]+)\s*\}\}")
+_TPL_LIST_RE = re.compile(r"\{\{\s*(\w+)\.")
+_TPL_PART_RE = re.compile(r"^word/(document|header\d*|footer\d*)\.xml$")
+
+@st.cache_resource(show_spinner=False)
+def _load_docx_template(path, mtime):
+    """Đọc & parse file mẫu 1 lần (cache theo đường dẫn + mtime, sửa file mẫu là tự nạp lại)"""
+    with zipfile.ZipFile(path) as zf:
+        entries = [(info, zf.read(info.filename)) for info in zf.infolist()]
+    parsed = {info.filename: etree.fromstring(data) for info, data in entries if _TPL_PART_RE.match(info.filename)}
+    return entries, parsed
+
+def _get_docx_template(name):
+    path = os.path.join(DOCX_TEMPLATE_FOLDER, name)
+    if not HAS_DOCX or not os.path.exists(path): return None
+    try:
+        return _load_docx_template(path, os.path.getmtime(path))
+    except Exception as e:
+        print(f"Lỗi đọc mẫu DOCX {name}: {e}")
+        return None
+
+def _fill_docx_paragraph(p, values):
+    # Gộp text các run (Word hay tách placeholder ra nhiều run) rồi thay thế vào run đầu
+    ts = [t for t in p.iter(W_NS + "t") if next(t.iterancestors(W_NS + "p"), None) is p]
+    if not ts: return
+    full = "".join(t.text or "" for t in ts)
+    if "{{" not in full: return
+    lines = _TPL_FIELD_RE.sub(lambda m: values.get(m.group(1), ""), full).split("\n")
+    ts[0].text = lines[0]
+    ts[0].set(XML_SPACE, "preserve")
+    for t in ts[1:]: t.text = ""
+    # Xuống dòng trong giá trị -> <w:br/>
+    run = ts[0].getparent()
+    idx = run.index(ts[0])
+    for line in lines[1:]:
+        br = etree.Element(W_NS + "br")
+        t = etree.Element(W_NS + "t")
+        t.text = line
+        t.set(XML_SPACE, "preserve")
+        run.insert(idx + 1, br)
+        run.insert(idx + 2, t)
+        idx += 2
+
+def _expand_docx_rows(root, lists):
+    for tr in list(root.iter(W_NS + "tr")):
+        m = _TPL_LIST_RE.search("".join(t.text or "" for t in tr.iter(W_NS + "t")))
+        if not m or m.group(1) not in lists: continue
+        key = m.group(1)
+        parent = tr.getparent()
+        pos = parent.index(tr)
+        for i, item in enumerate(lists[key]):
+            row = copy.deepcopy(tr)
+            vals = {f"{key}.stt": str(i + 1)}
+            vals.update({f"{key}.{k}": "" if v is None else str(v) for k, v in item.items()})
+            for p in row.iter(W_NS + "p"): _fill_docx_paragraph(p, vals)
+            parent.insert(pos + 1 + i, row)
+        parent.remove(tr)
+
+def render_docx_template(name, values, lists=None):
+    """Điền dữ liệu vào file mẫu đã cache. Trả về bytes .docx hoặc None nếu không có mẫu."""
+    tpl = _get_docx_template(name)
+    if tpl is None: return None
+    entries, parsed = tpl
+    values = {k: "" if v is None else str(v) for k, v in values.items()}
+    buffer = io.BytesIO()
+    try:
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+            for info, data in entries:
+                if info.filename in parsed:
+                    root = copy.deepcopy(parsed[info.filename])
+                    _expand_docx_rows(root, lists or {})
+                    for p in root.iter(W_NS + "p"): _fill_docx_paragraph(p, values)
+                    data = etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+                zf.writestr(info, data)
+    except Exception as e:
+        print(f"Lỗi điền mẫu DOCX {name}: {e}")
+        return None
+    return buffer.getvalue()
+
 def create_handover_docx(tour_info, guests, hotels, restaurants, sightseeings, checklist_str):
     if not HAS_DOCX: return None
     
     # Lấy thông tin công ty
     comp_data = get_company_data()
 
+    # [NEW] Ưu tiên file mẫu docx_templates/handover.docx nếu có
+    checked_items = checklist_str.split(',') if checklist_str else []
+    all_items = ["Chương trình đóng mộc", "Danh sách đóng mộc", "Bảo hiểm du lịch", "Thực đơn đóng mộc", "Vé máy bay", "Xác nhận khu du lịch/nhà hàng (Nếu có)", "Hợp đồng hướng dẫn"]
+    tpl_values = {
+        'company_name': comp_data['name'].upper(), 'company_address': comp_data['address'], 'company_phone': comp_data['phone'],
+        'tour_name': tour_info['tour_name'], 'tour_code': tour_info['tour_code'],
+        'start_date': tour_info['start_date'], 'end_date': tour_info['end_date'],
+        'guest_count': tour_info['guest_count'], 'sale_name': tour_info['sale_name'],
+        'customer': f"{tour_info.get('customer_name','')} - {tour_info.get('customer_phone','')}",
+        'export_time': datetime.now().strftime('%d/%m/%Y %H:%M'),
+    }
+    def _money_rows(items):
+        rows = []
+        for it in items or []:
+            it = dict(it)
+            total = float(it.get('total_amount', 0) or 0)
+            dep = float(it.get('deposit', 0) or 0)
+            it.update({'total': "{:,.0f}".format(total), 'deposit': "{:,.0f}".format(dep), 'remaining': "{:,.0f}".format(total - dep)})
+            rows.append(it)
+        return rows
+    tpl_lists = {
+        'guests': [dict(g) for g in guests or []],
+        'hotels': _money_rows(hotels),
+        'restaurants': _money_rows(restaurants),
+        'sightseeings': [dict(x) for x in sightseeings or []],
+        'checklist': [{'mark': "☑" if item in checked_items else "☐", 'item': item} for item in all_items],
+    }
+    tpl_bytes = render_docx_template("handover.docx", tpl_values, tpl_lists)
+    if tpl_bytes: return tpl_bytes
+
     doc = Document() # type: ignore
     
     # Styles
@@ -1529,9 +3212,6 @@ def create_handover_docx(tour_info, guests, hotels, restaurants, sightseeings, c
         
     # --- VI. CHECKLIST ---
     doc.add_heading('VI. CHECKLIST BÀN GIAO', level=1)
-    checked_items = checklist_str.split(',') if checklist_str else []
-    all_items = ["Chương trình đóng mộc", "Danh sách đóng mộc", "Bảo hiểm du lịch", "Thực đơn đóng mộc", "Vé máy bay", "Xác nhận khu du lịch/nhà hàng (Nếu có)", "Hợp đồng hướng dẫn"]
-    
     table_c = doc.add_table(rows=0, cols=2)
     for item in all_items:
         mark = "☑" if item in checked_items else "☐"
@@ -1551,60 +3231,62 @@ def create_handover_docx(tour_info, guests, hotels, restaurants, sightseeings, c
     return buffer.getvalue()
 
 # --- HÀM ĐỌC SỐ TIỀN BẰNG CHỮ (VIETNAMESE) ---
-def read_money_vietnamese(amount):
-    if amount == 0: return "Không đồng"
-    
-    digits = ["không", "một", "hai", "ba", "bốn", "năm", "sáu", "bảy", "tám", "chín"]
-    units = ["", "nghìn", "triệu", "tỷ"]
-    
-    def read_group(n):
-        res = ""
-        h = n // 100
-        t = (n % 100) // 10
-        u = n % 10
-        
-        if h > 0:
-            res += digits[h] + " trăm "
-        elif n > 0: # Có hàng chục hoặc đơn vị nhưng hàng trăm = 0 (xử lý ở loop chính tốt hơn, đây là logic đơn giản)
-            pass 
-            
-        if t > 1:
-            res += digits[t] + " mươi "
-            if u == 1: res += "mốt "
-            elif u == 5: res += "lăm "
-            elif u > 0: res += digits[u] + " "
-        elif t == 1:
-            res += "mười "
-            if u == 1: res += "một "
-            elif u == 5: res += "lăm "
-            elif u > 0: res += digits[u] + " "
-        else: # t = 0
-            if h > 0 and u > 0: res += "lẻ "
-            if u > 0: res += digits[u] + " "
-        return res
-
-    s_num = "{:.0f}".format(amount)
-    groups = []
-    while len(s_num) > 0:
-        groups.append(int(s_num[-3:]))
-        s_num = s_num[:-3]
-    
-    ret = ""
-    for i, g in enumerate(groups):
+_MONEY_DIGITS = ["không", "một", "hai", "ba", "bốn", "năm", "sáu", "bảy", "tám", "chín"]
+
+def _read_money_group(n):
+    h, t, u = n // 100, (n % 100) // 10, n % 10
+    words = []
+    if h > 0: words += [_MONEY_DIGITS[h], "trăm"]
+    if t > 1:
+        words += [_MONEY_DIGITS[t], "mươi"]
+        if u == 1: words.append("mốt")
+        elif u == 5: words.append("lăm")
+        elif u > 0: words.append(_MONEY_DIGITS[u])
+    elif t == 1:
+        words.append("mười")
+        if u == 5: words.append("lăm")
+        elif u > 0: words.append(_MONEY_DIGITS[u])
+    else:
+        if h > 0 and u > 0: words.append("lẻ")
+        if u > 0: words.append(_MONEY_DIGITS[u])
+    return " ".join(words)
+
+# Bảng tra sẵn 0-999: nhóm đứng đầu và nhóm phía sau (luôn đọc hàng trăm: 1.005 -> "một nghìn không trăm lẻ năm")
+_MONEY_GROUP_WORDS = [_read_money_group(n) for n in range(1000)]
+_MONEY_GROUP_WORDS_INNER = [("không trăm lẻ " if n < 10 else "không trăm ") + w if 0 < n < 100 else w for n, w in enumerate(_MONEY_GROUP_WORDS)]
+
+def _money_unit(i):
+    # 0: "", 1: nghìn, 2: triệu, 3: tỷ, 4: nghìn tỷ, 5: triệu tỷ, 6: tỷ tỷ...
+    return (["", "nghìn", "triệu"][i % 3] + " tỷ" * (i // 3)).strip()
+
+@functools.lru_cache(maxsize=4096)
+def _read_money_int(n):
+    if n == 0: return "Không đồng"
+    sign = "âm " if n < 0 else ""
+    n = abs(n)
+    parts = []
+    i = 0
+    while n > 0:
+        n, g = divmod(n, 1000)
         if g > 0:
-            s_g = read_group(g)
-            # Xử lý số 0 trăm
-            if i < len(groups) - 1 and g < 100 and g > 0: 
-                s_g = "không trăm " + s_g
-                
-            ret = s_g + units[i] + " " + ret
-            
-    ret = ret.strip()
-    # Capitalize first letter
-    if ret:
-        ret = ret[0].upper() + ret[1:]
-    
-    return ret + " đồng"
+            words = _MONEY_GROUP_WORDS_INNER[g] if n > 0 else _MONEY_GROUP_WORDS[g]
+            unit = _money_unit(i)
+            parts.append(f"{words} {unit}" if unit else words)
+        i += 1
+    ret = sign + " ".join(reversed(parts))
+    return ret[0].upper() + ret[1:] + " đồng"
+
+def read_money_vietnamese(amount):
+    return _read_money_int(int("{:.0f}".format(amount)))
+
+def read_money_vietnamese_many(amounts):
+    """Đọc hàng loạt (list hoặc Series) khi in chứng từ theo lô: mỗi số tiền khác nhau chỉ đọc 1 lần.
+    Trả về cùng kiểu đầu vào; ô trống (None/NaN) -> None (list) hoặc NaN (Series)."""
+    values = amounts if isinstance(amounts, pd.Series) else pd.Series(list(amounts), dtype=object)
+    ints = values.dropna().map(lambda a: int("{:.0f}".format(a)))
+    words = ints.map({n: _read_money_int(n) for n in ints.unique()})
+    out = words.reindex(values.index)
+    return out if isinstance(amounts, pd.Series) else [None if pd.isna(w) else w for w in out]
 
 def create_voucher_pdf(voucher_data):
     """Tạo file PDF phiếu thu/chi đẹp, có logo và màu sắc"""
@@ -1677,17 +3359,11 @@ def create_voucher_pdf(voucher_data):
     header_y = height - 50
     header_x_text = 50
     
-    if comp['logo_b64_str']:
+    logo = get_logo_assets(comp)
+    if logo:
         try:
-            logo_data = base64.b64decode(comp['logo_b64_str'])
-            image_stream = io.BytesIO(logo_data)
-            img_reader = ImageReader(image_stream)
-            # Tính tỷ lệ ảnh
-            iw, ih = img_reader.getSize()
-            aspect = iw / float(ih)
-            draw_w = logo_height * aspect
-            
-            c.drawImage(img_reader, 50, header_y - logo_height, width=draw_w, height=logo_height, mask='auto')
+            draw_w = logo_height * logo['aspect']
+            c.drawImage(logo['reader'], 50, header_y - logo_height, width=draw_w, height=logo_height, mask='auto')
             header_x_text = 50 + draw_w + 20
         except: pass
 
@@ -1755,11 +3431,8 @@ def create_voucher_pdf(voucher_data):
                 contract_val = float(b_info['selling_price'] or 0)
         
         # 2. Lấy tổng đã thu (Bao gồm cả phiếu vừa tạo nếu đã lưu DB)
-        txns = run_query("SELECT type, amount FROM transaction_history WHERE ref_code=?", (ref_code,))
-        if txns:
-            paid_sum = sum(r['amount'] for r in txns if r['type'] == 'THU')
-            refund_sum = sum(r['amount'] for r in txns if r['type'] == 'CHI')
-            total_paid = paid_sum - refund_sum
+        paid_sum, refund_sum = get_ref_balance(ref_code)
+        total_paid = paid_sum - refund_sum
             
         remaining = contract_val - total_paid
 
@@ -1775,26 +3448,19 @@ def create_voucher_pdf(voucher_data):
     content_w = width - 100
     content_h = 285
 
-    if comp['logo_b64_str']:
+    wm = get_logo_watermark(0.07, comp)
+    if wm:
         try:
-            c.saveState()
-            logo_data = base64.b64decode(comp['logo_b64_str'])
-            image_stream = io.BytesIO(logo_data)
-            img_reader = ImageReader(image_stream)
-            iw, ih = img_reader.getSize()
-            aspect = iw / float(ih)
             wm_width = 220
-            wm_height = wm_width / aspect
-            c.setFillAlpha(0.07)
+            wm_height = wm_width / wm['aspect']
             c.drawImage(
-                img_reader,
+                wm['reader'],
                 content_x + (content_w - wm_width) / 2,
                 content_y + (content_h - wm_height) / 2,
                 width=wm_width,
                 height=wm_height,
                 mask='auto'
             )
-            c.restoreState()
         except:
             pass
 
@@ -1856,6 +3522,32 @@ def create_voucher_pdf(voucher_data):
 
 def create_voucher_docx(voucher_data):
     """Tạo file Word phiếu thu/chi"""
+    comp = get_company_data()
+
+    # Data Logic
+    person_name = (voucher_data.get('payer_name') or "").strip()
+    ref_code = voucher_data.get('ref_code', '')
+    if ref_code and not person_name:
+        try:
+            t = run_query("SELECT customer_name FROM tours WHERE tour_code=?", (ref_code,), fetch_one=True)
+            if t and t['customer_name']: person_name = t['customer_name']
+            else:
+                b = run_query("SELECT customer_info FROM service_bookings WHERE code=?", (ref_code,), fetch_one=True)
+                if b and b['customer_info']: person_name = b['customer_info'].split(' - ')[0]
+        except: pass
+
+    title = "PHIẾU THU TIỀN" if voucher_data['type'] == 'THU' else "PHIẾU CHI TIỀN"
+    label_person = "Người nộp tiền:" if voucher_data['type'] == 'THU' else "Người nhận tiền:"
+
+    # [NEW] Ưu tiên file mẫu docx_templates/voucher.docx nếu có
+    tpl_bytes = render_docx_template("voucher.docx", {
+        'company_name': comp['name'].upper(), 'company_address': comp['address'], 'company_phone': comp['phone'],
+        'title': title, 'date': voucher_data['date'], 'label_person': label_person, 'person_name': person_name,
+        'ref_code': ref_code, 'note': voucher_data['note'], 'amount': f"{format_vnd(voucher_data['amount'])} VND",
+        'amount_text': read_money_vietnamese(voucher_data['amount']), 'issuer': voucher_data.get('issuer', ''),
+    })
+    if tpl_bytes: return tpl_bytes
+
     doc = Document()
     # Styles
     style = doc.styles['Normal']
@@ -1863,8 +3555,6 @@ def create_voucher_docx(voucher_data):
     font.name = 'Times New Roman'
     font.size = Pt(11)
     
-    comp = get_company_data()
-    
     # Header
     t = doc.add_table(rows=1, cols=2)
     t.autofit = False
@@ -1872,10 +3562,10 @@ def create_voucher_docx(voucher_data):
     t.columns[1].width = Cm(14)
     
     # Logo
-    if comp['logo_b64_str']:
+    logo = get_logo_assets(comp)
+    if logo:
         try:
-            logo_data = base64.b64decode(comp['logo_b64_str'])
-            image_stream = io.BytesIO(logo_data)
+            image_stream = io.BytesIO(logo['bytes'])
             cell = t.cell(0, 0)
             p = cell.paragraphs[0]
             r = p.add_run()
@@ -1896,7 +3586,6 @@ def create_voucher_docx(voucher_data):
     doc.add_paragraph()
     
     # Title
-    title = "PHIẾU THU TIỀN" if voucher_data['type'] == 'THU' else "PHIẾU CHI TIỀN"
     color = RGBColor(46, 125, 50) if voucher_data['type'] == 'THU' else RGBColor(198, 40, 40)
     
     p_title = doc.add_paragraph(title)
@@ -1911,18 +3600,6 @@ def create_voucher_docx(voucher_data):
     
     doc.add_paragraph()
     
-    # Data Logic
-    person_name = (voucher_data.get('payer_name') or "").strip()
-    ref_code = voucher_data.get('ref_code', '')
-    if ref_code and not person_name:
-        try:
-            t = run_query("SELECT customer_name FROM tours WHERE tour_code=?", (ref_code,), fetch_one=True)
-            if t and t['customer_name']: person_name = t['customer_name']
-            else:
-                b = run_query("SELECT customer_info FROM service_bookings WHERE code=?", (ref_code,), fetch_one=True)
-                if b and b['customer_info']: person_name = b['customer_info'].split(' - ')[0]
-        except: pass
-
     # Content Table
     t_content = doc.add_table(rows=0, cols=2)
     t_content.autofit = False
@@ -1938,7 +3615,6 @@ def create_voucher_docx(voucher_data):
         if color_val:
             r.cells[1].paragraphs[0].runs[0].font.color.rgb = color_val
 
-    label_person = "Người nộp tiền:" if voucher_data['type'] == 'THU' else "Người nhận tiền:"
     add_row(label_person, person_name)
     add_row("Mã Tour/Booking:", voucher_data.get('ref_code', ''))
     add_row("Lý do:", f"{voucher_data['note']}")
@@ -1972,20 +3648,13 @@ def create_booking_cfm_pdf(booking_info, company_info, lang='en'):
     width, height = letter
     
     # --- HELPER: WATERMARK & NEW PAGE ---
+    wm = get_logo_watermark(0.08, company_info) # Độ mờ 8%
     def draw_watermark():
-        if company_info['logo_b64_str']:
+        if wm:
             try:
-                c.saveState()
-                logo_data = base64.b64decode(company_info['logo_b64_str'])
-                image_stream = io.BytesIO(logo_data)
-                img_reader = ImageReader(image_stream)
-                iw, ih = img_reader.getSize()
-                aspect = iw / float(ih)
                 wm_width = 400
-                wm_height = wm_width / aspect
-                c.setFillAlpha(0.08) # Độ mờ 8%
-                c.drawImage(img_reader, (width - wm_width)/2, (height - wm_height)/2, width=wm_width, height=wm_height, mask='auto')
-                c.restoreState()
+                wm_height = wm_width / wm['aspect']
+                c.drawImage(wm['reader'], (width - wm_width)/2, (height - wm_height)/2, width=wm_width, height=wm_height, mask='auto')
             except: pass
 
     draw_watermark()
@@ -2109,16 +3778,12 @@ def create_booking_cfm_pdf(booking_info, company_info, lang='en'):
     # --- HEADER ---
     y = height - 50
     # Logo
-    if company_info['logo_b64_str']:
+    logo = get_logo_assets(company_info)
+    if logo:
         try:
-            logo_data = base64.b64decode(company_info['logo_b64_str'])
-            image_stream = io.BytesIO(logo_data)
-            img_reader = ImageReader(image_stream)
-            iw, ih = img_reader.getSize()
-            aspect = iw / float(ih)
             logo_h = 85 # Logo to hơn
-            logo_w = logo_h * aspect
-            c.drawImage(img_reader, 40, y - logo_h, width=logo_w, height=logo_h, mask='auto')
+            logo_w = logo_h * logo['aspect']
+            c.drawImage(logo['reader'], 40, y - logo_h, width=logo_w, height=logo_h, mask='auto')
         except: pass
 
     # Xử lý địa chỉ (Dịch sơ bộ nếu là tiếng Anh)
@@ -2516,18 +4181,66 @@ def create_booking_cfm_pdf(booking_info, company_info, lang='en'):
 
 def create_booking_cfm_docx(booking_info, company_info, lang='en'):
     """Tạo file Word Booking Confirmation"""
-    doc = Document()
-    style = doc.styles['Normal']
-    font = style.font # type: ignore
-    font.name = 'Times New Roman'
-    font.size = Pt(11)
-    
     # Labels
     labels = {
         'en': {'title': 'BOOKING CONFIRMATION', 'greeting': f"A warm greeting from {company_info['name']}!", 'gen_info': 'I. GENERAL INFORMATION', 'svc_details': 'II. SERVICE DETAILS', 'guest_list': 'III. GUEST LIST', 'included': 'INCLUDED SERVICES'},
         'vi': {'title': 'XÁC NHẬN ĐẶT DỊCH VỤ', 'greeting': f"Lời chào trân trọng từ {company_info['name']}!", 'gen_info': 'I. THÔNG TIN CHUNG', 'svc_details': 'II. CHI TIẾT DỊCH VỤ', 'guest_list': 'III. DANH SÁCH KHÁCH', 'included': 'DỊCH VỤ BAO GỒM'}
     }
     txt = labels[lang]
+
+    cust_raw = booking_info.get('customer_info', '')
+    cust_name = cust_raw.split(' - ')[0] if ' - ' in cust_raw else cust_raw
+
+    details = booking_info.get('details', '')
+    if booking_info.get('type') == 'HOTEL':
+        r_type = booking_info.get('room_type', '')
+        if r_type: details += f"\nRoom Type: {r_type}"
+    elif booking_info.get('type') == 'TRANS' and '[XE]' in booking_info.get('name', ''):
+        # [NEW] Xử lý hiển thị chi tiết cho Booking Xe (Word)
+        raw_details = details
+        itinerary = booking_info['name'].replace('[XE]', '').strip()
+        
+        car_info = ""
+        m_car = re.search(r'Xe\s*([^:]*):\s*([^|]+)', raw_details)
+        if m_car: car_info = f"{m_car.group(1).strip()} - {m_car.group(2).strip()}"
+            
+        driver_name = ""
+        driver_phone = ""
+        m_drv_full = re.search(r'Tài xế:\s*([^|]+)', raw_details)
+        if m_drv_full:
+            drv_str = m_drv_full.group(1).strip()
+            if ' - ' in drv_str:
+                parts = drv_str.split(' - ')
+                driver_name = parts[0]
+                driver_phone = parts[1] if len(parts) > 1 else ""
+            else:
+                driver_name = drv_str
+
+        lines = []
+        if itinerary: lines.append(f"Lịch trình: {itinerary}" if lang == 'vi' else f"Itinerary: {itinerary}")
+        if car_info: lines.append(f"Xe/Biển số: {car_info}" if lang == 'vi' else f"Car/Plate: {car_info}")
+        if driver_name: lines.append(f"Tài xế: {driver_name}" if lang == 'vi' else f"Driver: {driver_name}")
+        if driver_phone: lines.append(f"SĐT: {driver_phone}" if lang == 'vi' else f"Phone: {driver_phone}")
+        
+        if lines: details = "\n".join(lines)
+
+    # [NEW] Ưu tiên file mẫu docx_templates/booking_cfm.docx nếu có
+    tpl_bytes = render_docx_template("booking_cfm.docx", {
+        'company_name': company_info['name'].upper(), 'company_address': company_info['address'], 'company_phone': company_info['phone'],
+        'title': txt['title'], 'greeting': txt['greeting'], 'code': booking_info['code'],
+        'created_at': booking_info.get('created_at', ''), 'customer': cust_name, 'sale_name': booking_info.get('sale_name', ''),
+        'status': booking_info.get('status', ''), 'hotel_code': booking_info.get('hotel_code', ''),
+        'service_name': booking_info['name'], 'details': details, 'guest_list': booking_info.get('guest_list', ''),
+        'label_gen_info': txt['gen_info'], 'label_svc_details': txt['svc_details'],
+        'label_guest_list': txt['guest_list'], 'label_included': txt['included'],
+    })
+    if tpl_bytes: return tpl_bytes
+
+    doc = Document()
+    style = doc.styles['Normal']
+    font = style.font # type: ignore
+    font.name = 'Times New Roman'
+    font.size = Pt(11)
     
     # Header
     t = doc.add_table(rows=1, cols=2)
@@ -2535,10 +4248,10 @@ def create_booking_cfm_docx(booking_info, company_info, lang='en'):
     t.columns[0].width = Cm(3)
     t.columns[1].width = Cm(13)
     
-    if company_info['logo_b64_str']:
+    logo = get_logo_assets(company_info)
+    if logo:
         try:
-            logo_data = base64.b64decode(company_info['logo_b64_str'])
-            image_stream = io.BytesIO(logo_data)
+            image_stream = io.BytesIO(logo['bytes'])
             t.cell(0, 0).paragraphs[0].add_run().add_picture(image_stream, width=Cm(2.5))
         except: pass
         
@@ -2564,9 +4277,6 @@ def create_booking_cfm_docx(booking_info, company_info, lang='en'):
     t_gen = doc.add_table(rows=0, cols=4)
     t_gen.style = 'Table Grid'
     
-    cust_raw = booking_info.get('customer_info', '')
-    cust_name = cust_raw.split(' - ')[0] if ' - ' in cust_raw else cust_raw
-    
     def add_kv(k1, v1, k2, v2):
         r = t_gen.add_row()
         r.cells[0].text = k1; r.cells[0].paragraphs[0].runs[0].bold = True
@@ -2591,40 +4301,6 @@ def create_booking_cfm_docx(booking_info, company_info, lang='en'):
     
     r = t_svc.add_row()
     r.cells[0].text = booking_info['name']
-    
-    details = booking_info.get('details', '')
-    if booking_info.get('type') == 'HOTEL':
-        r_type = booking_info.get('room_type', '')
-        if r_type: details += f"\nRoom Type: {r_type}"
-    elif booking_info.get('type') == 'TRANS' and '[XE]' in booking_info.get('name', ''):
-        # [NEW] Xử lý hiển thị chi tiết cho Booking Xe (Word)
-        raw_details = details
-        itinerary = booking_info['name'].replace('[XE]', '').strip()
-        
-        car_info = ""
-        m_car = re.search(r'Xe\s*([^:]*):\s*([^|]+)', raw_details)
-        if m_car: car_info = f"{m_car.group(1).strip()} - {m_car.group(2).strip()}"
-            
-        driver_name = ""
-        driver_phone = ""
-        m_drv_full = re.search(r'Tài xế:\s*([^|]+)', raw_details)
-        if m_drv_full:
-            drv_str = m_drv_full.group(1).strip()
-            if ' - ' in drv_str:
-                parts = drv_str.split(' - ')
-                driver_name = parts[0]
-                driver_phone = parts[1] if len(parts) > 1 else ""
-            else:
-                driver_name = drv_str
-
-        lines = []
-        if itinerary: lines.append(f"Lịch trình: {itinerary}" if lang == 'vi' else f"Itinerary: {itinerary}")
-        if car_info: lines.append(f"Xe/Biển số: {car_info}" if lang == 'vi' else f"Car/Plate: {car_info}")
-        if driver_name: lines.append(f"Tài xế: {driver_name}" if lang == 'vi' else f"Driver: {driver_name}")
-        if driver_phone: lines.append(f"SĐT: {driver_phone}" if lang == 'vi' else f"Phone: {driver_phone}")
-        
-        if lines: details = "\n".join(lines)
-    
     r.cells[1].text = details
     
     doc.add_paragraph()
@@ -2660,15 +4336,158 @@ def create_booking_cfm_docx(booking_info, company_info, lang='en'):
 # 4. GIAO DIỆN & LOGIC MODULES
 # ==========================================
 
+def rerun_fragment():
+    """[NEW] st.rerun(scope="fragment") chỉ hợp lệ khi đang chạy lại riêng fragment.
+    Lần chạy toàn trang (fragment được gọi từ main) thì rerun cả trang thay vì báo lỗi."""
+    ctx = get_script_run_ctx()
+    if ctx is not None and ctx.fragment_ids_this_run:
+        st.rerun(scope="fragment")
+    st.rerun()
+
+def _normalize_editor_frame(df, cols):
+    # Cột toàn số (int/float/None lẫn lộn) -> float, còn lại -> chuỗi; bỏ qua index
+    out = df.reindex(columns=cols).reset_index(drop=True)
+    for c in cols:
+        col = out[c]
+        num = pd.to_numeric(col, errors='coerce')
+        filled = col.notna() & (col.astype(str).str.strip() != '')
+        if (num.notna() == filled).all(): out[c] = num.fillna(0.0).astype(float)
+        else: out[c] = col.fillna('').astype(str)
+    return out
+
+def editor_frame_changed(new_df, old_df, cols):
+    """[NEW] So sánh bảng vừa sửa với bản trong session_state theo giá trị, không theo dtype
+    (0 kiểu int so với 0.0 sau recalc_remaining, None so với NaN) để không rerun vô tận."""
+    if len(new_df) != len(old_df): return True
+    return not _normalize_editor_frame(new_df, cols).equals(_normalize_editor_frame(old_df, cols))
+
+def render_lazy_tabs(panels, key):
+    """[NEW] Thay st.tabs: thanh chọn tab giữ trạng thái, chỉ chạy thân của tab đang chọn.
+    panels: {nhãn tab: hàm vẽ tab}. Đo thời gian từng tab để admin thấy mỗi lần tải tiết kiệm bao nhiêu."""
+    labels = list(panels.keys())
+    active = st.radio("Tab", labels, horizontal=True, key=key, label_visibility="collapsed")
+    st.divider()
+
+    t0 = time.perf_counter()
+    panels[active]()
+    elapsed_ms = (time.perf_counter() - t0) * 1000
+
+    timings = st.session_state.setdefault('_tab_timings', {}).setdefault(key, {})
+    timings[active] = elapsed_ms
+    if (st.session_state.get("user_info") or {}).get('role') in ['admin', 'admin_f1']:
+        skipped = {lbl: ms for lbl, ms in timings.items() if lbl != active}
+        note = f"⏱️ Tab hiện tại: {elapsed_ms:,.0f} ms"
+        if skipped:
+            note += f" | Bỏ qua {len(skipped)} tab khác (lần đo gần nhất): ~{sum(skipped.values()):,.0f} ms tiết kiệm mỗi lần tải"
+        st.caption(note)
+    return active
+
+def typeahead_picker(label, search_fn, key, format_fn, empty_label, placeholder="Gõ để tìm..."):
+    """[NEW] Ô tìm + danh sách TOP N kết quả do search_fn(term) truy vấn từ DB.
+    st.text_input chỉ gửi khi Enter/rời ô nên tự có độ trễ (debounce), không truy vấn theo từng phím."""
+    c_q, c_sel = st.columns([1, 2])
+    term = c_q.text_input(label, key=f"{key}_q", placeholder=placeholder)
+    results = search_fn(term.strip())
+    options = [None] + results
+    return c_sel.selectbox(f"{label} - kết quả", options, key=f"{key}_sel",
+                           format_func=lambda r: empty_label if r is None else format_fn(r))
+
+# --- [NEW] PHÂN TRANG KEYSET: WHERE id < con trỏ ORDER BY id DESC LIMIT N (không OFFSET, không tải cả bảng) ---
+KEYSET_PAGE_SIZE = 20
+KEYSET_COUNT_CAP = 10000
+
+def fetch_keyset_page(table, columns, conditions, params, before_id=None, limit=KEYSET_PAGE_SIZE):
+    """Lấy 1 trang (thêm 1 dòng để biết còn trang sau không). columns phải có id."""
+    conds, p = list(conditions), list(params)
+    if before_id is not None:
+        conds.append("id < ?"); p.append(before_id)
+    where = " WHERE " + " AND ".join(conds) if conds else ""
+    return run_query(f"SELECT {columns} FROM {table}{where} ORDER BY id DESC LIMIT ?", tuple(p) + (limit + 1,))
+
+def count_rows_capped(table, conditions, params, cap=KEYSET_COUNT_CAP):
+    """Đếm có giới hạn: quá cap thì chỉ báo 'cap+' thay vì quét hết bảng"""
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    row = run_query(f"SELECT COUNT(*) AS n FROM (SELECT 1 FROM {table}{where} LIMIT ?)", tuple(params) + (cap + 1,), fetch_one=True, cache=True)
+    n = row['n'] if row else 0
+    return f"{cap:,}+".replace(",", ".") if n > cap else f"{n:,}".replace(",", ".")
+
+def list_filter_controls(key, table, sale_col=None, period_col=None, status_options=None):
+    """Bộ lọc phía server (trạng thái / sale / kỳ) -> (conditions, params) cho keyset_paginator.
+    period_col: cột ngày dạng YYYY-MM-DD... (lọc theo khoảng, dùng được index)."""
+    user_info = st.session_state.get("user_info", {}) or {}
+    conditions, params = [], []
+    cols = st.columns(3)
+
+    if status_options:
+        status_label = cols[0].selectbox("Trạng thái:", list(status_options.keys()), key=f"{key}_status")
+        status_cond = status_options[status_label]
+        if status_cond:
+            conditions.append(status_cond[0]); params.extend(status_cond[1])
+
+    if sale_col:
+        if user_info.get('role') == 'sale' and user_info.get('name'):
+            conditions.append(f"{sale_col}=?"); params.append(user_info.get('name'))
+        else:
+            sales = [r[0] for r in run_query(f"SELECT DISTINCT {sale_col} FROM {table} WHERE {sale_col} IS NOT NULL AND {sale_col} != '' ORDER BY 1", cache=True)]
+            sel_sale = cols[1].selectbox("Sales:", ["Tất cả"] + sales, key=f"{key}_sale")
+            if sel_sale != "Tất cả":
+                conditions.append(f"{sale_col}=?"); params.append(sel_sale)
+
+    if period_col:
+        now = datetime.now()
+        months = [f"{(now.month - i - 1) % 12 + 1:02d}/{now.year + (now.month - i - 1) // 12}" for i in range(24)]
+        sel_period = cols[2].selectbox("Tháng:", ["Tất cả"] + months, key=f"{key}_period")
+        if sel_period != "Tất cả":
+            mm, yyyy = sel_period.split("/")
+            conditions.append(f"{period_col} >= ? AND {period_col} < ?"); params.extend(month_range(int(yyyy), int(mm)))
+    return conditions, params
+
+def keyset_paginator(key, table, columns, conditions=(), params=(), page_size=KEYSET_PAGE_SIZE):
+    """Thanh ◀ Trước / Sau ▶ + trả về các dòng của trang hiện tại.
+    Con trỏ (id cuối mỗi trang) giữ trong session_state; đổi bộ lọc thì quay về trang 1."""
+    sig = (table, tuple(conditions), tuple(params))
+    state_key = f"{key}_keyset"
+    state = st.session_state.get(state_key)
+    if not state or state['sig'] != sig:
+        state = {'sig': sig, 'cursors': [None]}
+        st.session_state[state_key] = state
+
+    rows = fetch_keyset_page(table, columns, conditions, params, state['cursors'][-1], page_size)
+    if not rows and len(state['cursors']) > 1:
+        state['cursors'] = [None]  # Trang hiện tại bị xóa hết -> về trang đầu
+        rows = fetch_keyset_page(table, columns, conditions, params, None, page_size)
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    page_no = len(state['cursors'])
+
+    def _prev(): state['cursors'].pop()
+    def _next(): state['cursors'].append(rows[-1]['id'])
+
+    c_prev, c_info, c_next = st.columns([1, 3, 1])
+    c_prev.button("◀ Trước", key=f"{key}_prev", disabled=page_no == 1, on_click=_prev, use_container_width=True)
+    c_info.caption(f"Trang {page_no} · Tổng: {count_rows_capped(table, conditions, params)} bản ghi")
+    c_next.button("Sau ▶", key=f"{key}_next", disabled=not has_more, on_click=_next, use_container_width=True)
+    return rows
+
 def render_notification_calendar():
     st.title("📅 Lịch Thông Báo & Nhắc Thanh Toán")
     
-    # --- TỰ ĐỘNG CHẠY KIỂM TRA GỬI LẦN 2 ---
-    if "auto_check_done" not in st.session_state:
-        sent_count = check_and_send_due_reminders()
-        if sent_count > 0:
-            st.toast(f"🚀 Hệ thống vừa tự động gửi {sent_count} email nhắc hẹn đến hạn!", icon="✅")
-        st.session_state.auto_check_done = True
+    # --- [NEW] GỬI LẦN 2 DO THREAD NỀN ĐẢM NHIỆM, TRANG CHỈ HIỆN TRẠNG THÁI ---
+    scheduler = start_reminder_scheduler()
+    if scheduler['enabled']:
+        c_info, c_btn = st.columns([4, 1])
+        last_run = scheduler['last_run'].strftime('%H:%M:%S') if scheduler['last_run'] else "--"
+        c_info.caption(f"⏱️ Tự động gửi nhắc lần 2: quét mỗi {REMINDER_POLL_SECONDS}s · lần quét gần nhất {last_run} · đã gửi {scheduler['sent']} email")
+        if scheduler['last_error']: c_info.caption(f"⚠️ Lỗi lượt quét gần nhất: {scheduler['last_error']}")
+        if c_btn.button("🔄 Quét ngay", key="reminder_wake"):
+            # Chỉ đánh thức thread nền, không chờ; lần tải lại sau sẽ thấy lần quét / số email mới
+            scheduler['wake'].set()
+            c_info.caption("🔄 Đã yêu cầu quét, kết quả sẽ hiện ở lần tải lại tiếp theo.")
+    else:
+        st.caption("⏱️ Bộ lập lịch nền đang tắt trong tiến trình này (REMINDER_SCHEDULER=0) - tiến trình khác sẽ gửi nhắc lần 2.")
+
+    if (st.session_state.get("user_info") or {}).get('role') in ['admin', 'admin_f1']:
+        render_email_outbox_admin()
 
     # Chia layout
     col_cal, col_form = st.columns([1, 1.5])
@@ -2710,17 +4529,21 @@ def render_notification_calendar():
             upcoming = run_query("SELECT * FROM payment_reminders WHERE status != 'sent_2' ORDER BY due_date ASC")
             
             if upcoming:
+                parsed = []
                 for item in upcoming:
                     try:
                         d_obj = datetime.strptime(item['due_date'], '%Y-%m-%d %H:%M:%S')
                     except:
                         d_obj = datetime.strptime(item['due_date'], '%Y-%m-%d')
-                        
+                    parsed.append((item, d_obj))
+                # Tra âm lịch cả danh sách 1 lần (bảng dựng sẵn)
+                lunar_labels = convert_solar_to_lunar_batch([d for _, d in parsed], suffix="")
+
+                for (item, d_obj), lunar_display in zip(parsed, lunar_labels):
                     days_left = (d_obj.date() - datetime.now().date()).days
                     
                     # Format ngày tháng năm
                     date_display = d_obj.strftime('%H:%M %d/%m/%Y')
-                    lunar_display = convert_solar_to_lunar(d_obj).replace(" (Âm lịch)", "")
                     
                     color = "orange" if days_left == 0 else "green" if days_left > 0 else "red"
                     icon = "🔔" if days_left == 0 else "📅"
@@ -2730,8 +4553,11 @@ def render_notification_calendar():
                         st.write(f"**Người nhận:** {item['receiver_email']}")
                         st.write(f"**Số tiền:** {format_vnd(item['amount'])} VND")
                         
-                        status_txt = "Chờ gửi Lần 1" if item['status'] == 'pending' else "Đã gửi Lần 1, chờ Lần 2"
+                        status_txt = {'pending': "Chờ gửi Lần 1", 'queued_2': "Đang gửi Lần 2...",
+                                      'failed': "Gửi email thất bại"}.get(item['status'], "Đã gửi Lần 1, chờ Lần 2")
                         st.caption(f"Trạng thái: {status_txt}")
+                        if item['last_error']:
+                            st.caption(f"⚠️ Lỗi lần gửi {item['attempts']}: {item['last_error']}")
                         
                         if st.button("🗑️ Xóa", key=f"del_cal_{item['id']}"):
                             run_query("DELETE FROM payment_reminders WHERE id=?", (item['id'],), commit=True)
@@ -2749,33 +4575,18 @@ def render_notification_calendar():
             u_role = user_info.get('role')
             u_name = user_info.get('name')
             
-            tour_q = "SELECT tour_code, tour_name FROM tours WHERE status='running'"
-            tour_p = []
-            bk_q = "SELECT code, name FROM service_bookings WHERE status='active'"
-            bk_p = []
-            
-            if u_role not in ['admin', 'admin_f1']:
-                tour_q += " AND sale_name=?"
-                tour_p.append(u_name)
-                bk_q += " AND sale_name=?"
-                bk_p.append(u_name)
-                
-            tours = run_query(tour_q, tuple(tour_p))
-            bookings = run_query(bk_q, tuple(bk_p))
-            
-            opts = ["-- Chọn mã liên kết --"]
-            if tours: opts += [f"TOUR | {t['tour_code']} | {t['tour_name']}" for t in tours]
-            if bookings: opts += [f"BOOK | {b['code']} | {b['name']}" for b in bookings]
-            
-            sel_ref = st.selectbox("Liên kết với Booking/Tour:", opts, key="notif_ref")
+            ref_owner = u_name if u_role not in ['admin', 'admin_f1'] else None
+            sel_ref = typeahead_picker(
+                "Liên kết với Booking/Tour (Mã/Tên):", lambda q: search_open_refs(q, ref_owner), "notif_ref",
+                lambda r: f"{r[0]} | {r[1]} | {r[2]}", "-- Chọn mã liên kết --"
+            )
             
             # Tự động điền thông tin nếu chọn mã
             ref_code = ""
             ref_name = ""
-            if sel_ref != "-- Chọn mã liên kết --":
-                parts = sel_ref.split(" | ")
-                ref_code = parts[1]
-                ref_name = parts[2]
+            if sel_ref:
+                ref_code = sel_ref[1]
+                ref_name = sel_ref[2]
 
             c1, c2 = st.columns(2)
             
@@ -2827,8 +4638,8 @@ def render_notification_calendar():
 
             if st.button("🚀 Lưu & Gửi thông báo ngay", type="primary", use_container_width=True):
                 if ref_code and receiver and content:
-                    with st.spinner("Đang gửi email lần 1..."):
-                        # 1. Gửi Email Lần 1 Ngay lập tức
+                    with st.spinner("Đang xếp email lần 1 vào hàng đợi..."):
+                        # 1. Dựng Email Lần 1 (thread nền gửi ngay qua email_outbox, form không phải chờ SMTP)
                         bank_html = ""
                         if bank_name and bank_acc:
                             bank_html = f"""
@@ -2853,25 +4664,111 @@ def render_notification_calendar():
                         <p>Trân trọng,<br><strong>{sender_name}</strong><br><small>Bali Tourist Automated System</small></p>
                         """
                         
-                        ok, msg = send_email_notification(receiver, subj, html_body, cc_emails=cc_email)
+                        try:
+                            # 2. Lưu nhắc hẹn (chờ gửi lần 1 -> gửi xong thành sent_1, đến hạn gửi lần 2) + email lần 1 vào outbox
+                            queue_payment_request({
+                                'ref_code': ref_code, 'ref_name': ref_name, 'amount': amount,
+                                'due_date': due_datetime.strftime('%Y-%m-%d %H:%M:%S'), 'receiver_email': receiver, 'content': content,
+                                'status': 'pending', 'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'cc_email': cc_email,
+                                'sender_name': sender_name, 'bank_name': bank_name, 'bank_account': bank_acc, 'bank_holder': bank_holder,
+                            }, subj, html_body)
+                            ok, msg = True, ""
+                        except Exception as e:
+                            ok, msg = False, f"Lỗi lưu yêu cầu: {e}"
                         if ok:
-                            # 2. Lưu vào DB để hẹn giờ gửi lần 2
-                            run_query("""INSERT INTO payment_reminders 
-                                (ref_code, ref_name, amount, due_date, receiver_email, content, status, created_at, cc_email, sender_name, bank_name, bank_account, bank_holder)
-                                VALUES (?, ?, ?, ?, ?, ?, 'sent_1', ?, ?, ?, ?, ?, ?)""", 
-                                (ref_code, ref_name, amount, due_datetime.strftime('%Y-%m-%d %H:%M:%S'), receiver, content, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), cc_email, sender_name, bank_name, bank_acc, bank_holder),
-                                commit=True)
-                            
                             # [FIX] Reset form fields
-                            keys_to_reset = ["req_amount_val", "notif_receiver", "notif_content", "notif_bank_name", "notif_bank_acc", "notif_bank_holder", "notif_cc", "notif_date", "notif_time", "notif_ref"]
+                            keys_to_reset = ["req_amount_val", "notif_receiver", "notif_content", "notif_bank_name", "notif_bank_acc", "notif_bank_holder", "notif_cc", "notif_date", "notif_time", "notif_ref_q", "notif_ref_sel"]
                             for k in keys_to_reset:
                                 if k in st.session_state: del st.session_state[k]
 
-                            st.success(f"✅ Đã gửi email lần 1 và lên lịch nhắc lần 2 vào ngày {due_date.strftime('%d/%m/%Y')}!"); time.sleep(1); st.rerun()
+                            st.success(f"✅ Đã xếp email lần 1 vào hàng đợi và lên lịch nhắc lần 2 vào ngày {due_date.strftime('%d/%m/%Y')}!"); time.sleep(1); st.rerun()
                         else: st.error(msg)
                 else:
                     st.warning("Vui lòng chọn Mã liên kết, nhập Email và Nội dung.")
 
+@st.fragment
+def render_email_outbox_admin():
+    """[NEW] Admin: độ dài hàng đợi email, email lỗi đang chờ thử lại và email 'dead' (gửi lại / xóa)"""
+    counts, oldest = get_outbox_stats()
+    n_dead = counts.get('dead', 0)
+    with st.expander(f"📮 Hàng đợi email · chờ gửi {counts.get('queued', 0) + counts.get('sending', 0)} · lỗi hẳn {n_dead}", expanded=n_dead > 0):
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("Chờ gửi", counts.get('queued', 0))
+        m2.metric("Đang gửi", counts.get('sending', 0))
+        m3.metric("Đã gửi", counts.get('sent', 0))
+        m4.metric("Lỗi hẳn (dead)", n_dead)
+        if oldest: st.caption(f"Email chờ lâu nhất tạo lúc {oldest}")
+
+        retrying = run_query("""SELECT id, to_email, subject, attempts, next_attempt_at, last_error FROM email_outbox
+            WHERE status='queued' AND attempts > 0 ORDER BY next_attempt_at LIMIT 50""")
+        if retrying:
+            st.markdown("**🔁 Đang chờ thử lại**")
+            st.dataframe(pd.DataFrame([dict(r) for r in retrying]), hide_index=True, use_container_width=True)
+
+        dead = run_query("""SELECT id, to_email, subject, attempts, last_error, created_at FROM email_outbox
+            WHERE status='dead' ORDER BY id DESC LIMIT 50""")
+        if dead:
+            st.markdown("**☠️ Gửi thất bại hẳn**")
+            for item in dead:
+                c_info, c_retry, c_del = st.columns([6, 1, 1])
+                c_info.markdown(f"**{item['subject']}** → {item['to_email']}  \n<small>{item['attempts']} lần · {item['last_error']}</small>", unsafe_allow_html=True)
+                if c_retry.button("🔁", key=f"outbox_retry_{item['id']}", help="Đưa lại vào hàng đợi"):
+                    run_query("UPDATE email_outbox SET status='queued', attempts=0, next_attempt_at=?, last_error=NULL WHERE id=?",
+                              (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), item['id']), commit=True)
+                    run_query("UPDATE payment_reminders SET status=CASE (SELECT stage FROM email_outbox WHERE id=?) WHEN 1 THEN 'pending' ELSE 'queued_2' END WHERE id=(SELECT reminder_id FROM email_outbox WHERE id=?)",
+                              (item['id'], item['id']), commit=True)
+                    wake_reminder_scheduler()
+                    rerun_fragment()
+                if c_del.button("🗑️", key=f"outbox_del_{item['id']}", help="Xóa khỏi hàng đợi"):
+                    run_query("DELETE FROM email_outbox WHERE id=?", (item['id'],), commit=True)
+                    rerun_fragment()
+        elif not retrying:
+            st.success("Không có email lỗi.")
+
+# --- [NEW] SỐ LIỆU TRANG CHỦ: LỌC THÁNG & CỘNG DỒN NGAY TRONG SQL ---
+@st.cache_data(ttl=600, show_spinner=False)
+def get_dashboard_data(role, username, year, month):
+    """Chỉ lấy tour/booking của tháng đang xem, trả về đúng các cột hiển thị (cache theo role, user, tháng)"""
+    sale_filter = " AND sale_name=?" if role == 'sale' else ""
+    sale_params = (username,) if role == 'sale' else ()
+
+    # Lọc theo khoảng [đầu tháng, đầu tháng sau) trên cột ISO có index (tours.start_ymd suy ra từ start_date dd/mm/yyyy)
+    month_start, next_month = month_range(year, month)
+    tour_params = (month_start, next_month) + sale_params
+    tour_rows = run_query(f"""
+        WITH base AS (
+            SELECT t.id, t.start_date, t.tour_name,
+                   {TOUR_CONTRACT_SQL} AS contract_rev,
+                   COALESCE(t.est_profit_percent, 0) AS p_pct,
+                   COALESCE(t.est_tax_percent, 0) AS t_pct,
+                   COALESCE((SELECT SUM(total_amount) FROM tour_items WHERE tour_id=t.id AND item_type='EST'), 0) AS est_cost,
+                   COALESCE((SELECT SUM(total_amount) FROM tour_items WHERE tour_id=t.id AND item_type='ACT'), 0) AS act_cost
+            FROM tours t
+            WHERE t.start_ymd >= ? AND t.start_ymd < ? AND t.status != 'deleted'{sale_filter}
+        ), rev AS (
+            SELECT *, CASE WHEN contract_rev != 0 THEN contract_rev
+                           ELSE (est_cost + est_cost * p_pct / 100.0) * (1 + t_pct / 100.0) END AS revenue
+            FROM base
+        )
+        SELECT start_date, tour_name, revenue,
+               (CASE WHEN 1 + t_pct / 100.0 != 0 THEN revenue / (1 + t_pct / 100.0) ELSE revenue END) - act_cost AS profit
+        FROM rev ORDER BY id
+    """, tour_params)
+
+    bk_rows = run_query(f"""
+        SELECT created_at, name, COALESCE(selling_price, 0) AS revenue, COALESCE(profit, 0) AS profit
+        FROM service_bookings
+        WHERE created_at >= ? AND created_at < ? AND status != 'deleted'{sale_filter}
+        ORDER BY id
+    """, (month_start, next_month) + sale_params)
+
+    return {
+        'tours': [dict(r) for r in tour_rows],
+        'bookings': [dict(r) for r in bk_rows],
+    }
+
+register_table_write_hook(['tours', 'tour_items', 'service_bookings'], get_dashboard_data.clear)
+
 def render_dashboard():
     st.title("🏠 Trang Chủ - Tổng Quan Kinh Doanh")
     
@@ -2887,93 +4784,15 @@ def render_dashboard():
     
     st.markdown(f"### 📅 Số liệu tháng {current_month}/{current_year}")
     
-    # Data fetching
-    # 1. Tours
-    tour_query = "SELECT * FROM tours WHERE status != 'deleted'"
-    tour_params = []
-    if role == 'sale':
-        tour_query += " AND sale_name=?"
-        tour_params.append(username)
-    tours = run_query(tour_query, tuple(tour_params))
-    
-    # 2. Bookings
-    bk_query = "SELECT * FROM service_bookings WHERE status != 'deleted'"
-    bk_params = []
-    if role == 'sale':
-        bk_query += " AND sale_name=?"
-        bk_params.append(username)
-    bookings = run_query(bk_query, tuple(bk_params))
-    
-    # 3. Costs (for tours)
-    all_items = run_query("SELECT tour_id, item_type, total_amount FROM tour_items")
-    items_map = {}
-    if all_items:
-        for item in all_items:
-            tid = item['tour_id']
-            itype = item['item_type']
-            amt = item['total_amount'] or 0
-            if tid not in items_map: items_map[tid] = {'EST': 0, 'ACT': 0}
-            items_map[tid][itype] += amt
-
-    # Processing
-    total_tour_rev = 0
-    total_tour_profit = 0
-    count_tours = 0
-    tours_in_month = []
-    
-    total_bk_rev = 0
-    total_bk_profit = 0
-    count_bks = 0
-    bks_in_month = []
-    
-    # Process Tours
-    if tours:
-        for t in tours:
-            t = dict(t)
-            try:
-                s_date = datetime.strptime(t['start_date'], '%d/%m/%Y')
-                if s_date.month == current_month and s_date.year == current_year:
-                    count_tours += 1
-                    
-                    final_price = float(t.get('final_tour_price', 0) or 0)
-                    child_price = float(t.get('child_price', 0) or 0)
-                    final_qty = float(t.get('final_qty', 0) or 0)
-                    child_qty = float(t.get('child_qty', 0) or 0)
-                    if final_qty == 0: final_qty = float(t.get('guest_count', 1))
-                    
-                    rev = (final_price * final_qty) + (child_price * child_qty)
-                    
-                    costs = items_map.get(t['id'], {'EST': 0, 'ACT': 0})
-                    est_cost = costs['EST']; act_cost = costs['ACT']
-                    
-                    if rev == 0:
-                        p_pct = t.get('est_profit_percent', 0) or 0
-                        t_pct = t.get('est_tax_percent', 0) or 0
-                        profit_est_val = est_cost * (p_pct/100)
-                        rev = (est_cost + profit_est_val) * (1 + t_pct/100)
-                    
-                    t_pct = t.get('est_tax_percent', 0) or 0
-                    net_rev = rev / (1 + t_pct/100) if (1 + t_pct/100) != 0 else rev
-                    prof = net_rev - act_cost
-                    
-                    total_tour_rev += rev; total_tour_profit += prof
-                    
-                    t_display = dict(t); t_display['revenue'] = rev; t_display['profit'] = prof
-                    tours_in_month.append(t_display)
-            except: pass
-
-    # Process Bookings
-    if bookings:
-        for b in bookings:
-            try:
-                c_date = datetime.strptime(str(b['created_at']).split(' ')[0], '%Y-%m-%d')
-                if c_date.month == current_month and c_date.year == current_year:
-                    count_bks += 1
-                    rev = float(b['selling_price'] or 0); prof = float(b['profit'] or 0)
-                    total_bk_rev += rev; total_bk_profit += prof
-                    b_display = dict(b); b_display['revenue'] = rev; b_display['profit'] = prof
-                    bks_in_month.append(b_display)
-            except: pass
+    data = get_dashboard_data(role, username, current_year, current_month)
+    tours_in_month = data['tours']
+    bks_in_month = data['bookings']
+    count_tours = len(tours_in_month)
+    count_bks = len(bks_in_month)
+    total_tour_rev = sum(t['revenue'] for t in tours_in_month)
+    total_tour_profit = sum(t['profit'] for t in tours_in_month)
+    total_bk_rev = sum(b['revenue'] for b in bks_in_month)
+    total_bk_profit = sum(b['profit'] for b in bks_in_month)
 
     # Display Metrics
     m1, m2, m3, m4 = st.columns(4)
@@ -2987,18 +4806,14 @@ def render_dashboard():
     with c_left:
         st.subheader("📦 Tour trong tháng")
         if tours_in_month:
-            df_t = pd.DataFrame(tours_in_month)[['start_date', 'tour_name', 'revenue', 'profit']]
-            df_t['revenue'] = df_t['revenue'].apply(lambda x: format_vnd(x) + " VND")
-            df_t['profit'] = df_t['profit'].apply(lambda x: format_vnd(x) + " VND")
+            df_t = format_vnd_frame(pd.DataFrame(tours_in_month)[['start_date', 'tour_name', 'revenue', 'profit']], ['revenue', 'profit'], " VND")
             st.dataframe(df_t, column_config={"start_date": "Ngày đi", "tour_name": "Tên đoàn", "revenue": "Doanh thu", "profit": "Lợi nhuận (TT)"}, use_container_width=True, hide_index=True)
         else: st.info("Không có tour nào.")
             
     with c_right:
         st.subheader("🔖 Booking trong tháng")
         if bks_in_month:
-            df_b = pd.DataFrame(bks_in_month)[['created_at', 'name', 'revenue', 'profit']]
-            df_b['revenue'] = df_b['revenue'].apply(lambda x: format_vnd(x) + " VND")
-            df_b['profit'] = df_b['profit'].apply(lambda x: format_vnd(x) + " VND")
+            df_b = format_vnd_frame(pd.DataFrame(bks_in_month)[['created_at', 'name', 'revenue', 'profit']], ['revenue', 'profit'], " VND")
             st.dataframe(df_b, column_config={"created_at": "Ngày tạo", "name": "Tên dịch vụ", "revenue": "Doanh thu", "profit": "Lợi nhuận"}, use_container_width=True, hide_index=True)
         else: st.info("Không có booking nào.")
 
@@ -3212,18 +5027,19 @@ def render_login_page(comp):
 
         st.markdown("<div style='text-align: center; margin-top: 30px; color: #adb5bd; font-size: 12px;'>© 2026 Bali Tourist Platform</div>", unsafe_allow_html=True)
 
+@st.fragment
 def render_admin_notifications():
     st.divider()
     st.markdown("### 🔔 Trung Tâm Thông Báo & Phê Duyệt")
     
     # --- LẤY DỮ LIỆU CẦN DUYỆT ---
-    pending_projs = run_query("SELECT * FROM projects WHERE pending_name IS NOT NULL AND pending_name != ''")
-    pending_tours = run_query("SELECT * FROM tours WHERE pending_name IS NOT NULL AND pending_name != ''")
-    del_tours = run_query("SELECT * FROM tours WHERE request_delete=1")
-    req_edit_tours = run_query("SELECT * FROM tours WHERE request_edit_act=1")
-    pending_users = run_query("SELECT * FROM users WHERE role='user' AND status='pending'")
-    reset_requests = run_query("SELECT * FROM users WHERE COALESCE(reset_request, 0)=1")
-    req_invoices = run_query("SELECT * FROM invoices WHERE request_edit=1 AND status='active'")
+    pending_projs = run_query("SELECT * FROM projects WHERE pending_name IS NOT NULL AND pending_name != ''", cache=True)
+    pending_tours = run_query("SELECT * FROM tours WHERE pending_name IS NOT NULL AND pending_name != ''", cache=True)
+    del_tours = run_query("SELECT * FROM tours WHERE request_delete=1", cache=True)
+    req_edit_tours = run_query("SELECT * FROM tours WHERE request_edit_act=1", cache=True)
+    pending_users = run_query("SELECT * FROM users WHERE role='user' AND status='pending'", cache=True)
+    reset_requests = run_query("SELECT * FROM users WHERE COALESCE(reset_request, 0)=1", cache=True)
+    req_invoices = run_query("SELECT * FROM invoices WHERE request_edit=1 AND status='active'", cache=True)
     
     has_requests = False
 
@@ -3353,6 +5169,18 @@ def render_admin_panel(comp):
             if st.form_submit_button("Lưu"):
                 update_company_info(cn, ca, cp, ul.read() if ul else None)
                 st.success("Xong!"); time.sleep(0.5); st.rerun()
+
+        qc_stats = get_query_cache_stats()
+        qc_total = qc_stats['hit'] + qc_stats['miss']
+        st.caption(f"⚡ Cache truy vấn: {qc_stats['hit']}/{qc_total} lần dùng lại" + (f" ({qc_stats['hit'] * 100 // qc_total}%)" if qc_total else ""))
+        ms = get_mail_stats()
+        st.caption(f"📧 Email: đã gửi {ms['sent']} · lỗi {ms['failed']} · {ms['connects']} lần kết nối ({ms['reconnects']} lần nối lại) · {ms['per_second']:.1f} email/giây")
+        ds = get_document_store_stats()
+        st.caption(f"🗄️ Kho file: {ds['docs']} file · {ds['stored'] / 1048576:.1f} MB trên đĩa (gốc {ds['size'] / 1048576:.1f} MB) · "
+                   f"tiết kiệm nhờ trùng lặp {ds['dedup_saved'] / 1048576:.1f} MB · {ds['unreferenced'] or 0} file chờ dọn")
+        if st.button("🧹 Dọn file không dùng", use_container_width=True):
+            removed, freed = gc_documents(sweep_orphans=True)
+            st.toast(f"Đã xóa {removed} file, giải phóng {freed / 1048576:.1f} MB")
         
         # Chỉ admin chính mới thấy mục xóa
         if (st.session_state.user_info or {}).get('role') == 'admin':
@@ -3364,11 +5192,7 @@ def render_admin_panel(comp):
                 if st.button("Xóa Hóa Đơn", use_container_width=True, help="Xóa TOÀN BỘ dữ liệu Hóa đơn & UNC"):
                     run_query("DELETE FROM invoices", commit=True)
                     run_query("DELETE FROM sqlite_sequence WHERE name='invoices'", commit=True)
-                    if os.path.exists(UPLOAD_FOLDER):
-                        for f in os.listdir(UPLOAD_FOLDER):
-                            if "UNC" not in f and "converted" not in f: 
-                                    try: os.remove(os.path.join(UPLOAD_FOLDER, f))
-                                    except: pass
+                    gc_documents()  # Trigger đã hạ refcount; vẫn giữ khoảng ân hạn cho blob của hóa đơn đang lưu dở
                     st.toast("Đã xóa sạch Hóa Đơn!"); time.sleep(1); st.rerun()
                 
                 if st.button("Xóa Tour", use_container_width=True, help="Xóa TOÀN BỘ dữ liệu Tour (Dự toán và Quyết toán)"):
@@ -3403,10 +5227,9 @@ def render_admin_panel(comp):
                         for table in TABLES_TO_DELETE:
                             run_query(f"DELETE FROM {table}", commit=True)
                             run_query(f"DELETE FROM sqlite_sequence WHERE name='{table}'", commit=True)
-                        if os.path.exists(UPLOAD_FOLDER):
-                            for f in os.listdir(UPLOAD_FOLDER):
-                                try: os.remove(os.path.join(UPLOAD_FOLDER, f))
-                                except: pass
+                        run_query("DELETE FROM documents", commit=True)
+                        shutil.rmtree(UPLOAD_FOLDER, ignore_errors=True)
+                        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
                     st.success("Đã xóa toàn bộ dữ liệu kinh doanh và các file đã upload!")
                     time.sleep(2); st.rerun()
 
@@ -3482,6 +5305,180 @@ def render_sidebar(comp):
     return module, menu
 
 # --- HÀM HIỂN THỊ SO SÁNH CHI PHÍ (UNC vs HÓA ĐƠN) ---
+# --- [NEW] ĐỐI SOÁT UNC <-> HÓA ĐƠN ---
+# Ghép theo số tiền (sai lệch <= RECON_AMOUNT_TOLERANCE), khoảng ngày và độ giống tên đơn vị nhận tiền / bên bán.
+# Lượt 1: 1 UNC = 1 HĐ. Lượt 2: 1 UNC trả nhiều HĐ, lượt 3: nhiều UNC trả 1 HĐ (subset-sum có cắt nhánh).
+# Chỉ xét chứng từ còn dư chưa ghép -> chạy lại sau mỗi chứng từ mới chỉ tốn phần mới; liên kết 'manual' không bao giờ bị ghi đè.
+RECON_DATE_WINDOW_DAYS = 45
+RECON_AMOUNT_TOLERANCE = 1000
+RECON_MIN_SELLER_SIM = 0.3
+RECON_MAX_CANDIDATES = 24      # số HĐ/UNC ứng viên tối đa cho 1 bài toán subset-sum
+RECON_MAX_SUBSET = 6           # 1 UNC trả tối đa 6 HĐ (và ngược lại)
+RECON_MAX_NODES = 20000        # giới hạn số nút duyệt cho 1 bài toán
+_RECON_STOPWORDS = {'cong', 'ty', 'cty', 'ctcp', 'tnhh', 'cp', 'co', 'phan', 'mtv', 'mot', 'thanh', 'vien', 'chi', 'nhanh',
+                    'dich', 'vu', 'dv', 'thuong', 'mai', 'tm', 'va', 'hh', 'and', 'company', 'ltd', 'jsc'}
+_RECON_UNC_SQL = "(i.memo LIKE '[UNC]%' OR UPPER(COALESCE(i.invoice_number, '')) LIKE '%UNC%')"
+
+def _recon_date(text):
+    """Ngày chứng từ (dd/mm/yyyy, yyyy-mm-dd...) -> ordinal, không đọc được -> None"""
+    text = str(text or "").strip()[:10]
+    for fmt in ('%d/%m/%Y', '%Y-%m-%d', '%d-%m-%Y', '%d.%m.%Y'):
+        try: return datetime.strptime(text, fmt).toordinal()
+        except ValueError: pass
+    return None
+
+def _seller_tokens(name):
+    return frozenset(t for t in re.split(r'[^0-9a-z]+', fold_vn(name or '')) if t and t not in _RECON_STOPWORDS)
+
+def seller_similarity(a, b):
+    """Độ giống 2 tập từ khóa tên đơn vị (Jaccard; tên này chứa trọn tên kia -> tối thiểu 0.8). Thiếu tên -> None"""
+    if not a or not b: return None
+    inter = len(a & b)
+    if not inter: return 0.0
+    sim = inter / len(a | b)
+    return max(sim, 0.8) if inter == min(len(a), len(b)) else sim
+
+def _recon_pair_score(unc, inv):
+    """Điểm ghép 1 cặp (0..1) hoặc None nếu loại (lệch ngày quá khoảng / tên khác hẳn)"""
+    date_score = 0.5
+    if unc['date'] is not None and inv['date'] is not None:
+        gap = abs(unc['date'] - inv['date'])
+        if gap > RECON_DATE_WINDOW_DAYS: return None
+        date_score = 1 - gap / (RECON_DATE_WINDOW_DAYS + 1)
+    sim = seller_similarity(unc['tokens'], inv['tokens'])
+    if sim is not None and sim < RECON_MIN_SELLER_SIM: return None
+    score = 0.6 * (0.5 if sim is None else sim) + 0.4 * date_score
+    if unc.get('cost_code') and unc.get('cost_code') == inv.get('cost_code'): score = min(1.0, score + 0.1)
+    return round(score, 3)
+
+def subset_sum_match(target, items, tolerance=RECON_AMOUNT_TOLERANCE, max_size=RECON_MAX_SUBSET, max_nodes=RECON_MAX_NODES):
+    """Tìm ít phần tử nhất trong items [(key, amount)] có tổng = target (± tolerance); items nên xếp theo độ ưu tiên.
+    Tăng dần số phần tử (2, 3, ...); cắt nhánh khi vượt target hoặc phần còn lại không đủ. Trả về list key hoặc None."""
+    items = [(k, a) for k, a in items if 0 < a <= target + tolerance]
+    n = len(items)
+    suffix = [0.0] * (n + 1)
+    for i in range(n - 1, -1, -1): suffix[i] = suffix[i + 1] + items[i][1]
+    if suffix[0] < target - tolerance: return None
+    budget = [max_nodes]
+
+    def dfs(start, remaining, slots, picked):
+        if abs(remaining) <= tolerance: return list(picked) if slots == 0 else None
+        if slots == 0 or budget[0] <= 0: return None
+        for i in range(start, n - slots + 1):
+            budget[0] -= 1
+            if budget[0] <= 0: return None
+            if suffix[i] < remaining - tolerance: return None  # phần còn lại cộng hết vẫn không đủ
+            amount = items[i][1]
+            if amount > remaining + tolerance: continue
+            picked.append(items[i][0])
+            found = dfs(i + 1, remaining - amount, slots - 1, picked)
+            picked.pop()
+            if found: return found
+        return None
+
+    for size in range(2, min(max_size, n) + 1):
+        found = dfs(0, target, size, [])
+        if found: return found
+        if budget[0] <= 0: break
+    return None
+
+def match_unc_invoices(uncs, invoices, blocked=frozenset()):
+    """Lõi đối soát (không đụng DB). uncs/invoices: [{'id', 'amount' (còn lại), 'date' (ordinal|None), 'tokens', 'cost_code'}],
+    blocked: các cặp (unc_id, invoice_id) người dùng đã bỏ. Trả về [(unc_id, invoice_id, amount, score)]"""
+    links = []
+    open_inv = {d['id']: d for d in invoices if d['amount'] > RECON_AMOUNT_TOLERANCE}
+    open_unc = {d['id']: d for d in uncs if d['amount'] > RECON_AMOUNT_TOLERANCE}
+
+    # Lượt 1: 1-1 cùng số tiền, tra theo "ngăn" số tiền (bội số của sai lệch cho phép)
+    step = max(RECON_AMOUNT_TOLERANCE, 1)
+    buckets = {}
+    for inv in open_inv.values(): buckets.setdefault(round(inv['amount'] / step), []).append(inv)
+    for unc in sorted(open_unc.values(), key=lambda d: (d['date'] is None, d['date'] or 0)):
+        k = round(unc['amount'] / step)
+        best, best_score = None, -1
+        for inv in buckets.get(k - 1, []) + buckets.get(k, []) + buckets.get(k + 1, []):
+            if inv['id'] not in open_inv or abs(inv['amount'] - unc['amount']) > RECON_AMOUNT_TOLERANCE: continue
+            if (unc['id'], inv['id']) in blocked: continue
+            score = _recon_pair_score(unc, inv)
+            if score is not None and score > best_score: best, best_score = inv, score
+        if best:
+            links.append((unc['id'], best['id'], min(unc['amount'], best['amount']), best_score))
+            del open_inv[best['id']], open_unc[unc['id']]
+
+    # Lượt 2 & 3: subset-sum trong cửa sổ ngày (danh sách xếp theo ngày + bisect, chứng từ không ngày luôn là ứng viên)
+    def window_index(docs):
+        dated = sorted((d for d in docs if d['date'] is not None), key=lambda d: d['date'])
+        return [d['date'] for d in dated], dated, [d for d in docs if d['date'] is None]
+
+    def candidates(anchor, pool, index, anchor_is_unc):
+        keys, dated, undated = index
+        if anchor['date'] is None: cands = dated + undated
+        else:
+            lo = bisect.bisect_left(keys, anchor['date'] - RECON_DATE_WINDOW_DAYS)
+            hi = bisect.bisect_right(keys, anchor['date'] + RECON_DATE_WINDOW_DAYS)
+            cands = dated[lo:hi] + undated
+        scored = []
+        for d in cands:
+            if d['id'] not in pool or d['amount'] > anchor['amount'] + RECON_AMOUNT_TOLERANCE: continue
+            if ((anchor['id'], d['id']) if anchor_is_unc else (d['id'], anchor['id'])) in blocked: continue
+            score = _recon_pair_score(anchor, d)
+            if score is not None: scored.append((score, d))
+        scored.sort(key=lambda x: -x[0])
+        return scored[:RECON_MAX_CANDIDATES]
+
+    for anchors, pool, anchor_is_unc in ((open_unc, open_inv, True), (open_inv, open_unc, False)):
+        index = window_index(list(pool.values()))
+        for anchor in sorted(anchors.values(), key=lambda d: -d['amount']):
+            if anchor['id'] not in anchors: continue
+            scored = candidates(anchor, pool, index, anchor_is_unc)
+            picked = subset_sum_match(anchor['amount'], [(d['id'], d['amount']) for _, d in scored])
+            if not picked: continue
+            scores = {d['id']: s for s, d in scored}
+            for pid in picked:
+                pair = (anchor['id'], pid) if anchor_is_unc else (pid, anchor['id'])
+                links.append(pair + (pool[pid]['amount'], scores[pid]))
+                del pool[pid]
+            del anchors[anchor['id']]
+    return links
+
+def load_open_recon_documents(conn, cost_code=None):
+    """UNC và hóa đơn đầu vào còn số dư chưa ghép (theo mã chi phí hoặc toàn bộ)"""
+    cond, params = ("AND i.cost_code = ?", (cost_code,)) if cost_code else ("", ())
+    rows = conn.execute(f"""
+        SELECT i.id, i.date, i.seller_name, i.cost_code, {_RECON_UNC_SQL} AS is_unc,
+               COALESCE(i.total_amount, 0) - COALESCE(CASE WHEN {_RECON_UNC_SQL}
+                   THEN (SELECT SUM(l.amount) FROM unc_invoice_links l WHERE l.unc_id = i.id)
+                   ELSE (SELECT SUM(l.amount) FROM unc_invoice_links l WHERE l.invoice_id = i.id) END, 0) AS remaining
+        FROM invoices i WHERE i.type = 'IN' AND i.status = 'active' {cond}
+    """, params).fetchall()
+    uncs, invoices = [], []
+    for r in rows:
+        if r['remaining'] <= RECON_AMOUNT_TOLERANCE: continue
+        doc = {'id': r['id'], 'amount': r['remaining'], 'date': _recon_date(r['date']), 'tokens': _seller_tokens(r['seller_name']), 'cost_code': r['cost_code']}
+        (uncs if r['is_unc'] else invoices).append(doc)
+    return uncs, invoices
+
+def reconcile_unc_invoices(cost_code=None, conn=None):
+    """Đối soát tăng dần cho 1 mã chi phí (hoặc toàn bộ khi cost_code=None), lưu liên kết mới. Trả về số liệu lần chạy"""
+    own_conn = conn is None
+    conn = conn or get_connection()
+    t0 = time.perf_counter()
+    uncs, invoices = load_open_recon_documents(conn, cost_code)
+    blocked = frozenset((r[0], r[1]) for r in conn.execute(
+        "SELECT unc_id, invoice_id FROM unc_invoice_links WHERE method = 'rejected'" + (" AND cost_code = ?" if cost_code else ""), (cost_code,) if cost_code else ()))
+    t1 = time.perf_counter()
+    links = match_unc_invoices(uncs, invoices, blocked)
+    t2 = time.perf_counter()
+    if links:
+        now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with conn:
+            conn.executemany("""INSERT OR IGNORE INTO unc_invoice_links (unc_id, invoice_id, amount, score, method, cost_code, created_at)
+                SELECT ?, ?, ?, ?, 'auto', cost_code, ? FROM invoices WHERE id = ?""",
+                [(u, i, a, s, now_str, i) for u, i, a, s in links])
+        if own_conn: notify_table_write('unc_invoice_links')
+    return {'uncs': len(uncs), 'invoices': len(invoices), 'links': len(links),
+            'load_ms': (t1 - t0) * 1000, 'match_ms': (t2 - t1) * 1000, 'total_ms': (time.perf_counter() - t0) * 1000}
+
 def render_cost_comparison(code):
     # Lấy tất cả hóa đơn/UNC theo mã
     docs = run_query("SELECT * FROM invoices WHERE cost_code=? AND status='active'", (code,))
@@ -3520,16 +5517,59 @@ def render_cost_comparison(code):
         c3.error(f"⚠️ Thiếu UNC: {format_vnd(abs(diff))}")
         
     # Bảng chi tiết
-    t1, t2 = st.tabs(["📄 Danh sách Hóa Đơn", "💸 Danh sách UNC"])
+    t1, t2, t3 = st.tabs(["📄 Danh sách Hóa Đơn", "💸 Danh sách UNC", "🔗 Đối soát UNC ↔ HĐ"])
     with t1:
         st.dataframe(df_bills[['date', 'invoice_number', 'seller_name', 'total_amount', 'memo']], 
                      column_config={"total_amount": st.column_config.NumberColumn("Số tiền", format="%d")}, use_container_width=True, hide_index=True)
     with t2:
         st.dataframe(df_uncs[['date', 'invoice_number', 'seller_name', 'total_amount', 'memo']], 
                      column_config={"total_amount": st.column_config.NumberColumn("Số tiền", format="%d")}, use_container_width=True, hide_index=True)
+    with t3:
+        render_unc_reconciliation(code)
         
     return total_bills
 
+def render_unc_reconciliation(code):
+    """[NEW] Kết quả đối soát UNC <-> Hóa đơn của 1 mã: các cặp đã ghép, chứng từ còn dư, chạy lại / bỏ liên kết"""
+    c_run, c_info = st.columns([1, 3])
+    if c_run.button("⚙️ Đối soát tự động", key=f"recon_run_{code}"):
+        stats = reconcile_unc_invoices(code)
+        st.toast(f"Ghép thêm {stats['links']} cặp ({stats['total_ms']:.0f} ms)")
+
+    links = run_query("""SELECT l.id, l.amount, l.score, l.method,
+            u.date AS unc_date, u.invoice_number AS unc_number, u.seller_name AS unc_seller,
+            i.date AS inv_date, i.invoice_number AS inv_number, i.seller_name AS inv_seller, i.total_amount AS inv_total
+        FROM unc_invoice_links l JOIN invoices u ON u.id = l.unc_id JOIN invoices i ON i.id = l.invoice_id
+        WHERE l.cost_code = ? AND l.method != 'rejected' ORDER BY l.unc_id, l.invoice_id""", (code,))
+    uncs, invoices = load_open_recon_documents(get_connection(), code)
+    c_info.caption(f"🔗 {len(links)} cặp đã ghép · {len(invoices)} hóa đơn & {len(uncs)} UNC còn dư chưa ghép")
+
+    if links:
+        df_links = pd.DataFrame([dict(r) for r in links])
+        df_links['method'] = df_links['method'].map({'auto': '🤖 Tự động', 'manual': '✋ Thủ công'}).fillna(df_links['method'])
+        df_links = df_links[['id', 'unc_date', 'unc_number', 'unc_seller', 'inv_date', 'inv_number', 'inv_seller', 'inv_total', 'amount', 'score', 'method']]
+        df_links.columns = ['ID', 'Ngày UNC', 'Số UNC', 'Đơn vị nhận', 'Ngày HĐ', 'Số HĐ', 'Bên bán', 'Tổng HĐ', 'Phân bổ', 'Độ tin cậy', 'Cách ghép']
+        st.dataframe(df_links, hide_index=True, use_container_width=True,
+                     column_config={"Tổng HĐ": st.column_config.NumberColumn(format="%d"), "Phân bổ": st.column_config.NumberColumn(format="%d"),
+                                    "Độ tin cậy": st.column_config.ProgressColumn(min_value=0, max_value=1, format="%.2f")})
+        c_sel, c_btn = st.columns([3, 1])
+        unlink_ids = c_sel.multiselect("Bỏ liên kết sai", df_links['ID'].tolist(), key=f"recon_unlink_{code}", label_visibility="collapsed", placeholder="Chọn ID liên kết ghép sai...")
+        if c_btn.button("✂️ Bỏ liên kết", key=f"recon_unlink_btn_{code}", disabled=not unlink_ids):
+            # Giữ lại dòng 'rejected' (số tiền 0) để lần đối soát sau không ghép lại đúng cặp này
+            run_query_many("UPDATE unc_invoice_links SET method='rejected', amount=0 WHERE id=?", [(i,) for i in unlink_ids])
+            st.rerun()
+
+    if uncs or invoices:
+        left = run_query(f"""SELECT id, date, invoice_number, seller_name, total_amount FROM invoices
+            WHERE id IN ({','.join('?' * (len(uncs) + len(invoices)))}) ORDER BY date""", [d['id'] for d in uncs + invoices])
+        remaining = {d['id']: d['amount'] for d in uncs + invoices}
+        unc_ids = {d['id'] for d in uncs}
+        df_left = pd.DataFrame([{'Loại': '💸 UNC' if r['id'] in unc_ids else '📄 Hóa đơn', 'Ngày': r['date'], 'Số': r['invoice_number'],
+                                 'Đơn vị': r['seller_name'], 'Tổng': r['total_amount'], 'Còn dư chưa ghép': remaining[r['id']]} for r in left])
+        st.markdown("**Chưa ghép được**")
+        st.dataframe(df_left, hide_index=True, use_container_width=True,
+                     column_config={"Tổng": st.column_config.NumberColumn(format="%d"), "Còn dư chưa ghép": st.column_config.NumberColumn(format="%d")})
+
 def render_cost_control(menu):
     if menu == "1. Nhập Hóa Đơn":
         # 1. Logic Nhập UNC mặc định là Đầu vào (Nhưng Type IN)
@@ -3590,7 +5630,7 @@ def render_cost_control(menu):
                     if st.button("🔄 CHUYỂN ĐỔI SANG PDF (ĐỂ LƯU TRỮ)", type="secondary", width="stretch"):
                         with st.spinner("Đang chuyển đổi..."):
                             uploaded_file.seek(0)
-                            converted_bytes = convert_image_to_pdf(uploaded_file)
+                            converted_bytes = convert_image_to_pdf(uploaded_file, target_dpi=IMAGE_PDF_TARGET_DPI)
                             if converted_bytes:
                                 st.session_state.ready_pdf_bytes = converted_bytes
                                 st.success("Đã convert xong!")
@@ -3641,12 +5681,12 @@ def render_cost_control(menu):
                     if user_role_cost == 'sale' and user_name_cost:
                         tour_query += " AND sale_name=?"
                         tour_params.append(user_name_cost)
-                    active_tours = run_query(tour_query, tuple(tour_params))
+                    active_tours = run_query(tour_query, tuple(tour_params), cache=True)
                     tour_choices = {f"[{t['tour_code']}] {t['tour_name']}": t['tour_code'] for t in active_tours} if active_tours else {} # type: ignore
                     tour_choices = {f"📦 TOUR: [{t['tour_code']}] {t['tour_name']}": t['tour_code'] for t in active_tours} if active_tours else {} # type: ignore
                     
                     # Lấy danh sách các mã Cost Code đã tồn tại (từ UNC hoặc Hóa đơn trước đó) để Hóa đơn chọn lại
-                    existing_codes_query = run_query("SELECT DISTINCT cost_code FROM invoices WHERE cost_code IS NOT NULL AND cost_code != ''")
+                    existing_codes_query = run_query("SELECT DISTINCT cost_code FROM invoices WHERE cost_code IS NOT NULL AND cost_code != ''", cache=True)
                     existing_codes = [r['cost_code'] for r in existing_codes_query] if existing_codes_query else [] # type: ignore
                     
                     # Lấy danh sách Booking Dịch Vụ (Lọc theo sale nếu cần)
@@ -3813,6 +5853,10 @@ def render_cost_control(menu):
                             if doc_type == "Hóa đơn" and (not date or not num): st.error("Ơ kìa, thiếu ngày hoặc số hóa đơn rồi!")
                             elif doc_type == "Ủy nhiệm chi " and not date: st.error("Thiếu ngày chuyển khoản rồi nè!")
                             elif not st.session_state.edit_lock: st.warning("Bấm 'Chốt giá' trước khi lưu nha!")
+                            elif warn_duplicate_invoice(
+                                    invoice_fingerprint(num, sym, seller, total) if doc_type == "Hóa đơn" else None,
+                                    hashlib.sha256(st.session_state.ready_pdf_bytes or uploaded_file.getvalue()).hexdigest()):
+                                pass  # [NEW] Đã cảnh báo trùng -> bấm lưu lần nữa để vẫn lưu
                             else:
                                 # --- CHUẨN BỊ DỮ LIỆU ---
                                 t = 'OUT' if "Đầu ra" in typ else 'IN'
@@ -3841,6 +5885,14 @@ def render_cost_control(menu):
                                 #     else:
                                 #         drive_link = upload_to_drive(uploaded_file, final_name)
                                 
+                                # 1b. [NEW] Lưu file vào kho tài liệu (cùng nội dung -> dùng chung 1 blob)
+                                doc_hash = None
+                                try:
+                                    file_bytes = st.session_state.ready_pdf_bytes or uploaded_file.getvalue()
+                                    if file_bytes: doc_hash = store_document(file_bytes, final_name)
+                                except Exception as e:
+                                    st.warning(f"Không lưu được file gốc: {e}")
+
                                 # 2. Chuẩn bị dữ liệu để lưu
                                 new_invoice = {
                                     'type': t, 
@@ -3857,6 +5909,7 @@ def render_cost_control(menu):
                                     'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                                     'memo': save_memo,
                                     'file_path': drive_link, 
+                                    'doc_hash': doc_hash,
                                     'cost_code': selected_cost_code,
                                     'edit_count': st.session_state.local_edit_count,
                                     'request_edit': 1 if is_locked_admin else 0
@@ -3865,6 +5918,10 @@ def render_cost_control(menu):
                                 # 3. Ghi vào Sheet 'invoices'
                                 if add_row_to_table('invoices', new_invoice):
                                     st.success("Đã lưu thành công lên Cloud! 🎉")
+                                    # [NEW] Ghép UNC <-> HĐ cho mã này (chỉ xét chứng từ còn dư -> nhanh)
+                                    if selected_cost_code and t == 'IN':
+                                        try: reconcile_unc_invoices(selected_cost_code)
+                                        except Exception as e: print(f"Lỗi đối soát: {e}")
                                     
                                     # Reset state
                                     time.sleep(1)
@@ -3882,7 +5939,13 @@ def render_cost_control(menu):
         st.divider()
         # --- 4. LỊCH SỬ NHẬP LIỆU (HIỆN TẤT CẢ NHƯNG CÓ NOTE) ---
         with st.expander("Lịch sử nhập liệu", expanded=True):
-            rows = run_query("SELECT id, type, invoice_number, total_amount, status, memo, request_edit, edit_count, cost_code FROM invoices ORDER BY id DESC LIMIT 20")
+            inv_conds, inv_params = list_filter_controls("inv_hist", "invoices", period_col="created_at", status_options={
+                "Tất cả": None,
+                "Hoạt động": ("status='active'", []),
+                "Chờ duyệt sửa": ("request_edit=1", []),
+                "Đã xóa": ("status='deleted'", []),
+            })
+            rows = keyset_paginator("inv_hist", "invoices", "id, type, invoice_number, total_amount, status, memo, request_edit, edit_count, cost_code", inv_conds, inv_params)
             if rows:
                 df = pd.DataFrame([dict(r) for r in rows])
                 df['Chọn'] = False 
@@ -3936,136 +5999,40 @@ def render_cost_control(menu):
                         st.warning("Bạn chưa chọn mục nào cả.")
             else:
                 st.info("Chưa có hóa đơn nào.")
+
+            # [NEW] Quét trùng lặp toàn bộ dữ liệu cũ (admin)
+            if st.session_state.user_info and st.session_state.user_info.get('role') in ['admin', 'admin_f1']:
+                if st.button("🔍 Quét hóa đơn / UNC trùng lặp", key="inv_dup_scan"):
+                    st.session_state.inv_dup_scan = scan_duplicate_invoices()
+                dup_df = st.session_state.get('inv_dup_scan')
+                if dup_df is not None:
+                    if dup_df.empty:
+                        st.success("Không phát hiện chứng từ trùng.")
+                    else:
+                        st.warning(f"Phát hiện {len(dup_df)} nhóm trùng ({int(dup_df['n'].sum())} chứng từ). Lọc theo ID ở trên để rà soát / xóa.")
+                        show_df = dup_df.drop(columns=['k']).copy()
+                        show_df['total_amount'] = show_df['total_amount'].apply(format_vnd)
+                        show_df.columns = ['Kiểu trùng', 'Số lượng', 'ID', 'Số HĐ', 'Bên bán', 'Tổng tiền']
+                        st.dataframe(show_df, hide_index=True, use_container_width=True)
     elif menu == "2. Báo Cáo Tổng Hợp":
         st.title("📊 Báo Cáo Tài Chính")
 
-        all_financial_records = []
-        with st.spinner("Đang tổng hợp dữ liệu từ tất cả các phân hệ..."):
-            # --- OPTIMIZED DATA FETCHING ---
-            # Lọc booking theo sale nếu cần
-            user_info_rpt = st.session_state.get("user_info", {})
-            user_role_rpt = user_info_rpt.get('role')
-            user_name_rpt = user_info_rpt.get('name')
-
-            # 1. Fetch all base data in a few queries
-            tour_rpt_query = "SELECT * FROM tours WHERE status != 'deleted'"
-            tour_rpt_params = []
-            if user_role_rpt == 'sale' and user_name_rpt:
-                tour_rpt_query += " AND sale_name=?"
-                tour_rpt_params.append(user_name_rpt)
-            all_tours = run_query(tour_rpt_query, tuple(tour_rpt_params))
-            
-            bk_rpt_query = "SELECT * FROM service_bookings WHERE status != 'deleted'"
-            bk_rpt_params = []
-            if user_role_rpt == 'sale' and user_name_rpt:
-                bk_rpt_query += " AND sale_name=?"
-                bk_rpt_params.append(user_name_rpt)
-            all_bookings = run_query(bk_rpt_query, tuple(bk_rpt_params))
-
-            all_linked_invoices = run_query("SELECT cost_code, type, invoice_number, total_amount FROM invoices WHERE status='active' AND request_edit=0 AND cost_code IS NOT NULL AND cost_code != ''")
-            # [NEW] Fetch all transactions for debt calculation
-            all_transactions = run_query("SELECT ref_code, type, amount FROM transaction_history")
-
-            # 2. Process data in memory using dictionaries for fast lookups
-            invoice_costs_by_code = {}
-            for inv in all_linked_invoices:
-                code = inv['cost_code']
-                if code not in invoice_costs_by_code:
-                    invoice_costs_by_code[code] = {'IN_INV': 0, 'IN_UNC': 0}
-                if inv['type'] == 'IN':
-                    is_unc = 'UNC' in (inv.get('invoice_number') or '') # type: ignore
-                    if is_unc:
-                        invoice_costs_by_code[code]['IN_UNC'] += inv['total_amount'] # type: ignore
-                    else:
-                        invoice_costs_by_code[code]['IN_INV'] += inv['total_amount'] # type: ignore
-            
-            # [NEW] Process transactions to get paid amounts
-            paid_amounts = {}
-            if all_transactions:
-                df_txns = pd.DataFrame([dict(r) for r in all_transactions])
-                if not df_txns.empty:
-                    df_thu = df_txns[df_txns['type'] == 'THU'].groupby('ref_code')['amount'].sum()
-                    df_chi = df_txns[df_txns['type'] == 'CHI'].groupby('ref_code')['amount'].sum() # CHI means refund
-                    paid_amounts = (df_thu.subtract(df_chi, fill_value=0)).to_dict()
-
-            # --- Process Tours ---
-            if all_tours:
-                for tour_row in all_tours:
-                    tour = dict(tour_row)
-                    # [NEW] Add status to record
-                    tour_status = tour.get('status', 'running')
-                    revenue, cost = get_tour_financials(tour['id'], tour)
-                    if revenue > 0: all_financial_records.append({'date_str': tour['start_date'], 'name': tour['tour_name'], 'code': tour['tour_code'], 'category': 'Tour', 'type': 'thu', 'amount': revenue, 'status': tour_status}) # type: ignore
-                    if cost > 0: all_financial_records.append({'date_str': tour['start_date'], 'name': tour['tour_name'], 'code': tour['tour_code'], 'category': 'Tour', 'type': 'chi', 'amount': cost, 'status': tour_status}) # type: ignore
-
-            # --- Process Service Bookings ---
-            if all_bookings:
-                for booking_row in all_bookings:
-                    booking = dict(booking_row)
-                    
-                    # [FIX] Chuyển đổi định dạng ngày YYYY-MM-DD sang DD/MM/YYYY để đồng bộ
-                    try:
-                        booking_date_obj = datetime.strptime(str(booking['created_at']).split(" ")[0], '%Y-%m-%d')
-                        booking_date_str = booking_date_obj.strftime('%d/%m/%Y')
-                    except:
-                        booking_date_str = booking['created_at']
-                    # [NEW] Add status to record
-                    booking_status = booking.get('status', 'active')
+        user_info_rpt = st.session_state.get("user_info", {})
+        user_role_rpt = user_info_rpt.get('role')
+        user_name_rpt = user_info_rpt.get('name')
 
-                    if booking.get('selling_price', 0) > 0:
-                        all_financial_records.append({'date_str': booking_date_str, 'name': booking['name'], 'code': booking['code'], 'category': 'Booking Dịch Vụ', 'type': 'thu', 'amount': booking['selling_price'], 'status': booking_status}) # type: ignore
-                    
-                    # [FIX] Chỉ tính chi phí từ hóa đơn (IN_INV), không tính UNC để tránh double-count.
-                    # UNC là thanh toán cho chi phí, không phải bản thân chi phí.
-                    total_cost_booking = invoice_costs_by_code.get(booking['code'], {}).get('IN_INV', 0)
-                    if total_cost_booking == 0 and booking.get('net_price', 0) > 0:
-                        total_cost_booking = booking['net_price'] # type: ignore
-                    if total_cost_booking > 0:
-                        all_financial_records.append({'date_str': booking_date_str, 'name': booking['name'], 'code': booking['code'], 'category': 'Booking Dịch Vụ', 'type': 'chi', 'amount': total_cost_booking, 'status': booking_status}) # type: ignore
-
-            # --- Process old Projects & Unlinked Invoices (These queries are already efficient) ---
-            project_invoices = run_query("SELECT p.project_name, i.type, i.total_amount, i.date, p.id as project_id FROM projects p JOIN project_links l ON p.id = l.project_id JOIN invoices i ON l.invoice_id = i.id WHERE i.status = 'active' AND i.request_edit = 0")
-            if project_invoices:
-                for inv in project_invoices:
-                    all_financial_records.append({'date_str': inv['date'], 'name': inv['project_name'], 'code': f"PROJ_{inv['project_id']}", 'category': 'Dự án (cũ)', 'type': 'thu' if inv['type'] == 'OUT' else 'chi', 'amount': inv['total_amount'], 'status': 'N/A'}) # type: ignore
-
-            unlinked_invoices = run_query("SELECT * FROM invoices i WHERE i.status = 'active' AND i.request_edit = 0 AND (i.cost_code IS NULL OR i.cost_code = '') AND NOT EXISTS (SELECT 1 FROM project_links pl WHERE pl.invoice_id = i.id)")
-            if unlinked_invoices:
-                for inv in unlinked_invoices:
-                    all_financial_records.append({'date_str': inv['date'], 'name': inv['memo'] or inv['seller_name'] or 'Chi phí chung', 'code': f"INV_{inv['id']}", 'category': 'Chi phí chung', 'type': 'thu' if inv['type'] == 'OUT' else 'chi', 'amount': inv['total_amount'], 'status': 'N/A'}) # type: ignore
-
-        if not all_financial_records:
+        # [NEW] Chỉ tính lại các mã có thay đổi kể từ lần xem trước (report_cube)
+        with st.spinner("Đang cập nhật dữ liệu báo cáo..."):
+            refresh_report_cube()
+        periods = get_report_periods(user_role_rpt, user_name_rpt)
+
+        if not periods["Tháng"]:
             st.info("Chưa có dữ liệu tài chính để báo cáo.")
         else:
-            df = pd.DataFrame(all_financial_records)
-            df['date'] = pd.to_datetime(df['date_str'], errors='coerce', dayfirst=True)
-            df['status'] = df['status'].fillna('N/A') # Đảm bảo cột status không có giá trị null
-            df = df.dropna(subset=['date'])
-
-            # Explicitly create a DatetimeIndex to help Pylance with type inference
-            dt_index = pd.DatetimeIndex(df['date'])
-            df['year'] = dt_index.year
-            df['quarter'] = dt_index.quarter
-            df['month_year'] = dt_index.to_period('M').astype(str)
-            df['quarter_year'] = df.apply(lambda row: f"Q{row['quarter']}/{row['year']}", axis=1)
-
             st.markdown("####  Lọc báo cáo")
             c1, c2, c3 = st.columns(3)
             filter_type = c1.selectbox("Lọc theo thời gian:", ["Tháng", "Quý", "Năm"])
-            
-            options = []
-            period_col = ''
-            if filter_type == "Tháng":
-                options = sorted(df['month_year'].unique(), reverse=True)
-                period_col = 'month_year'
-            elif filter_type == "Quý":
-                options = sorted(df['quarter_year'].unique(), reverse=True)
-                period_col = 'quarter_year'
-            elif filter_type == "Năm":
-                options = sorted(df['year'].unique(), reverse=True)
-                period_col = 'year'
-                
-            selected_period = c2.selectbox(f"Chọn kỳ:", ["Tất cả"] + options)
+            selected_period = c2.selectbox(f"Chọn kỳ:", ["Tất cả"] + periods[filter_type])
 
             # [NEW] Thêm bộ lọc trạng thái
             status_map = {
@@ -4075,28 +6042,13 @@ def render_cost_control(menu):
             }
             selected_status_label = c3.selectbox("Lọc theo trạng thái:", list(status_map.keys()))
             selected_statuses = status_map[selected_status_label]
+            rpt_filter = (user_role_rpt, user_name_rpt, filter_type, selected_period, selected_statuses)
 
-            # Áp dụng các bộ lọc
-            df_filtered = df.copy()
-            if selected_period != "Tất cả":
-                df_filtered = df_filtered[df_filtered[period_col] == selected_period]
-            
-            if selected_statuses:
-                # Chỉ lọc các mục có trạng thái (Tour/Booking), giữ lại các mục khác (Chi phí chung...)
-                mask = df_filtered['status'].isin(selected_statuses) | (df_filtered['status'] == 'N/A')
-                df_filtered = df_filtered[mask]
-
-            if not df_filtered.empty:
-                agg = df_filtered.pivot_table(index=['category', 'name', 'code'], columns='type', values='amount', aggfunc='sum').fillna(0)
-                agg = agg.reset_index()
-                
-                if 'thu' not in agg.columns: agg['thu'] = 0
-                if 'chi' not in agg.columns: agg['chi'] = 0
-                agg['lợi nhuận'] = agg['thu'] - agg['chi']
-                
-                total_thu = agg['thu'].sum()
-                total_chi = agg['chi'].sum()
-                total_loi_nhuan = agg['lợi nhuận'].sum()
+            category_totals = get_report_category_totals(*rpt_filter)
+            if not category_totals.empty:
+                total_thu = category_totals['thu'].sum()
+                total_chi = category_totals['chi'].sum()
+                total_loi_nhuan = category_totals['lợi nhuận'].sum()
                 
                 m1, m2, m3 = st.columns(3)
                 m1.metric(f"Tổng Thu ({selected_period})", format_vnd(total_thu))
@@ -4106,13 +6058,40 @@ def render_cost_control(menu):
                 st.divider()
                 
                 st.markdown("#### Chi tiết theo hạng mục")
-                # Sort categories by total profit
-                category_profit = agg.groupby('category')['lợi nhuận'].sum().sort_values(ascending=False)
-                
-                for category in category_profit.index:
-                    group = agg[agg['category'] == category]
-                    with st.expander(f"📂 {category} (Lợi nhuận: {format_vnd(group['lợi nhuận'].sum())})", expanded=True):
-                        group = group.sort_values('lợi nhuận', ascending=False)
+                paid_amounts = None
+                for _, cat_row in category_totals.iterrows():
+                    category = cat_row['category']
+                    with st.expander(f"📂 {category} (Lợi nhuận: {format_vnd(cat_row['lợi nhuận'])})", expanded=False):
+                        # Chi tiết chỉ truy vấn khi người dùng bật xem (expander không báo trạng thái mở)
+                        if not st.toggle("Xem chi tiết", key=f"rpt_detail_{category}"):
+                            st.caption(f"Thu: {format_vnd(cat_row['thu'])} | Chi: {format_vnd(cat_row['chi'])}")
+                            continue
+                        # [NEW] Sắp xếp phía server + hiển thị N thẻ đầu, bấm "Xem thêm" để tải tiếp
+                        c_sort, c_view = st.columns([2, 1])
+                        sort_label = c_sort.selectbox("Sắp xếp:", list(REPORT_DETAIL_SORTS.keys()), key=f"rpt_sort_{category}")
+                        view_mode = c_view.radio("Hiển thị:", ["Thẻ", "Bảng"], horizontal=True, key=f"rpt_view_{category}")
+                        if paid_amounts is None: paid_amounts = get_paid_amounts()
+
+                        if view_mode == "Bảng":
+                            group, total_codes = get_report_details(*rpt_filter, category, sort_label)
+                            if category in ['Tour', 'Booking Dịch Vụ']:
+                                group['còn phải thu'] = (group['thu'] - group['code'].map(paid_amounts).fillna(0)).where(group['thu'] > 0, 0).clip(lower=0)
+                            st.dataframe(
+                                group.drop(columns=['category']),
+                                column_config={
+                                    "code": "Mã", "name": "Tên",
+                                    "thu": st.column_config.NumberColumn("Thu", format="%d VND"),
+                                    "chi": st.column_config.NumberColumn("Chi", format="%d VND"),
+                                    "lợi nhuận": st.column_config.NumberColumn("Lãi", format="%d VND"),
+                                    "còn phải thu": st.column_config.NumberColumn("Còn phải thu", format="%d VND"),
+                                },
+                                use_container_width=True, hide_index=True
+                            )
+                            continue
+
+                        limit_key = f"rpt_limit_{category}_{sort_label}_{filter_type}_{selected_period}_{selected_status_label}"
+                        if limit_key not in st.session_state: st.session_state[limit_key] = REPORT_CARD_PAGE_SIZE
+                        group, total_codes = get_report_details(*rpt_filter, category, sort_label, st.session_state[limit_key])
                         for _, r in group.iterrows():
                             # --- [NEW] Debt calculation & display ---
                             debt_html = ""
@@ -4147,6 +6126,12 @@ def render_cost_control(menu):
                                 {debt_html}
                             </div>
                             """, unsafe_allow_html=True)
+
+                        if total_codes > len(group):
+                            st.caption(f"Đang hiển thị {len(group)}/{total_codes} mã")
+                            if st.button("⬇️ Xem thêm", key=f"btn_more_{limit_key}"):
+                                st.session_state[limit_key] += REPORT_CARD_PAGE_SIZE
+                                st.rerun()
             else:
                 st.info(f"Không có dữ liệu cho kỳ báo cáo '{selected_period}'.")
 
@@ -4154,70 +6139,20 @@ def render_debt_management():
     st.title("💳 Quản Lý Công Nợ")
     st.caption("Theo dõi và tổng hợp các khoản phải thu từ khách hàng.")
 
-    tab_lookup, tab_summary = st.tabs(["Tra cứu theo Mã", "Tổng hợp Công nợ"])
-
-    with tab_lookup:
+    def _debt_lookup_panel():
         st.subheader("Tra cứu công nợ theo Mã Tour / Booking")
         
         # --- LẤY DỮ LIỆU ĐỂ TÌM KIẾM (CHỈ HIỆN CÁC MÃ CÒN NỢ) ---
         with st.spinner("Đang tải danh sách còn nợ..."):
-            # 1. Lấy tất cả giao dịch và tính toán số tiền đã trả cho mỗi mã
-            all_txns_cn = run_query("SELECT ref_code, type, amount FROM transaction_history")
-            paid_amounts_cn = {}
-            if all_txns_cn:
-                df_txns_cn = pd.DataFrame([dict(r) for r in all_txns_cn])
-                if not df_txns_cn.empty:
-                    df_thu_cn = df_txns_cn[df_txns_cn['type'] == 'THU'].groupby('ref_code')['amount'].sum()
-                    df_chi_cn = df_txns_cn[df_txns_cn['type'] == 'CHI'].groupby('ref_code')['amount'].sum()
-                    paid_amounts_cn = (df_thu_cn.subtract(df_chi_cn, fill_value=0)).to_dict()
-
-            # 2. Lấy tất cả tour và booking (lọc theo sale nếu cần)
             user_info_cn = st.session_state.get("user_info", {})
             user_role_cn = user_info_cn.get('role')
             user_name_cn = user_info_cn.get('name')
 
-            # [FIX] Lấy tất cả tour/booking chưa bị xóa (bao gồm cả mục đã hoàn thành) để kiểm tra công nợ
-            tour_cn_query = "SELECT * FROM tours WHERE COALESCE(status, 'running') NOT IN ('deleted')"
-            tour_cn_params = []
-            if user_role_cn == 'sale' and user_name_cn:
-                tour_cn_query += " AND sale_name=?"
-                tour_cn_params.append(user_name_cn)
-            all_tours_cn = run_query(tour_cn_query, tuple(tour_cn_params))
-
-            bk_cn_query = "SELECT * FROM service_bookings WHERE COALESCE(status, 'active') NOT IN ('deleted')"
-            bk_cn_params = []
-            if user_role_cn == 'sale' and user_name_cn:
-                bk_cn_query += " AND sale_name=?"
-                bk_cn_params.append(user_name_cn)
-            all_bookings_cn = run_query(bk_cn_query, tuple(bk_cn_params))
-
+            # [FIX] Tất cả tour/booking chưa bị xóa (kể cả đã hoàn thành), số đã thu lấy từ sổ công nợ
             search_options = {"": "-- Chọn mã để theo dõi --"}
-
-            # 3. Xử lý Tours: Chỉ thêm vào danh sách nếu chưa thu đủ
-            if all_tours_cn:
-                for t_row in all_tours_cn:
-                    tour = dict(t_row)
-                    # Tính giá trị hợp đồng
-                    final_price = float(tour.get('final_tour_price', 0) or 0)
-                    child_price = float(tour.get('child_price', 0) or 0)
-                    final_qty = float(tour.get('final_qty', 0) or 0)
-                    child_qty = float(tour.get('child_qty', 0) or 0)
-                    if final_qty == 0: final_qty = float(tour.get('guest_count', 1))
-                    contract_value = (final_price * final_qty) + (child_price * child_qty)
-                    
-                    paid = paid_amounts_cn.get(tour['tour_code'], 0.0)
-                    
-                    if contract_value > 0 and contract_value - paid > 0.1:
-                        search_options[f"📦 TOUR: [{tour['tour_code']}] {tour['tour_name']}"] = tour['tour_code']
-
-            # 4. Xử lý Bookings: Chỉ thêm vào danh sách nếu chưa thu đủ
-            if all_bookings_cn:
-                for b_row in all_bookings_cn:
-                    booking = dict(b_row)
-                    contract_value = float(booking.get('selling_price', 0) or 0)
-                    paid = paid_amounts_cn.get(booking['code'], 0.0)
-                    if contract_value > 0 and contract_value - paid > 0.1:
-                        search_options[f"🔖 BOOKING: [{booking['code']}] {booking['name']}"] = booking['code']
+            for r in get_open_debts(user_role_cn, user_name_cn).itertuples():
+                icon = "📦 TOUR" if r.type == 'Tour' else "🔖 BOOKING"
+                search_options[f"{icon}: [{r.ref_code}] {r.ref_name}"] = r.ref_code
 
         # --- GIAO DIỆN CHÍNH ---
         col1, col2 = st.columns([1, 2])
@@ -4255,13 +6190,8 @@ def render_debt_management():
                     if booking_info:
                         contract_value = float(booking_info['selling_price'] or 0)
 
-                # Lấy tổng đã thu
-                paid_data = run_query("SELECT SUM(amount) as total FROM transaction_history WHERE ref_code=? AND type='THU'", (selected_code,), fetch_one=True)
-                total_paid = paid_data['total'] if paid_data and paid_data['total'] else 0.0
-
-                # Lấy tổng đã chi (hoàn tiền)
-                refund_data = run_query("SELECT SUM(amount) as total FROM transaction_history WHERE ref_code=? AND type='CHI'", (selected_code,), fetch_one=True)
-                total_refund = refund_data['total'] if refund_data and refund_data['total'] else 0.0
+                # Tổng đã thu / đã chi (hoàn tiền) từ sổ công nợ
+                total_paid, total_refund = get_ref_balance(selected_code)
                 
                 actual_paid = total_paid - total_refund
                 
@@ -4397,7 +6327,7 @@ def render_debt_management():
                         # Format dữ liệu hiển thị
                         df_display = df_hist.copy()
                         df_display['created_at'] = pd.to_datetime(df_display['created_at'], errors='coerce').dt.strftime('%d/%m/%Y')
-                        df_display['amount'] = df_display['amount'].apply(lambda x: format_vnd(x))
+                        df_display['amount'] = format_vnd_series(df_display['amount'])
                         
                         df_display = df_display.rename(columns={
                             'created_at': 'Ngày',
@@ -4470,74 +6400,19 @@ def render_debt_management():
             else:
                 st.info("👆 Vui lòng chọn một Mã Tour hoặc Mã Booking để xem công nợ.")
 
-    with tab_summary:
+    def _debt_summary_panel():
         st.subheader("Tổng hợp các khoản phải thu")
         with st.spinner("Đang tính toán công nợ..."):
-            # 1. Lấy tất cả giao dịch và tính toán số tiền đã trả cho mỗi mã
-            all_txns = run_query("SELECT ref_code, type, amount FROM transaction_history")
-            paid_amounts = {}
-            if all_txns:
-                df_txns = pd.DataFrame([dict(r) for r in all_txns])
-                if not df_txns.empty:
-                    df_thu = df_txns[df_txns['type'] == 'THU'].groupby('ref_code')['amount'].sum()
-                    df_chi = df_txns[df_txns['type'] == 'CHI'].groupby('ref_code')['amount'].sum()
-                    paid_amounts = (df_thu.subtract(df_chi, fill_value=0)).to_dict()
-
-            debt_records = []
-
-            # 2. Lấy tất cả tour đang hoạt động và tính công nợ
             user_info_debt = st.session_state.get("user_info", {})
             user_role_debt = user_info_debt.get('role')
             user_name_debt = user_info_debt.get('name')
-            # [FIX] Lấy tất cả tour chưa bị xóa (bao gồm cả tour đã hoàn thành) để tổng hợp công nợ
-            tour_debt_query = "SELECT * FROM tours WHERE COALESCE(status, 'running') NOT IN ('deleted')"
-            tour_debt_params = []
-            if user_role_debt == 'sale' and user_name_debt:
-                tour_debt_query += " AND sale_name=?"
-                tour_debt_params.append(user_name_debt)
-            active_tours = run_query(tour_debt_query, tuple(tour_debt_params))
-            if active_tours:
-                for tour_row in active_tours:
-                    tour = dict(tour_row)
-                    final_price = float(tour.get('final_tour_price', 0) or 0)
-                    child_price = float(tour.get('child_price', 0) or 0)
-                    final_qty = float(tour.get('final_qty', 0) or 0)
-                    child_qty = float(tour.get('child_qty', 0) or 0)
-                    if final_qty == 0: final_qty = float(tour.get('guest_count', 1))
-                    contract_value = (final_price * final_qty) + (child_price * child_qty)
- 
-                    if contract_value > 0:
-                        paid = paid_amounts.get(tour['tour_code'], 0.0)
-                        remaining = contract_value - paid
-                        if remaining > 0.1:
-                            debt_records.append({'customer_name': tour.get('customer_name', 'N/A'), 'ref_name': tour['tour_name'], 'ref_code': tour['tour_code'], 'type': 'Tour', 'contract_value': contract_value, 'paid': paid, 'remaining': remaining})
- 
-            # 3. Lấy tất cả booking lẻ đang hoạt động và tính công nợ
-            # [FIX] Lấy tất cả booking chưa bị xóa (bao gồm cả booking đã hoàn thành) để tổng hợp công nợ
-            bk_debt_query = "SELECT * FROM service_bookings WHERE COALESCE(status, 'active') NOT IN ('deleted')"
-            bk_debt_params = []
-            if user_role_debt == 'sale' and user_name_debt:
-                bk_debt_query += " AND sale_name=?"
-                bk_debt_params.append(user_name_debt)
-            active_bookings = run_query(bk_debt_query, tuple(bk_debt_params))
-            if active_bookings:
-                for booking_row in active_bookings:
-                    booking = dict(booking_row)
-                    contract_value = float(booking.get('selling_price', 0) or 0)
- 
-                    if contract_value > 0:
-                        paid = paid_amounts.get(booking['code'], 0.0)
-                        remaining = contract_value - paid
-                        if remaining > 0.1:
-                            customer_info = booking.get('customer_info', 'N/A')
-                            customer_name = customer_info.split(' - ')[0] if ' - ' in customer_info else customer_info
-                            debt_records.append({'customer_name': customer_name, 'ref_name': booking['name'], 'ref_code': booking['code'], 'type': 'Booking', 'contract_value': contract_value, 'paid': paid, 'remaining': remaining})
- 
-            # 4. Hiển thị kết quả
-            if not debt_records:
+            # [FIX] Tất cả tour/booking chưa bị xóa (kể cả đã hoàn thành), đọc 1 lần từ sổ công nợ
+            df_debt = get_open_debts(user_role_debt, user_name_debt)
+
+            # Hiển thị kết quả
+            if df_debt.empty:
                 st.success("🎉 Không có công nợ nào cần thu.")
             else:
-                df_debt = pd.DataFrame(debt_records)
                 total_debt = df_debt['remaining'].sum()
                 
                 st.metric("TỔNG SỐ TIỀN CẦN THU", format_vnd(total_debt))
@@ -4550,11 +6425,19 @@ def render_debt_management():
                 
                 st.dataframe(customer_debt, column_config={"Tổng nợ": st.column_config.NumberColumn(format="%d VND")}, use_container_width=True, hide_index=True)
                 
+                # [NEW] Tuổi nợ (tính từ ngày đi tour / ngày tạo booking)
+                st.divider()
+                st.markdown("#### Tuổi nợ")
+                aging = df_debt.groupby('aging')['remaining'].agg(['sum', 'count']).reindex(DEBT_AGING_BUCKETS, fill_value=0)
+                age_cols = st.columns(len(DEBT_AGING_BUCKETS))
+                for col, bucket in zip(age_cols, DEBT_AGING_BUCKETS):
+                    col.metric(bucket, format_vnd(aging.loc[bucket, 'sum']), delta=f"{int(aging.loc[bucket, 'count'])} mã", delta_color="off")
+                
                 st.divider()
                 st.markdown("#### Chi tiết các khoản nợ")
                 st.dataframe(
-                    df_debt.sort_values('remaining', ascending=False),
-                    column_config={ 'customer_name': 'Khách hàng', 'ref_name': 'Tên Tour/Booking', 'ref_code': 'Mã', 'type': 'Loại', 'contract_value': st.column_config.NumberColumn("Giá trị HĐ", format="%d VND"), 'paid': st.column_config.NumberColumn("Đã thu", format="%d VND"), 'remaining': st.column_config.NumberColumn("Còn lại", format="%d VND"), },
+                    df_debt.sort_values('remaining', ascending=False)[['customer_name', 'ref_name', 'ref_code', 'type', 'contract_value', 'paid', 'remaining', 'age_days', 'aging']],
+                    column_config={ 'customer_name': 'Khách hàng', 'ref_name': 'Tên Tour/Booking', 'ref_code': 'Mã', 'type': 'Loại', 'contract_value': st.column_config.NumberColumn("Giá trị HĐ", format="%d VND"), 'paid': st.column_config.NumberColumn("Đã thu", format="%d VND"), 'remaining': st.column_config.NumberColumn("Còn lại", format="%d VND"), 'age_days': st.column_config.NumberColumn("Số ngày", format="%d"), 'aging': 'Tuổi nợ', },
                     use_container_width=True, hide_index=True
                 )
 
@@ -4632,6 +6515,11 @@ def render_debt_management():
                         type="primary"
                     )
 
+    render_lazy_tabs({
+        "Tra cứu theo Mã": _debt_lookup_panel,
+        "Tổng hợp Công nợ": _debt_summary_panel
+    }, key="nav_debt")
+
 def render_booking_management():
     st.title("🔖 Quản Lý Booking")
     st.caption("Quản lý các booking lẻ, booking dịch vụ (Không phải Tour trọn gói)")
@@ -4642,30 +6530,22 @@ def render_booking_management():
     current_user_role = current_user_info.get('role')
 
     # --- 2. TÁCH LIÊN KẾT RA 2 PHẦN RIÊNG BIỆT ---
-    tab1, tab2, tab3 = st.tabs(["✨ Tạo Booking", "🔗 Chi tiết Booking", "📜 Lịch sử Booking"])
-    
     # ---------------- TAB 1: TẠO BOOKING ----------------
-    with tab1:
+    def _booking_create_panel():
         with st.container(border=True):
             st.markdown("### ➕ Tạo Booking Mới")
             
             # --- GỢI Ý KHÁCH HÀNG ---
-            cust_query = "SELECT * FROM customers ORDER BY id DESC"
-            cust_params = []
-            if current_user_role == 'sale' and current_user_name:
-                cust_query = "SELECT * FROM customers WHERE sale_name=? ORDER BY id DESC"
-                cust_params.append(current_user_name)
-            customers = run_query(cust_query, tuple(cust_params))
-            cust_opts = ["-- Khách mới --"]
-            if customers:
-                cust_opts += [f"{c['name']} | {c['phone']}" for c in customers]
-            sel_cust = st.selectbox("🔍 Chọn khách hàng cũ (Gợi ý):", cust_opts, key="bk_cust_suggest")
+            cust_owner = current_user_name if current_user_role == 'sale' and current_user_name else None
+            sel_cust = typeahead_picker(
+                "🔍 Tìm khách hàng cũ (Tên/SĐT):", lambda q: search_customers(q, cust_owner), "bk_cust_suggest",
+                lambda c: f"{c[0]} | {c[1]}", "-- Khách mới --"
+            )
             
             pre_name, pre_phone = "", ""
-            if sel_cust and sel_cust != "-- Khách mới --":
-                parts = sel_cust.split(" | ")
-                pre_name = parts[0]
-                pre_phone = parts[1] if len(parts) > 1 else ""
+            if sel_cust:
+                pre_name = sel_cust[0] or ""
+                pre_phone = sel_cust[1] or ""
             
             # Chọn loại dịch vụ
             bk_type = st.radio("Chọn loại dịch vụ:", ["🏨 Khách sạn", "🚌 Vận chuyển", "🧩 Combo / Đa dịch vụ", "🔖 Khác"], horizontal=True)
@@ -5156,7 +7036,7 @@ def render_booking_management():
                         else: st.warning("Vui lòng nhập tên dịch vụ và tên khách hàng.")
 
     # ---------------- TAB 2: KHỚP UNC & HÓA ĐƠN (DỰ ÁN UNC) ----------------
-    with tab2:
+    def _booking_detail_panel():
         st.subheader("🔗 Chi tiết Booking")
         # --- Lọc danh sách booking theo sale ---
         bk_query = "SELECT * FROM service_bookings WHERE status='active'"
@@ -5197,7 +7077,7 @@ def render_booking_management():
                 
                 # --- NÚT TẢI BOOKING CONFIRMATION (MỚI) ---
                 st.write("")
-                c_lang, c_dl_btn = st.columns([1, 2])
+                c_lang, c_dl_btn, c_dl_docx = st.columns([1, 1, 1])
                 sel_lang = c_lang.radio("Ngôn ngữ PDF:", ["Tiếng Việt", "English"], horizontal=True)
                 lang_code = 'vi' if sel_lang == "Tiếng Việt" else 'en'
                 
@@ -5210,6 +7090,16 @@ def render_booking_management():
                     mime="application/pdf",
                     type="secondary"
                 )
+                # [NEW] Bản Word (điền từ docx_templates/booking_cfm.docx)
+                docx_cfm = create_booking_cfm_docx(dict(bk_info), comp_data_cfm, lang=lang_code)
+                if docx_cfm:
+                    c_dl_docx.download_button(
+                        label="📝 Tải Booking Confirmation (Word)",
+                        data=docx_cfm,
+                        file_name=f"Booking_CFM_{code}.docx",
+                        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                        type="secondary"
+                    )
                 
                 st.divider()
                 # Nút hoàn tất & xóa booking
@@ -5225,16 +7115,11 @@ def render_booking_management():
             st.info("Chưa có booking nào.")
 
     # ---------------- TAB 3: LỊCH SỬ BOOKING ----------------
-    with tab3:
+    def _booking_history_panel():
         st.subheader("📜 Lịch sử Booking đã hoàn tất")
-        # --- Lọc danh sách booking theo sale ---
-        hist_bk_query = "SELECT * FROM service_bookings WHERE status='completed'"
-        hist_bk_params = []
-        if current_user_role == 'sale' and current_user_name:
-            hist_bk_query += " AND sale_name=?"
-            hist_bk_params.append(current_user_name)
-        hist_bk_query += " ORDER BY id DESC"
-        history_bk = run_query(hist_bk_query, tuple(hist_bk_params))
+        # --- Lọc theo sale / tháng tạo, phân trang keyset ---
+        hist_bk_conds, hist_bk_params = list_filter_controls("bk_hist", "service_bookings", sale_col="sale_name", period_col="created_at")
+        history_bk = keyset_paginator("bk_hist", "service_bookings", "*", ["status='completed'"] + hist_bk_conds, hist_bk_params)
         if history_bk:
             df_hist = pd.DataFrame([dict(r) for r in history_bk])
             st.dataframe(
@@ -5256,12 +7141,15 @@ def render_booking_management():
         else:
             st.info("Chưa có booking nào hoàn tất.")
 
+    render_lazy_tabs({
+        "✨ Tạo Booking": _booking_create_panel,
+        "🔗 Chi tiết Booking": _booking_detail_panel,
+        "📜 Lịch sử Booking": _booking_history_panel
+    }, key="nav_booking")
+
 def render_tour_management():
     st.title("📦 Quản Lý Tour ")
     
-    # Sử dụng Tabs theo yêu cầu
-    tab_est, tab_list_srv, tab_act, tab_hist, tab_rpt = st.tabs(["📝 Dự Toán Chi Phí", "📋 Danh sách & Dịch vụ", "💸 Quyết Toán Tour", "📜 Lịch sử Tour", "📈 Tổng Hợp Lợi Nhuận"])
-    
     # Lấy thông tin user hiện tại để lọc
     current_user_info_tour = st.session_state.get("user_info", {})
     current_user_name_tour = current_user_info_tour.get('name', 'N/A')
@@ -5273,28 +7161,29 @@ def render_tour_management():
     if current_user_role_tour == 'sale' and current_user_name_tour:
         all_tours_query = "SELECT * FROM tours WHERE sale_name=? ORDER BY id DESC"
         all_tours_params.append(current_user_name_tour)
-    all_tours = run_query(all_tours_query, tuple(all_tours_params))
+    all_tours = run_query(all_tours_query, tuple(all_tours_params), cache=True)
     running_tours = [t for t in all_tours if t['status'] == 'running']
     tour_options = {f"[{t['tour_code']}] {t['tour_name']} ({t['start_date']})": t['id'] for t in running_tours} if running_tours else {} # type: ignore
+
+    # [NEW] Chỉ tab đang chọn được chạy (render_lazy_tabs); tab có bảng nhập liệu là st.fragment:
+    # sửa bảng trong tab chỉ chạy lại tab đó (rerun_fragment()).
+    # Dữ liệu dùng chung (all_tours, tour_options) lấy từ lần chạy toàn trang; thao tác ghi DB vẫn gọi st.rerun() toàn trang.
     
     # ---------------- TAB 1: DỰ TOÁN CHI PHÍ ----------------
-    with tab_est:
+    @st.fragment
+    def _tour_estimate_panel():
         with st.expander("➕ Tạo Thông Tin Đoàn Mới", expanded=False):
             # --- GỢI Ý KHÁCH HÀNG ---
-            cust_query_t = "SELECT * FROM customers ORDER BY id DESC"
-            cust_params_t = []
-            if current_user_role_tour == 'sale' and current_user_name_tour:
-                cust_query_t = "SELECT * FROM customers WHERE sale_name=? ORDER BY id DESC"
-                cust_params_t.append(current_user_name_tour)
-            customers = run_query(cust_query_t, tuple(cust_params_t))
-            cust_opts_t = ["-- Khách mới --"] + [f"{c['name']} | {c['phone']}" for c in customers] if customers else ["-- Khách mới --"] # type: ignore
-            sel_cust_t = st.selectbox("🔍 Gợi ý khách hàng:", cust_opts_t, key="tour_cust_suggest")
+            cust_owner_t = current_user_name_tour if current_user_role_tour == 'sale' and current_user_name_tour else None
+            sel_cust_t = typeahead_picker(
+                "🔍 Gợi ý khách hàng (Tên/SĐT):", lambda q: search_customers(q, cust_owner_t), "tour_cust_suggest",
+                lambda c: f"{c[0]} | {c[1]}", "-- Khách mới --"
+            )
             
             t_pre_name, t_pre_phone = "", ""
-            if sel_cust_t and sel_cust_t != "-- Khách mới --":
-                parts = sel_cust_t.split(" | ")
-                t_pre_name = parts[0]
-                t_pre_phone = parts[1] if len(parts) > 1 else ""
+            if sel_cust_t:
+                t_pre_name = sel_cust_t[0] or ""
+                t_pre_phone = sel_cust_t[1] or ""
 
             with st.form("create_tour_form", clear_on_submit=True):
                 c1, c2 = st.columns(2)
@@ -5506,9 +7395,9 @@ def render_tour_management():
             df_display['total_val'] = df_display['quantity'] * df_display['unit_price'] * df_display['times']
             df_display['price_per_pax'] = df_display['total_val'] / guest_cnt
             
-            df_display['price_per_pax'] = df_display['price_per_pax'].apply(lambda x: format_vnd(x) + " VND")
-            df_display['total_display'] = df_display['total_val'].apply(lambda x: format_vnd(x) + " VND")
-            df_display['unit_price'] = df_display['unit_price'].apply(lambda x: format_vnd(x) + " VND") # type: ignore
+            df_display['price_per_pax'] = format_vnd_series(df_display['price_per_pax'], " VND")
+            df_display['total_display'] = format_vnd_series(df_display['total_val'], " VND")
+            df_display['unit_price'] = format_vnd_series(df_display['unit_price'], " VND") # type: ignore
 
             st.markdown(f"**Đoàn:** {tour_info['tour_name']} (Mã: {tour_info['tour_code']}) | **Pax:** {tour_info['guest_count']}")
             
@@ -5614,13 +7503,11 @@ def render_tour_management():
                 df_new_check = df_new[cols_check].reset_index(drop=True).fillna(0)
                 df_old_check = df_old[cols_check].reset_index(drop=True).fillna(0)
                 
-                has_changes = False
-                if len(df_new_check) != len(df_old_check): has_changes = True
-                elif not df_new_check.equals(df_old_check): has_changes = True
+                has_changes = editor_frame_changed(df_new_check, df_old_check, cols_check)
                 
                 if has_changes or force_rerun_fmt:
                     st.session_state.est_df_temp = df_new[cols_check]
-                    st.rerun()
+                    rerun_fragment()
 
             # --- TÍNH TOÁN REAL-TIME ---
             total_cost = 0
@@ -5769,14 +7656,12 @@ def render_tour_management():
                         sum_total_fmt = workbook.add_format({'bold': True, 'bg_color': '#C8E6C9', 'font_color': '#1B5E20', 'num_format': '#,##0', 'align': 'right', 'border': 1, 'font_size': 12, 'font_name': 'Times New Roman'})
                         
                         # --- 1. COMPANY INFO (Rows 0-3) ---
-                        if comp['logo_b64_str']:
+                        logo = get_logo_assets(comp)
+                        if logo:
                             try:
-                                logo_data = base64.b64decode(comp['logo_b64_str'])
-                                image_stream = io.BytesIO(logo_data)
-                                img = Image.open(image_stream)
-                                w, h = img.size
+                                image_stream = io.BytesIO(logo['bytes'])
+                                w, h = logo['size']
                                 scale = 60 / h if h > 0 else 0.5
-                                image_stream.seek(0)
                                 worksheet.insert_image('A1', 'logo.png', {'image_data': image_stream, 'x_scale': scale, 'y_scale': scale, 'x_offset': 5, 'y_offset': 5})
                             except: pass
                         
@@ -5945,7 +7830,8 @@ def render_tour_management():
                     st.rerun()
 
     # ---------------- TAB MỚI: DANH SÁCH & DỊCH VỤ ----------------
-    with tab_list_srv:
+    @st.fragment
+    def _tour_services_panel():
         st.subheader("📋 Danh sách Đoàn & Dịch vụ")
         
         def clean_vnd_val(x):
@@ -6151,9 +8037,9 @@ def render_tour_management():
                 edited_hotels = recalc_remaining(edited_hotels)
                 
                   # So sánh với dữ liệu cũ (chỉ so các cột nhập liệu để tránh lặp vô tận do cột tính toán)
-                if not edited_hotels[cols_h].equals(st.session_state.ls_hotels_temp[cols_h].map(lambda x: x if not isinstance(x, float) else x)):
+                if editor_frame_changed(edited_hotels, st.session_state.ls_hotels_temp, cols_h):
                     st.session_state.ls_hotels_temp = edited_hotels
-                    st.rerun()
+                    rerun_fragment()
                 # 3. MENU NHÀ HÀNG
                 st.markdown("##### 3. Menu nhà hàng")
                 df_rests = st.session_state.ls_rests_temp.copy()
@@ -6182,9 +8068,9 @@ def render_tour_management():
                 cols_r = ['date', 'meal_name', 'restaurant_name', 'address', 'phone', 'menu', 'total_amount', 'deposit']
                 edited_rests = recalc_remaining(edited_rests)
                 
-                if not edited_rests[cols_r].equals(st.session_state.ls_rests_temp[cols_r].map(lambda x: x if not isinstance(x, float) else x)):
+                if editor_frame_changed(edited_rests, st.session_state.ls_rests_temp, cols_r):
                     st.session_state.ls_rests_temp = edited_rests
-                    st.rerun()
+                    rerun_fragment()
               # 4. ĐIỂM THAM QUAN (MỚI)
                 st.markdown("##### 4. Điểm tham quan")
                 df_sightseeings = st.session_state.ls_sight_temp.copy()
@@ -6212,9 +8098,9 @@ def render_tour_management():
                 cols_s = ['date', 'name', 'address', 'quantity', 'total_amount', 'deposit', 'note']
                 edited_sightseeings = recalc_remaining(edited_sightseeings)
                 
-                if not edited_sightseeings[cols_s].equals(st.session_state.ls_sight_temp[cols_s].map(lambda x: x if not isinstance(x, float) else x)):
+                if editor_frame_changed(edited_sightseeings, st.session_state.ls_sight_temp, cols_s):
                     st.session_state.ls_sight_temp = edited_sightseeings
-                    st.rerun()
+                    rerun_fragment()
               # 5. CHI PHÍ PHÁT SINH (Đã đổi thứ tự lên trên)
                 st.divider()
                 st.markdown("##### 5. Chi phí phát sinh (Nước, Sim, Banner...)")
@@ -6254,9 +8140,9 @@ def render_tour_management():
                 
                 cols_inc = ['name', 'unit', 'quantity', 'price', 'total_amount', 'deposit', 'note']
                 # So sánh với dữ liệu cũ
-                if not edited_incurred[cols_inc].equals(st.session_state.ls_incurred_temp[cols_inc].map(lambda x: x if not isinstance(x, float) else x)):
+                if editor_frame_changed(edited_incurred, st.session_state.ls_incurred_temp, cols_inc):
                      st.session_state.ls_incurred_temp = edited_incurred[cols_inc]
-                     st.rerun()
+                     rerun_fragment()
                 st.write("")
                 # 6. CHECKLIST BÀN GIAO (Đã đổi thứ tự xuống dưới)
                 st.markdown("##### 6. Checklist bàn giao hồ sơ HDV")
@@ -6787,8 +8673,21 @@ def render_tour_management():
 
                     st.download_button("📥 Xuất Hồ Sơ Bàn Giao & Thực Đơn (Excel)", buffer_combined.getvalue(), f"HoSo_BanGiao_{tour_info_ls['tour_code']}.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
 
+                    # [NEW] Hồ sơ bàn giao bản Word (điền từ docx_templates/handover.docx)
+                    docx_handover = create_handover_docx(
+                        dict(tour_info_ls),
+                        edited_guests.fillna('').to_dict('records'),
+                        st.session_state.ls_hotels_temp.fillna('').to_dict('records'),
+                        st.session_state.ls_rests_temp.fillna('').to_dict('records'),
+                        st.session_state.ls_sight_temp.fillna('').to_dict('records'),
+                        ",".join(new_checked_list),
+                    )
+                    if docx_handover:
+                        st.download_button("📝 Xuất Hồ Sơ Bàn Giao (Word)", docx_handover, f"HoSo_BanGiao_{tour_info_ls['tour_code']}.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document", use_container_width=True)
+
     # ---------------- TAB 2: QUYẾT TOÁN ----------------
-    with tab_act:
+    @st.fragment
+    def _tour_settlement_panel():
         st.subheader("💸 Quyết Toán ")
         
         selected_tour_act_label = st.selectbox("Chọn Đoàn quyết toán:", list(tour_options.keys()) if tour_options else [], key="sel_tour_act")
@@ -6855,7 +8754,7 @@ def render_tour_management():
                 if not df_unc.empty:
                     # [UPDATED] Format tiền tệ Việt Nam có dấu chấm và chữ VND
                     df_unc_show = df_unc.copy()
-                    df_unc_show['total_show'] = df_unc_show['total_amount'].apply(lambda x: format_vnd(x) + " VND") # type: ignore
+                    df_unc_show['total_show'] = format_vnd_series(df_unc_show['total_amount'], " VND") # type: ignore
                     st.dataframe(df_unc_show[['date', 'invoice_number', 'memo', 'total_show']],
                                  column_config={
                                      "date": "Ngày", 
@@ -6871,7 +8770,7 @@ def render_tour_management():
                 if not df_inv.empty:
                     # [UPDATED] Format tiền tệ Việt Nam có dấu chấm và chữ VND
                     df_inv_show = df_inv.copy()
-                    df_inv_show['total_show'] = df_inv_show['total_amount'].apply(lambda x: format_vnd(x) + " VND") # type: ignore
+                    df_inv_show['total_show'] = format_vnd_series(df_inv_show['total_amount'], " VND") # type: ignore
                     st.dataframe(df_inv_show[['date', 'invoice_number', 'seller_name', 'total_show']], 
                                  column_config={"date": "Ngày", "invoice_number": "Số hóa đơn", "seller_name": "Đơn vị bán", "total_show": "Thành tiền"}, 
                                  use_container_width=True, hide_index=True)
@@ -6888,7 +8787,7 @@ def render_tour_management():
             with st.expander("👀 Bảng Dự Toán (Để đối chiếu)", expanded=False):
                 if est_items_ref:
                     df_est_ref = pd.DataFrame([dict(r) for r in est_items_ref])
-                    df_est_ref['total_amount'] = df_est_ref['total_amount'].apply(lambda x: format_vnd(x)) # type: ignore
+                    df_est_ref['total_amount'] = format_vnd_series(df_est_ref['total_amount']) # type: ignore
                     st.dataframe(df_est_ref, column_config={"category": "Hạng mục", "description": "Diễn giải", "total_amount": "Dự toán"}, use_container_width=True, hide_index=True)
                 else: st.info("Chưa có dữ liệu dự toán.")
 
@@ -6931,9 +8830,9 @@ def render_tour_management():
             df_act_display['price_per_pax'] = df_act_display['total_val'] / guest_cnt_act
             
             # Format strings
-            df_act_display['price_per_pax'] = df_act_display['price_per_pax'].apply(lambda x: format_vnd(x) + " VND")
-            df_act_display['total_display'] = df_act_display['total_val'].apply(lambda x: format_vnd(x) + " VND") # type: ignore
-            df_act_display['unit_price'] = df_act_display['unit_price'].apply(lambda x: format_vnd(x) + " VND") # type: ignore
+            df_act_display['price_per_pax'] = format_vnd_series(df_act_display['price_per_pax'], " VND")
+            df_act_display['total_display'] = format_vnd_series(df_act_display['total_val'], " VND") # type: ignore
+            df_act_display['unit_price'] = format_vnd_series(df_act_display['unit_price'], " VND") # type: ignore
 
             # [CODE MỚI] Tính toán so sánh (Dự toán vs Thực tế)
             def get_est_val(row): # type: ignore
@@ -6942,8 +8841,8 @@ def render_tour_management():
             
             df_act_display['est_val'] = df_act_display.apply(get_est_val, axis=1)
             df_act_display['diff_val'] = df_act_display['est_val'] - df_act_display['total_val']
-            df_act_display['est_display'] = df_act_display['est_val'].apply(lambda x: format_vnd(x) + " VND")
-            df_act_display['diff_display'] = df_act_display['diff_val'].apply(lambda x: format_vnd(x) + " VND")
+            df_act_display['est_display'] = format_vnd_series(df_act_display['est_val'], " VND")
+            df_act_display['diff_display'] = format_vnd_series(df_act_display['diff_val'], " VND")
 
             # --- LOGIC KHÓA / DUYỆT QUYẾT TOÁN ---
             req_act_status = tour_info_act['request_edit_act'] # type: ignore
@@ -7006,9 +8905,9 @@ def render_tour_management():
                 df_new_check_act = df_new_act[cols_check_act].reset_index(drop=True).fillna(0)
                 df_old_check_act = df_old_act[cols_check_act].reset_index(drop=True).fillna(0)
                 
-                if len(df_new_check_act) != len(df_old_check_act) or not df_new_check_act.equals(df_old_check_act):
+                if editor_frame_changed(df_new_check_act, df_old_check_act, cols_check_act):
                     st.session_state.act_df_temp = df_new_act[cols_check_act]
-                    st.rerun()
+                    rerun_fragment()
 
             act_total_cost = 0
             if not edited_act.empty:
@@ -7138,14 +9037,12 @@ def render_tour_management():
                     section_title_fmt = workbook.add_format({'bold': True, 'font_size': 12, 'font_color': '#004D40', 'bg_color': '#E0F2F1', 'border': 1, 'align': 'center', 'font_name': 'Times New Roman'})
 
                     # 1. Company Info
-                    if comp['logo_b64_str']:
+                    logo = get_logo_assets(comp)
+                    if logo:
                         try:
-                            logo_data = base64.b64decode(comp['logo_b64_str'])
-                            image_stream = io.BytesIO(logo_data)
-                            img = Image.open(image_stream)
-                            w, h = img.size
+                            image_stream = io.BytesIO(logo['bytes'])
+                            w, h = logo['size']
                             scale = 60 / h if h > 0 else 0.5
-                            image_stream.seek(0)
                             worksheet.insert_image('A1', 'logo.png', {'image_data': image_stream, 'x_scale': scale, 'y_scale': scale, 'x_offset': 5, 'y_offset': 5})
                         except: pass
                     
@@ -7311,9 +9208,10 @@ def render_tour_management():
                 st.rerun()
 
     # ---------------- TAB 4: LỊCH SỬ TOUR ----------------
-    with tab_hist:
+    def _tour_history_panel():
         st.subheader("📜 Lịch sử Tour đã hoàn thành")
-        completed_tours = [t for t in all_tours if t['status'] == 'completed']
+        hist_conds, hist_params = list_filter_controls("tour_hist", "tours", sale_col="sale_name", period_col="start_ymd")
+        completed_tours = keyset_paginator("tour_hist", "tours", "*", ["status='completed'"] + hist_conds, hist_params)
         
         if completed_tours:
             df_hist = pd.DataFrame([dict(t) for t in completed_tours])
@@ -7346,7 +9244,8 @@ def render_tour_management():
             st.info("Chưa có tour nào trong lịch sử.")
 
     # ---------------- TAB 3: TỔNG HỢP LỢI NHUẬN ----------------
-    with tab_rpt:
+    @st.fragment
+    def _tour_report_panel():
         st.subheader("📈 Tổng Hợp Lợi Nhuận & Doanh Số")
         
         # Lọc theo thời gian
@@ -7355,62 +9254,12 @@ def render_tour_management():
             rpt_df['dt'] = pd.to_datetime(rpt_df['start_date'], format='%d/%m/%Y', errors='coerce') # type: ignore
             rpt_df = rpt_df.dropna(subset=['dt'])
             
-            rpt_df['Month'] = rpt_df['dt'].apply(lambda x: x.strftime('%m/%Y'))
-            rpt_df['Quarter'] = rpt_df['dt'].apply(lambda x: f"Q{(x.month-1)//3+1}/{x.year}")
-            rpt_df['Year'] = rpt_df['dt'].apply(lambda x: x.strftime('%Y'))
+            rpt_df['Month'] = rpt_df['dt'].dt.strftime('%m/%Y')
+            rpt_df['Quarter'] = "Q" + rpt_df['dt'].dt.quarter.astype(str) + "/" + rpt_df['dt'].dt.year.astype(str)
+            rpt_df['Year'] = rpt_df['dt'].dt.strftime('%Y')
             
-            # --- PRE-FETCH DATA FOR PERFORMANCE ---
-            all_items = run_query("SELECT tour_id, item_type, total_amount FROM tour_items")
-            items_map = {} 
-            if all_items:
-                for item in all_items:
-                    tid = item['tour_id']
-                    itype = item['item_type']
-                    amt = item['total_amount'] or 0
-                    if tid not in items_map: items_map[tid] = {'EST': 0, 'ACT': 0}
-                    items_map[tid][itype] += amt
-            
-            # Tính toán chỉ số cho từng tour
-            results = []
-            for _, t in rpt_df.iterrows():
-                tid = t['id'] # type: ignore
-                costs = items_map.get(tid, {'EST': 0, 'ACT': 0})
-                est_cost = costs['EST']
-                act_cost = costs['ACT']
-                
-                p_pct = t.get('est_profit_percent', 0) or 0
-                t_pct = t.get('est_tax_percent', 0) or 0
-
-                # Tính doanh thu (Ưu tiên giá chốt tay)
-                final_price_manual = float(t.get('final_tour_price', 0) or 0)
-                child_price_manual = float(t.get('child_price', 0) or 0)
-                final_qty = float(t.get('final_qty', 0) or 0)
-                child_qty = float(t.get('child_qty', 0) or 0)
-                if final_qty == 0: final_qty = float(t.get('guest_count', 1))
-                
-                manual_revenue = (final_price_manual * final_qty) + (child_price_manual * child_qty)
-                
-                if manual_revenue > 0:
-                    final_sale = manual_revenue
-                else:
-                    profit_est_val = est_cost * (p_pct/100)
-                    final_sale = (est_cost + profit_est_val) * (1 + t_pct/100)
-
-                net_revenue = final_sale / (1 + t_pct/100) if (1 + t_pct/100) != 0 else final_sale
-                
-                real_profit = net_revenue - act_cost
-                
-                results.append({
-                    **t.to_dict(),
-                    "Tên Đoàn": t['tour_name'], # type: ignore
-                    "Sales": t['sale_name'], # type: ignore
-                    "Ngày đi": t['start_date'], # type: ignore
-                    "Doanh Thu Thuần": net_revenue,
-                    "Chi Phí TT": act_cost,
-                    "Lợi Nhuận TT": real_profit,
-                })
-            
-            res_df = pd.DataFrame(results)
+            # Tổng EST/ACT gom sẵn bằng SQL, ghép & tính theo cột
+            res_df = compute_tour_profit_frame(rpt_df, get_tour_item_totals())
 
             # --- UI CONTROLS ---
             c_type, c_period, c_val = st.columns(3)
@@ -7436,7 +9285,7 @@ def render_tour_management():
                 res_df = res_df[res_df[period_col] == selected_period]
             
             if report_type == "Theo Tour (Chi tiết)":
-                res_df['Tỷ suất LN'] = res_df.apply(lambda x: (x['Lợi Nhuận TT']/x['Doanh Thu Thuần']*100) if x['Doanh Thu Thuần'] else 0, axis=1)
+                res_df['Tỷ suất LN'] = profit_margin_pct(res_df['Lợi Nhuận TT'], res_df['Doanh Thu Thuần'])
                 
                 c_sum1, c_sum2 = st.columns(2)
                 c_sum1.metric("Tổng Lợi Nhuận", format_vnd(res_df['Lợi Nhuận TT'].sum()))
@@ -7465,7 +9314,7 @@ def render_tour_management():
                     'id': 'count'
                 }).reset_index()
                 df_sales.columns = ["Nhân viên Sales", "Doanh Thu Thuần", "Chi Phí TT", "Lợi Nhuận TT", "Số Tour"]
-                df_sales['Tỷ suất LN'] = df_sales.apply(lambda x: (x['Lợi Nhuận TT']/x['Doanh Thu Thuần']*100) if x['Doanh Thu Thuần'] else 0, axis=1)
+                df_sales['Tỷ suất LN'] = profit_margin_pct(df_sales['Lợi Nhuận TT'], df_sales['Doanh Thu Thuần'])
                 df_sales = df_sales.sort_values('Lợi Nhuận TT', ascending=False)
                 
                 st.markdown(f"##### 🏆 Bảng xếp hạng Sales ({selected_period})")
@@ -7533,12 +9382,19 @@ def render_tour_management():
         else:
             st.info("Chưa có dữ liệu tour.")
 
+    render_lazy_tabs({
+        "📝 Dự Toán Chi Phí": _tour_estimate_panel,
+        "📋 Danh sách & Dịch vụ": _tour_services_panel,
+        "💸 Quyết Toán Tour": _tour_settlement_panel,
+        "📜 Lịch sử Tour": _tour_history_panel,
+        "📈 Tổng Hợp Lợi Nhuận": _tour_report_panel
+    }, key="nav_tour")
+
 def render_invoice_management():
     st.title("🧾 Quản Lý Hóa Đơn")
     
-    tab_reverse, tab_profit = st.tabs(["🧮 Tính Hóa Đơn Ngược", "💰 Tính Lợi Nhuận"])
-    
-    with tab_reverse:
+    @st.fragment
+    def _invoice_reverse_panel():
         st.subheader("🧾 Tính Hóa Đơn Ngược")
         st.markdown("""<div style="background-color: #e3f2fd; padding: 15px; border-radius: 10px; margin-bottom: 20px; border-left: 5px solid #2196F3;">
             <b>💡 Công cụ này giúp bạn:</b><br>
@@ -7793,11 +9649,11 @@ def render_invoice_management():
                     view_df_main = df_main.copy().reset_index(drop=True)
                     view_df_main.index = view_df_main.index + 1
                     view_df_main["Số lượng"] = view_df_main["qty"]
-                    view_df_main["Đơn giá"] = view_df_main["unit_price"].apply(lambda x: format_vnd(x))
-                    view_df_main["Thành tiền"] = view_df_main["amount"].apply(lambda x: format_vnd(x))
+                    view_df_main["Đơn giá"] = format_vnd_series(view_df_main["unit_price"])
+                    view_df_main["Thành tiền"] = format_vnd_series(view_df_main["amount"])
                     view_df_main["% VAT"] = view_df_main["vat_pct"].apply(lambda x: f"{x:g}%")
-                    view_df_main["Tiền thuế"] = view_df_main["vat_amount"].apply(lambda x: format_vnd(x))
-                    view_df_main["Tổng cộng"] = view_df_main["total_amount"].apply(lambda x: format_vnd(x))
+                    view_df_main["Tiền thuế"] = format_vnd_series(view_df_main["vat_amount"])
+                    view_df_main["Tổng cộng"] = format_vnd_series(view_df_main["total_amount"])
                     st.dataframe(
                         view_df_main[["name", "unit", "Số lượng", "Đơn giá", "Thành tiền", "% VAT", "Tiền thuế", "Tổng cộng"]],
                         column_config={
@@ -7818,11 +9674,11 @@ def render_invoice_management():
                         view_df_incurred = df_incurred_final.copy().reset_index(drop=True)
                         view_df_incurred.index = view_df_incurred.index + 1
                         view_df_incurred["Số lượng"] = view_df_incurred["qty"]
-                        view_df_incurred["Đơn giá"] = view_df_incurred["unit_price"].apply(lambda x: format_vnd(x))
-                        view_df_incurred["Thành tiền"] = view_df_incurred["amount"].apply(lambda x: format_vnd(x))
+                        view_df_incurred["Đơn giá"] = format_vnd_series(view_df_incurred["unit_price"])
+                        view_df_incurred["Thành tiền"] = format_vnd_series(view_df_incurred["amount"])
                         view_df_incurred["% VAT"] = view_df_incurred["vat_pct"].apply(lambda x: f"{x:g}%")
-                        view_df_incurred["Tiền thuế"] = view_df_incurred["vat_amount"].apply(lambda x: format_vnd(x))
-                        view_df_incurred["Tổng cộng"] = view_df_incurred["total_amount"].apply(lambda x: format_vnd(x))
+                        view_df_incurred["Tiền thuế"] = format_vnd_series(view_df_incurred["vat_amount"])
+                        view_df_incurred["Tổng cộng"] = format_vnd_series(view_df_incurred["total_amount"])
                         st.dataframe(
                             view_df_incurred[["name", "unit", "Số lượng", "Đơn giá", "Thành tiền", "% VAT", "Tiền thuế", "Tổng cộng"]],
                             column_config={
@@ -7967,7 +9823,8 @@ def render_invoice_management():
             - Phù hợp với quy định thuế hiện hành
             """)
     
-    with tab_profit:
+    @st.fragment
+    def _invoice_profit_panel():
         st.subheader("💰 Tính Lợi Nhuận")
         st.markdown("""<div style="background-color: #e8f5e9; padding: 15px; border-radius: 10px; margin-bottom: 20px; border-left: 5px solid #4CAF50;">
             <b>💡 Công cụ này giúp bạn:</b><br>
@@ -8262,7 +10119,7 @@ def render_invoice_management():
         # So sánh với temp cũ, nếu đổi thì lưu và rerun như tab Dự Toán
         old_out = st.session_state.profit_output_temp[['period', 'project', 'invoice_no', 'description', 'amount']].reset_index(drop=True).fillna('')
         new_out = edited_output[['period', 'project', 'invoice_no', 'description', 'amount']].reset_index(drop=True).fillna('')
-        if len(old_out) != len(new_out) or not old_out.equals(new_out):
+        if editor_frame_changed(new_out, old_out, ['period', 'project', 'invoice_no', 'description', 'amount']):
             st.session_state.profit_output_temp = edited_output.copy()
             df_other_output = st.session_state.profit_output_invoices[
                 ~(
@@ -8271,7 +10128,7 @@ def render_invoice_management():
                 )
             ]
             st.session_state.profit_output_invoices = pd.concat([df_other_output, edited_output], ignore_index=True)
-            st.rerun()
+            rerun_fragment()
 
         # Lọc cho mục đích tính toán
         edited_output_clean = edited_output[is_profit_row_valid(edited_output)].copy()
@@ -8282,7 +10139,7 @@ def render_invoice_management():
         col_refresh1, col_metric1 = st.columns([1, 5])
         with col_refresh1:
             if st.button("🔄", key="refresh_output", help="Làm mới để định dạng số tiền"):
-                st.rerun()
+                rerun_fragment()
         with col_metric1:
             st.metric("💰 Tổng Thu (Dự án đang chọn)", format_vnd(total_revenue_project) + " VND")
         
@@ -8330,7 +10187,7 @@ def render_invoice_management():
         # So sánh với temp cũ, nếu đổi thì lưu và rerun như tab Dự Toán
         old_in = st.session_state.profit_input_temp[['period', 'project', 'invoice_no', 'description', 'amount']].reset_index(drop=True).fillna('')
         new_in = edited_input[['period', 'project', 'invoice_no', 'description', 'amount']].reset_index(drop=True).fillna('')
-        if len(old_in) != len(new_in) or not old_in.equals(new_in):
+        if editor_frame_changed(new_in, old_in, ['period', 'project', 'invoice_no', 'description', 'amount']):
             st.session_state.profit_input_temp = edited_input.copy()
             df_other_input = st.session_state.profit_input_invoices[
                 ~(
@@ -8339,7 +10196,7 @@ def render_invoice_management():
                 )
             ]
             st.session_state.profit_input_invoices = pd.concat([df_other_input, edited_input], ignore_index=True)
-            st.rerun()
+            rerun_fragment()
 
         # Lọc cho mục đích tính toán
         edited_input_clean = edited_input[is_profit_row_valid(edited_input)].copy()
@@ -8361,7 +10218,7 @@ def render_invoice_management():
         col_refresh2, col_metric2 = st.columns([1, 5])
         with col_refresh2:
             if st.button("🔄", key="refresh_input", help="Làm mới để định dạng số tiền"):
-                st.rerun()
+                rerun_fragment()
         with col_metric2:
             st.metric("💸 Tổng Chi (Dự án đang chọn)", format_vnd(total_expense_project) + " VND")
 
@@ -8458,9 +10315,7 @@ def render_invoice_management():
 
             df_project_show = df_project_summary.copy()
             df_project_show = df_project_show.rename(columns={'project': 'Dự án'})
-            df_project_show['Tổng Thu'] = df_project_show['Tổng Thu'].apply(lambda x: format_vnd(x) + " VND")
-            df_project_show['Tổng Chi'] = df_project_show['Tổng Chi'].apply(lambda x: format_vnd(x) + " VND")
-            df_project_show['Lợi Nhuận'] = df_project_show['Lợi Nhuận'].apply(lambda x: format_vnd(x) + " VND")
+            df_project_show = format_vnd_frame(df_project_show, ['Tổng Thu', 'Tổng Chi', 'Lợi Nhuận'], " VND")
             st.dataframe(df_project_show, use_container_width=True, hide_index=True)
         else:
             df_project_summary = pd.DataFrame(columns=['project', 'Tổng Thu', 'Tổng Chi', 'Lợi Nhuận'])
@@ -8734,6 +10589,11 @@ def render_invoice_management():
             Lợi Nhuận = Tổng Thu - Tổng Chi
             ```
             """)
+
+    render_lazy_tabs({
+        "🧮 Tính Hóa Đơn Ngược": _invoice_reverse_panel,
+        "💰 Tính Lợi Nhuận": _invoice_profit_panel
+    }, key="nav_invoice")
     
 def render_customer_management():
     st.title("🤝 Quản Lý Khách Hàng")
@@ -8741,11 +10601,8 @@ def render_customer_management():
     # Lấy thông tin user hiện tại để lọc
     current_user_info_cust = st.session_state.get("user_info", {})
     current_user_name_cust = current_user_info_cust.get('name', 'N/A')
-    current_user_role_cust = current_user_info_cust.get('role')
-    
-    tab_list, tab_add = st.tabs(["📋 Danh sách khách hàng", "➕ Thêm khách hàng"])
     
-    with tab_add:
+    def _customer_add_panel():
         with st.form("add_cust_form"):
             st.subheader("Thêm khách hàng mới")
             c1, c2 = st.columns(2)
@@ -8765,28 +10622,20 @@ def render_customer_management():
                 else:
                     st.warning("Vui lòng nhập tên khách hàng.")
 
-    with tab_list:
+    def _customer_list_panel():
         # Search bar
         search_term = st.text_input("🔍 Tìm kiếm", placeholder="Nhập tên hoặc số điện thoại...")
         
-        query = "SELECT * FROM customers"
-        params = []
-
-        # Base filter for sales role
-        if current_user_role_cust == 'sale':
-            query += " WHERE sale_name=?"
-            params.append(current_user_name_cust)
+        conds, params = list_filter_controls("cust_list", "customers", sale_col="sale_name")
 
         # Additional filter for search term
         if search_term:
-            if "WHERE" in query:
-                query += " AND (name LIKE ? OR phone LIKE ?)"
-            else:
-                query += " WHERE name LIKE ? OR phone LIKE ?"
-            params.extend([f"%{search_term}%", f"%{search_term}%"])
-        query += " ORDER BY id DESC"
+            # Tìm không dấu: "nguyen van a" khớp "Nguyễn Văn A"
+            search_sql, search_params = fts_match_condition('customers', search_term)
+            conds.append(search_sql)
+            params.extend(search_params)
         
-        customers = run_query(query, tuple(params))
+        customers = keyset_paginator("cust_list", "customers", "*", conds, params)
         
         if customers:
             # Display as dataframe for overview
@@ -8835,6 +10684,11 @@ def render_customer_management():
         else:
             st.info("Chưa có khách hàng nào.")
 
+    render_lazy_tabs({
+        "📋 Danh sách khách hàng": _customer_list_panel,
+        "➕ Thêm khách hàng": _customer_add_panel
+    }, key="nav_customer")
+
 def render_hr_management():
     st.title("👥 Quản Lý Nhân Sự & Tài Khoản")
     
@@ -8959,7 +10813,7 @@ def render_hr_management():
 
             st.divider()
             st.subheader("Yêu cầu quên mật khẩu")
-            reset_pending = run_query("SELECT * FROM users WHERE COALESCE(reset_request, 0)=1")
+            reset_pending = run_query("SELECT * FROM users WHERE COALESCE(reset_request, 0)=1", cache=True)
             if reset_pending:
                 for p in reset_pending:
                     with st.container(border=True):
@@ -8990,87 +10844,142 @@ def render_search_module():
     current_user_name = current_user_info.get('name', 'N/A')
     current_user_role = current_user_info.get('role')
 
-    query = st.text_input("Nhập từ khóa tìm kiếm", placeholder="Nhập Mã Tour, Số Hóa Đơn, Mã Vé, Mã Chi Phí, hoặc Tên Khách...", help="Hệ thống sẽ tìm trong Tour, Hóa đơn, UNC và Vé máy bay")
-        
+    query = st.text_input("Nhập từ khóa tìm kiếm", placeholder="Nhập Mã Tour, Số Hóa Đơn, Mã Vé, Mã Chi Phí, CCCD, hoặc Tên Khách...", help="Hệ thống sẽ tìm trong Tour, Booking, Khách hàng, Danh sách đoàn, Hóa đơn/UNC, Phiếu thu/chi và Vé máy bay (không cần gõ dấu)")
+
+    # --- Cách hiển thị từng nhóm kết quả ---
+    def show_tours(tour_hits):
+        st.subheader(f"📦 Tìm thấy {len(tour_hits)} Tour")
+        # Tổng Dự toán / Quyết toán của tất cả tour tìm được trong 1 truy vấn GROUP BY
+        totals = get_tour_item_totals([t['id'] for t, _ in tour_hits]).set_index('tour_id')
+        for t, snip in tour_hits:
+            with st.expander(f"Tour: {t['tour_name']} (Mã: {t['tour_code']})", expanded=True):
+                if snip: st.caption(f"🔎 {snip}")
+                c1, c2, c3 = st.columns(3) # type: ignore
+                c1.write(f"**Sales:** {t['sale_name']}") # type: ignore
+                c2.write(f"**Ngày:** {t['start_date']} - {t['end_date']}") # type: ignore
+                c3.write(f"**Khách:** {t['guest_count']}") # type: ignore
+                
+                est_val = totals['est_cost'].get(t['id'], 0) or 0 # type: ignore
+                act_val = totals['act_cost'].get(t['id'], 0) or 0 # type: ignore
+                
+                st.info(f"💰 Dự toán: {format_vnd(est_val)} | 💸 Quyết toán: {format_vnd(act_val)}")
+
+    def show_customers(custs):
+        st.subheader(f"👥 Tìm thấy {len(custs)} Khách hàng")
+        for c, snip in custs:
+            with st.expander(f"Khách hàng: {c['name']} - {c['phone']}", expanded=True):
+                if snip: st.caption(f"🔎 {snip}")
+                st.write(f"**Email:** {c['email']}")
+                st.write(f"**Địa chỉ:** {c['address']}")
+                st.write(f"**Ghi chú:** {c['notes']}")
+
+    def show_invoices(invs):
+        st.subheader(f"💰 Tìm thấy {len(invs)} Hóa đơn / UNC")
+        for inv, snip in invs:
+            icon = "💸" if "UNC" in (inv['invoice_number'] or "") else "📄"
+            i_num = inv['invoice_number'] if inv['invoice_number'] else "(Không số)" # type: ignore
+            label = f"{icon} {inv['date']} | {i_num} | {format_vnd(inv['total_amount'])} | {inv['memo']}" # type: ignore
+            
+            with st.expander(label):
+                if snip: st.caption(f"🔎 {snip}")
+                c_info, c_file = st.columns([1, 1])
+                with c_info:
+                    st.markdown(f"**Bên bán:** {inv['seller_name']}") # type: ignore
+                    st.markdown(f"**Bên mua:** {inv['buyer_name']}") # type: ignore
+                    st.markdown(f"**Tổng tiền:** {format_vnd(inv['total_amount'])}") # type: ignore
+                    st.markdown(f"**Mã chi phí:** `{inv['cost_code']}`") # type: ignore
+                    st.caption(f"Trạng thái: {inv['status']}") # type: ignore
+                
+                with c_file:
+                    if inv['doc_hash']: # type: ignore
+                        # Chỉ đọc blob khi người dùng bấm chuẩn bị (không đọc file cho mọi kết quả ở mỗi lần rerun)
+                        ready_key = f"dl_ready_{inv['id']}"
+                        if not st.session_state.get(ready_key):
+                            if st.button("📄 Chuẩn bị file gốc", key=f"prep_doc_{inv['id']}", use_container_width=True):
+                                st.session_state[ready_key] = True; rerun_fragment()
+                        else:
+                            doc_bytes = read_document(inv['doc_hash']) # type: ignore
+                            if doc_bytes:
+                                st.download_button("📥 Tải file gốc", doc_bytes, inv['file_name'] or f"{inv['doc_hash'][:12]}.pdf", key=f"dl_doc_{inv['id']}", use_container_width=True) # type: ignore
+                            else: st.warning("Không đọc được file gốc.")
+                    file_path = inv['file_path'] # type: ignore
+                    if file_path and os.path.exists(file_path):
+                        # The 'file_path' from the database is a Google Drive link, not a local path.
+                        # The original code to check os.path.exists(file_path) and open it is incorrect.
+                        # We should just provide the link.
+                        st.link_button("🔗 Mở file trên Google Drive", file_path, use_container_width=True)
+
+    def show_bookings(bks):
+        st.subheader(f"🔖 Tìm thấy {len(bks)} Booking")
+        for bk, snip in bks:
+            with st.expander(f"Booking: {bk['name']} (Mã: {bk['code']})"):
+                if snip: st.caption(f"🔎 {snip}")
+                c1, c2, c3 = st.columns(3)
+                c1.write(f"**Sales:** {bk['sale_name']}")
+                c2.write(f"**Ngày tạo:** {bk['created_at']}")
+                c3.write(f"**Trạng thái:** {bk['status']}")
+                st.write(f"**Khách hàng:** {bk['customer_info']}")
+                st.info(f"💰 Giá bán: {format_vnd(bk['selling_price'])} | 📈 Lợi nhuận: {format_vnd(bk['profit'])}")
+
+    def show_transactions(txns):
+        st.subheader(f"💳 Tìm thấy {len(txns)} Phiếu Thu/Chi")
+        df_txn = pd.DataFrame([dict(r) for r, _ in txns])
+        df_txn['amount'] = format_vnd_series(df_txn['amount'], " VND")
+        st.dataframe(
+            df_txn[['created_at', 'ref_code', 'type', 'amount', 'payment_method', 'payer_name', 'note']],
+            column_config={
+                "created_at": "Thời gian", "ref_code": "Mã Tour/Booking", "type": "Loại", "amount": "Số tiền",
+                "payment_method": "Hình thức", "payer_name": "Người nộp/nhận", "note": "Ghi chú"
+            },
+            use_container_width=True, hide_index=True
+        )
+
+    def show_guests(guests):
+        st.subheader(f"🧍 Tìm thấy {len(guests)} Khách trong danh sách đoàn")
+        df_g = pd.DataFrame([dict(r) for r, _ in guests])
+        st.dataframe(
+            df_g[['name', 'cccd', 'dob', 'hometown', 'type', 'tour_label']],
+            column_config={
+                "name": "Họ và tên", "cccd": "Số CCCD", "dob": "Ngày sinh", "hometown": "Quê quán",
+                "type": "Phân loại", "tour_label": "Tour"
+            },
+            use_container_width=True, hide_index=True
+        )
+
+    def show_flights(tickets):
+        st.subheader(f"✈️ Tìm thấy {len(tickets)} Vé máy bay")
+        for tk, snip in tickets:
+            with st.expander(f"✈️ {tk['ticket_code']} | {tk['flight_date']} | {tk['route']} | {tk['airline'] or ''}"):
+                if snip: st.caption(f"🔎 {snip}")
+                st.write(f"**Hành khách:** {tk['passenger_names']}")
+                if tk['file_path']:
+                    st.link_button("🔗 Mở file vé", tk['file_path'])
+
     if query:
         st.divider()
-        term = f"%{query.strip()}%"
-        found_any = False
-        
-        # 1. TÌM TRONG TOUR
-        tour_sql = "SELECT * FROM tours WHERE (tour_code LIKE ? OR tour_name LIKE ?)"
-        tour_params = [term, term]
-        if current_user_role == 'sale':
-            tour_sql += " AND sale_name=?"
-            tour_params.append(current_user_name)
-            
-        tours = run_query(tour_sql, tuple(tour_params))
-        if tours:
-            found_any = True
-            st.subheader(f"📦 Tìm thấy {len(tours)} Tour")
-            for t in tours:
-                with st.expander(f"Tour: {t['tour_name']} (Mã: {t['tour_code']})", expanded=True):
-                    c1, c2, c3 = st.columns(3) # type: ignore
-                    c1.write(f"**Sales:** {t['sale_name']}") # type: ignore
-                    c2.write(f"**Ngày:** {t['start_date']} - {t['end_date']}") # type: ignore
-                    c3.write(f"**Khách:** {t['guest_count']}") # type: ignore
-                    
-                    est = run_query("SELECT SUM(total_amount) as t FROM tour_items WHERE tour_id=? AND item_type='EST'", (t['id'],), fetch_one=True) # type: ignore
-                    act = run_query("SELECT SUM(total_amount) as t FROM tour_items WHERE tour_id=? AND item_type='ACT'", (t['id'],), fetch_one=True) # type: ignore
-                    est_val = est['t'] if isinstance(est, sqlite3.Row) and est['t'] else 0 # type: ignore
-                    act_val = act['t'] if isinstance(act, sqlite3.Row) and act['t'] else 0 # type: ignore
-                    
-                    st.info(f"💰 Dự toán: {format_vnd(est_val)} | 💸 Quyết toán: {format_vnd(act_val)}")
-
-        # 2. TÌM TRONG KHÁCH HÀNG (MỚI)
-        cust_sql = "SELECT * FROM customers WHERE (name LIKE ? OR phone LIKE ?)"
-        cust_params = [term, term]
-        if current_user_role == 'sale':
-            cust_sql += " AND sale_name=?"
-            cust_params.append(current_user_name)
-            
-        custs = run_query(cust_sql, tuple(cust_params))
-        if custs:
-            found_any = True
-            st.subheader(f"👥 Tìm thấy {len(custs)} Khách hàng")
-            for c in custs:
-                with st.expander(f"Khách hàng: {c['name']} - {c['phone']}", expanded=True):
-                    st.write(f"**Email:** {c['email']}")
-                    st.write(f"**Địa chỉ:** {c['address']}")
-                    st.write(f"**Ghi chú:** {c['notes']}")
-
-        # 3. TÌM TRONG HÓA ĐƠN / UNC
-        invs = run_query("SELECT * FROM invoices WHERE invoice_number LIKE ? OR cost_code LIKE ? OR memo LIKE ? ORDER BY date DESC", (term, term, term))
-        if invs:
-            found_any = True
-            st.subheader(f"💰 Tìm thấy {len(invs)} Hóa đơn / UNC")
-            
-            for inv in invs:
-                icon = "💸" if "UNC" in (inv['invoice_number'] or "") else "📄"
-                i_num = inv['invoice_number'] if inv['invoice_number'] else "(Không số)" # type: ignore
-                label = f"{icon} {inv['date']} | {i_num} | {format_vnd(inv['total_amount'])} | {inv['memo']}" # type: ignore
-                
-                with st.expander(label):
-                    c_info, c_file = st.columns([1, 1])
-                    with c_info:
-                        st.markdown(f"**Bên bán:** {inv['seller_name']}") # type: ignore
-                        st.markdown(f"**Bên mua:** {inv['buyer_name']}") # type: ignore
-                        st.markdown(f"**Tổng tiền:** {format_vnd(inv['total_amount'])}") # type: ignore
-                        st.markdown(f"**Mã chi phí:** `{inv['cost_code']}`") # type: ignore
-                        st.caption(f"Trạng thái: {inv['status']}") # type: ignore
-                    
-                    with c_file:
-                        file_path = inv['file_path'] # type: ignore
-                        if file_path and os.path.exists(file_path):
-                            # The 'file_path' from the database is a Google Drive link, not a local path.
-                            # The original code to check os.path.exists(file_path) and open it is incorrect.
-                            # We should just provide the link.
-                            st.link_button("🔗 Mở file trên Google Drive", file_path, use_container_width=True)
-
-        if not found_any:
+        # [NEW] Mỗi nhóm 1 truy vấn (FTS5 / cột không dấu), chạy song song trên pool kết nối đọc;
+        # nhóm nào xong trước hiển thị trước vào đúng vị trí của nhóm đó.
+        renderers = {
+            'tours': show_tours, 'service_bookings': show_bookings, 'customers': show_customers,
+            'tour_guests': show_guests, 'invoices': show_invoices, 'transaction_history': show_transactions,
+            'flight_tickets': show_flights,
+        }
+        slots = {tbl: st.container() for tbl in renderers}
+        status = st.empty()
+        status.caption("⏳ Đang tìm kiếm...")
+        found_groups = 0
+        for tbl, hits in iter_search_groups(query, current_user_name if current_user_role == 'sale' else None, renderers.keys()):
+            if hits:
+                found_groups += 1
+                with slots[tbl]:
+                    renderers[tbl](hits)
+        status.empty()
+
+        if not found_groups:
             st.warning("📭 Không tìm thấy dữ liệu nào phù hợp.")
 
 def main():
+    start_reminder_scheduler()  # [NEW] Thread nền gửi nhắc lần 2 (1 lần/tiến trình)
     if not st.session_state.logged_in:
         render_login_page(comp)
         return
@@ -0,0 +1 @@
+"""Benchmark chạy tay (không nằm trong bộ test): python -m benchmarks.<tên> từ thư mục gốc repo."""
@@ -0,0 +1,14 @@
+import importlib
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_app():
+    """Nạp app.py trong thư mục tạm (DB và thư mục upload mới, không đụng dữ liệu thật), giống tests/conftest.py"""
+    os.chdir(tempfile.mkdtemp(prefix="bench_"))
+    os.environ.setdefault("REMINDER_SCHEDULER", "0")
+    sys.path.insert(0, ROOT)
+    return importlib.import_module("app")
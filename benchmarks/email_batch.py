@@ -0,0 +1,32 @@
+"""Gửi n email qua máy chủ SMTP giả cục bộ: 1 phiên dùng chung (send_email_batch) so với mỗi email 1 kết nối."""
+import os
+import sys
+import time
+
+from benchmarks._app import load_app
+
+
+def benchmark_email_batch(app, n=200):
+    server = app.start_debug_smtp_server()
+    os.environ["SMTP_DEBUG_PORT"] = str(server.server_address[1])
+    app.get_mail_transport.clear()
+    try:
+        t0 = time.perf_counter()
+        app.send_email_batch([("guest@example.com", f"Thư {i}", f"<p>Nội dung {i}</p>", None) for i in range(n)])
+        batch_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for i in range(n):
+            app._smtp_close(app.get_mail_transport())
+            app.send_email_batch([("guest@example.com", f"Thư {i}", f"<p>Nội dung {i}</p>", None)])
+        per_email_s = time.perf_counter() - t0
+        stats = app.get_mail_stats()
+    finally:
+        app._smtp_close(app.get_mail_transport())
+        server.shutdown()
+        server.server_close()
+    return {'emails': n, 'batch_per_s': round(n / batch_s), 'per_email_connection_per_s': round(n / per_email_s),
+            'delivered': len(server.messages), 'connects': stats['connects']}
+
+
+if __name__ == "__main__":
+    print(benchmark_email_batch(load_app(), *(int(a) for a in sys.argv[1:2])))
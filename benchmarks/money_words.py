@@ -0,0 +1,29 @@
+"""Tốc độ đọc số tiền bằng chữ: số khác nhau, số lặp lại (LRU cache) và đọc theo lô (read_money_vietnamese_many)."""
+import random
+import sys
+import time
+
+from benchmarks._app import load_app
+
+
+def benchmark_read_money(app, n=100_000, seed=1):
+    rng = random.Random(seed)
+    amounts = [rng.randrange(10 ** 12) for _ in range(n)]
+    repeated = [rng.choice(amounts[:1000]) for _ in range(n)]
+    app._read_money_int.cache_clear()
+    t0 = time.perf_counter()
+    for a in amounts: app.read_money_vietnamese(a)
+    distinct_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for a in repeated: app.read_money_vietnamese(a)
+    repeated_s = time.perf_counter() - t0
+    app._read_money_int.cache_clear()
+    t0 = time.perf_counter()
+    app.read_money_vietnamese_many(repeated)
+    batch_s = time.perf_counter() - t0
+    return {'amounts': n, 'distinct_per_s': round(n / distinct_s), 'repeated_per_s': round(n / repeated_s),
+            'batch_per_s': round(n / batch_s)}
+
+
+if __name__ == "__main__":
+    print(benchmark_read_money(load_app(), *(int(a) for a in sys.argv[1:2])))
@@ -0,0 +1,68 @@
+"""Đối soát UNC <-> hóa đơn trên DB tạm trong RAM với chứng từ giả lập có đáp án đúng: tốc độ, precision, recall."""
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+from benchmarks._app import load_app
+
+
+def benchmark_reconciliation(app, n_docs=5000, seed=42):
+    """Đo tốc độ/độ chính xác đối soát trên DB tạm trong RAM với n_docs chứng từ giả lập (có đáp án đúng)"""
+    rng = random.Random(seed)
+    sellers = [f"Công ty TNHH Du lịch {w} {i}" for i, w in enumerate(rng.choices(['Sao Mai', 'Hải Âu', 'Bình Minh', 'Phương Nam', 'Hoàng Gia'], k=300))]
+    base = datetime(2024, 1, 1).toordinal()
+    invoices, uncs, truth = [], [], set()
+    next_id = [0]
+    def new_id():
+        next_id[0] += 1
+        return next_id[0]
+    while len(invoices) + len(uncs) < n_docs:
+        seller, code = rng.choice(sellers), f"BK{rng.randint(1, max(1, n_docs // 20)):05d}"
+        day = base + rng.randint(0, 700)
+        kind = rng.random()
+        group = [(new_id(), rng.randint(5, 500) * 10000 + rng.randint(0, 9) * 1000, day + rng.randint(-10, 0)) for _ in range(1 if kind < 0.7 else rng.randint(2, 4))]
+        for gid, amount, d in group: invoices.append((gid, amount, d, seller, code))
+        if kind < 0.9:  # 1 UNC trả cả nhóm
+            uid = new_id(); uncs.append((uid, sum(a for _, a, _ in group), day + rng.randint(0, 20), seller, code))
+            truth.update((uid, gid) for gid, _, _ in group)
+        elif len(group) == 1:  # 1 HĐ trả bằng 2 UNC (cọc + phần còn lại)
+            gid, amount, _ = group[0]; deposit = (amount // 2000) * 1000
+            for part in (deposit, amount - deposit):
+                uid = new_id(); uncs.append((uid, part, day + rng.randint(0, 20), seller, code)); truth.add((uid, gid))
+        # còn lại: HĐ chưa thanh toán
+
+    mem = sqlite3.connect(":memory:")
+    mem.row_factory = sqlite3.Row
+    mem.execute("CREATE TABLE invoices (id INTEGER PRIMARY KEY, type TEXT, status TEXT, date TEXT, invoice_number TEXT, seller_name TEXT, total_amount REAL, memo TEXT, cost_code TEXT)")
+    mem.execute("""CREATE TABLE unc_invoice_links (id INTEGER PRIMARY KEY AUTOINCREMENT, unc_id INTEGER NOT NULL, invoice_id INTEGER NOT NULL,
+        amount REAL, score REAL, method TEXT, cost_code TEXT, created_at TEXT, UNIQUE (unc_id, invoice_id))""")
+    mem.execute("CREATE INDEX idx_unc_links_invoice ON unc_invoice_links(invoice_id)")
+    mem.execute("CREATE INDEX idx_invoices_cost_code ON invoices(cost_code)")
+    fmt = lambda o: datetime.fromordinal(o).strftime('%d/%m/%Y')
+    mem.executemany("INSERT INTO invoices VALUES (?, 'IN', 'active', ?, ?, ?, ?, '', ?)",
+                    [(i, fmt(d), f"{i:07d}", s, a, c) for i, a, d, s, c in invoices] +
+                    [(i, fmt(d), f"UNC-{i}", s.upper(), a, c) for i, a, d, s, c in uncs])
+    mem.commit()
+
+    codes = sorted({c for *_, c in invoices})
+    t0 = time.perf_counter()
+    for code in codes: app.reconcile_unc_invoices(code, conn=mem)
+    per_code_ms = (time.perf_counter() - t0) * 1000
+    found = {(r['unc_id'], r['invoice_id']) for r in mem.execute("SELECT unc_id, invoice_id FROM unc_invoice_links")}
+    mem.execute("DELETE FROM unc_invoice_links")
+    global_stats = app.reconcile_unc_invoices(None, conn=mem)
+    found_global = {(r['unc_id'], r['invoice_id']) for r in mem.execute("SELECT unc_id, invoice_id FROM unc_invoice_links")}
+    mem.close()
+    pct = lambda a, b: round(100 * a / b, 1) if b else 0.0
+    return {
+        'documents': len(invoices) + len(uncs), 'invoices': len(invoices), 'uncs': len(uncs), 'cost_codes': len(codes), 'true_links': len(truth),
+        'per_code_ms': round(per_code_ms), 'per_code_precision_%': pct(len(found & truth), len(found)), 'per_code_recall_%': pct(len(found & truth), len(truth)),
+        'global_ms': round(global_stats['total_ms']), 'global_precision_%': pct(len(found_global & truth), len(found_global)),
+        'global_recall_%': pct(len(found_global & truth), len(truth)),
+    }
+
+
+if __name__ == "__main__":
+    print(benchmark_reconciliation(load_app(), *(int(a) for a in sys.argv[1:2])))
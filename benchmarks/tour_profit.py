@@ -0,0 +1,68 @@
+"""Tab Tổng Hợp Lợi Nhuận: cách tính cũ (lặp từng dòng) so với compute_tour_profit_frame (tính theo cột)."""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks._app import load_app
+
+
+def tour_profit_rowwise(tours_df, items):
+    """Cách tính cũ (lặp từng dòng), giữ làm đáp án đối chiếu"""
+    items_map = {}
+    for tid, itype, amt in items:
+        items_map.setdefault(tid, {'EST': 0, 'ACT': 0})[itype] += amt or 0
+    results = []
+    for _, t in tours_df.iterrows():
+        costs = items_map.get(t['id'], {'EST': 0, 'ACT': 0})
+        p_pct = t.get('est_profit_percent', 0) or 0
+        t_pct = t.get('est_tax_percent', 0) or 0
+        final_qty = float(t.get('final_qty', 0) or 0)
+        if final_qty == 0: final_qty = float(t.get('guest_count', 1))
+        manual_revenue = float(t.get('final_tour_price', 0) or 0) * final_qty + float(t.get('child_price', 0) or 0) * float(t.get('child_qty', 0) or 0)
+        final_sale = manual_revenue if manual_revenue > 0 else (costs['EST'] + costs['EST'] * (p_pct / 100)) * (1 + t_pct / 100)
+        net_revenue = final_sale / (1 + t_pct / 100) if (1 + t_pct / 100) != 0 else final_sale
+        results.append({**t.to_dict(), "Doanh Thu Thuần": net_revenue, "Chi Phí TT": costs['ACT'], "Lợi Nhuận TT": net_revenue - costs['ACT']})
+    return pd.DataFrame(results)
+
+
+def benchmark_tour_profit(app, n_tours=50000, seed=42):
+    """Chạy 2 cách tính trên n_tours tour giả lập: thời gian, độ lệch lớn nhất, cột kỳ (Tháng/Quý/Năm) có giống nhau không"""
+    rng = np.random.default_rng(seed)
+    ids = np.arange(1, n_tours + 1)
+    manual = rng.random(n_tours) < 0.5
+    tours_df = pd.DataFrame({
+        'id': ids, 'tour_name': [f"Tour {i}" for i in ids], 'sale_name': rng.choice(['An', 'Bình', 'Chi', 'Dũng'], n_tours),
+        'start_date': pd.to_datetime('2023-01-01') + pd.to_timedelta(rng.integers(0, 1000, n_tours), unit='D'),
+        'guest_count': rng.integers(1, 45, n_tours), 'final_qty': np.where(rng.random(n_tours) < 0.3, 0, rng.integers(1, 45, n_tours)),
+        'final_tour_price': np.where(manual, rng.integers(1, 300, n_tours) * 100000, 0), 'child_price': np.where(manual, rng.integers(0, 100, n_tours) * 50000, 0),
+        'child_qty': rng.integers(0, 6, n_tours), 'est_profit_percent': rng.choice([0, 5, 10, 15], n_tours), 'est_tax_percent': rng.choice([0, 8, 10], n_tours),
+    })
+    n_items = n_tours * 8
+    items = list(zip(rng.integers(1, n_tours + 1, n_items).tolist(), rng.choice(['EST', 'ACT'], n_items).tolist(),
+                     (rng.integers(1, 500, n_items) * 10000).tolist()))
+    items_df = pd.DataFrame(items, columns=['tour_id', 'item_type', 'total_amount'])
+
+    t0 = time.perf_counter()
+    dt = pd.to_datetime(tours_df['start_date'])
+    old = tours_df.assign(Month=dt.apply(lambda x: x.strftime('%m/%Y')), Quarter=dt.apply(lambda x: f"Q{(x.month-1)//3+1}/{x.year}"), Year=dt.apply(lambda x: x.strftime('%Y')))
+    old = tour_profit_rowwise(old, items)
+    rowwise_ms = (time.perf_counter() - t0) * 1000
+
+    t0 = time.perf_counter()
+    new = tours_df.assign(Month=dt.dt.strftime('%m/%Y'), Quarter="Q" + dt.dt.quarter.astype(str) + "/" + dt.dt.year.astype(str), Year=dt.dt.strftime('%Y'))
+    totals = items_df.pivot_table(index='tour_id', columns='item_type', values='total_amount', aggfunc='sum', fill_value=0)
+    totals = totals.reindex(columns=['EST', 'ACT'], fill_value=0).rename(columns={'EST': 'est_cost', 'ACT': 'act_cost'}).reset_index()
+    new = app.compute_tour_profit_frame(new, totals)
+    vectorized_ms = (time.perf_counter() - t0) * 1000
+
+    cols = ['Doanh Thu Thuần', 'Chi Phí TT', 'Lợi Nhuận TT']
+    max_diff = float((old[cols].astype(float) - new[cols].astype(float)).abs().max().max())
+    same_periods = bool((old[['Month', 'Quarter', 'Year']] == new[['Month', 'Quarter', 'Year']]).all().all())
+    return {'tours': n_tours, 'tour_items': n_items, 'rowwise_ms': round(rowwise_ms), 'vectorized_ms': round(vectorized_ms),
+            'speedup_x': round(rowwise_ms / vectorized_ms, 1) if vectorized_ms else None, 'max_abs_diff': max_diff, 'same_periods': same_periods}
+
+
+if __name__ == "__main__":
+    print(benchmark_tour_profit(load_app(), *(int(a) for a in sys.argv[1:2])))
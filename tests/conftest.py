@@ -0,0 +1,21 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)  # app.py và gói benchmarks/
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """Nạp app.py trong thư mục tạm: invoice_app.db và thư mục upload được tạo mới, không đụng dữ liệu thật."""
+    workdir = tmp_path_factory.mktemp("app")
+    old_cwd = os.getcwd()
+    os.chdir(workdir)
+    os.environ.setdefault("REMINDER_SCHEDULER", "0")
+    try:
+        yield importlib.import_module("app")
+    finally:
+        os.chdir(old_cwd)
@@ -0,0 +1,76 @@
+import socket
+
+import pytest
+
+
+@pytest.fixture
+def smtp(app, monkeypatch):
+    """Máy chủ SMTP giả + kết nối dùng chung mới cho mỗi test"""
+    server = app.start_debug_smtp_server()
+    monkeypatch.setenv("SMTP_DEBUG_PORT", str(server.server_address[1]))
+    app.get_mail_transport.clear()
+    yield server
+    app._smtp_close(app.get_mail_transport())
+    server.shutdown()
+    server.server_close()
+
+
+def _emails(n, to="guest@example.com"):
+    return [(to, f"Thư {i}", f"<p>Nội dung {i}</p>", None) for i in range(n)]
+
+
+def test_batch_reuses_one_connection(app, smtp):
+    results = app.send_email_batch(_emails(20))
+    assert all(ok for ok, _ in results)
+    assert len(smtp.messages) == 20
+    stats = app.get_mail_stats()
+    assert stats['connects'] == 1 and stats['reconnects'] == 0
+
+
+def test_cc_recipients_are_delivered(app, smtp):
+    ok, _ = app.send_email_notification("a@example.com", "Hẹn", "<p>x</p>", "b@example.com, c@example.com")
+    assert ok
+    assert smtp.messages[0]['to'] == ["a@example.com", "b@example.com", "c@example.com"]
+
+
+def test_refused_recipient_is_not_resent(app, smtp):
+    smtp.rejected.add("bad@example.com")
+    emails = _emails(1) + _emails(1, to="bad@example.com") + _emails(1)
+    results = app.send_email_batch(emails)
+    assert [ok for ok, _ in results] == [True, False, True]
+    stats = app.get_mail_stats()
+    # Người nhận bị từ chối: không mở lại kết nối, không gửi lại
+    assert stats['connects'] == 1 and stats['reconnects'] == 0
+    assert len(smtp.messages) == 2
+
+
+def test_dropped_connection_reconnects_once(app, smtp):
+    assert app.send_email_batch(_emails(1))[0][0]
+    app.get_mail_transport()['server'].sock.shutdown(socket.SHUT_RDWR)
+    ok, _ = app.send_email_batch(_emails(1))[0]
+    assert ok
+    stats = app.get_mail_stats()
+    assert stats['connects'] == 2 and stats['reconnects'] == 1
+    assert len(smtp.messages) == 2
+
+
+def test_unreachable_server_fails_every_email(app, monkeypatch):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    monkeypatch.setenv("SMTP_DEBUG_PORT", str(port))
+    app.get_mail_transport.clear()
+    results = app.send_email_batch(_emails(3))
+    assert [ok for ok, _ in results] == [False, False, False]
+
+
+def test_batch_vs_connection_per_email_counts(app, smtp):
+    n = 20
+    app.send_email_batch(_emails(n))
+    assert app.get_mail_stats()['connects'] == 1
+    for email in _emails(n):
+        app._smtp_close(app.get_mail_transport())
+        app.send_email_batch([email])
+    stats = app.get_mail_stats()
+    assert stats['connects'] == 1 + n and stats['reconnects'] == 0
+    assert stats['sent'] == 2 * n and len(smtp.messages) == 2 * n
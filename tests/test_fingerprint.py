@@ -0,0 +1,37 @@
+import pytest
+
+
+@pytest.mark.parametrize("number", ["HĐ 0000123", "123", "0000123", "No. 123", "Số: 00123", "hđ-0123"])
+def test_number_prefix_and_leading_zeros(app, number):
+    assert app.invoice_fingerprint(number, "1C24TAA", "Công ty ABC", 1000) == "123|1C24TAA|congtyabc|1000"
+
+
+def test_seller_name_folding(app):
+    fp = lambda seller: app.invoice_fingerprint("123", "1C24TAA", seller, 1_500_000.4)
+    assert fp("Công ty TNHH Đại Việt.") == fp("CONG TY TNHH DAI VIET") == fp("công-ty  tnhh đại việt") == "123|1C24TAA|congtytnhhdaiviet|1500000"
+    assert fp("Công ty TNHH Đại Việt") != fp("Công ty TNHH Đại Việt 2")
+
+
+def test_fingerprint_edge_cases(app):
+    assert app.invoice_fingerprint("UNC-5", "", "A", 1, memo="[UNC] Chuyển khoản") is None
+    assert app.invoice_fingerprint("", "1C24TAA", "A", 1) is None
+    assert app.invoice_fingerprint("000", "1C24TAA", "A", 1) is None
+    # Số toàn chữ giữ nguyên, chữ nằm sau phần số không bị bỏ
+    assert app.invoice_fingerprint("ABC", "", "A", 1) == "ABC||a|1"
+    assert app.invoice_fingerprint("AB012C", "", "A", 1) == "12C||a|1"
+    assert app.invoice_fingerprint("123", "", "A", None) == "123||a|0"
+
+
+def test_old_prefixed_fingerprints_are_recomputed(app):
+    conn = app.get_connection()
+    cur = conn.execute("INSERT INTO invoices (invoice_number, invoice_symbol, seller_name, total_amount, status, type) VALUES ('HĐ 0000777', 'K1', 'Công ty X', 5000, 'active', 'IN')")
+    inv_id = cur.lastrowid
+    conn.commit()
+    app.sync_derived_columns(conn)
+    conn.execute("UPDATE invoices SET fingerprint = 'H0000777|K1|congtyx|5000' WHERE id = ?", (inv_id,))  # giá trị bản cũ
+    conn.execute("DELETE FROM derived_dirty")
+    conn.commit()
+    app.migrate_db_columns()
+    app.sync_derived_columns(conn)
+    assert conn.execute("SELECT fingerprint FROM invoices WHERE id = ?", (inv_id,)).fetchone()[0] == "777|K1|congtyx|5000"
+    assert conn.execute("SELECT COUNT(*) FROM derived_dirty").fetchone()[0] == 0
@@ -0,0 +1,89 @@
+import random
+
+import pandas as pd
+import pytest
+
+DIGITS = ["không", "một", "hai", "ba", "bốn", "năm", "sáu", "bảy", "tám", "chín"]
+UNITS = ["", "nghìn", "triệu", "tỷ", "nghìn tỷ", "triệu tỷ"]
+
+
+def reference(n):
+    """Cách đọc chuẩn, viết độc lập với app.py: tách nhóm 3 chữ số từ chuỗi"""
+    if n == 0: return "Không đồng"
+    s = str(abs(n))
+    s = s.zfill(-(-len(s) // 3) * 3)
+    groups = [tuple(int(d) for d in s[i:i + 3]) for i in range(0, len(s), 3)]
+    words = []
+    for idx, (h, t, u) in enumerate(groups):
+        if h == t == u == 0: continue
+        read_hundreds = h > 0 or idx > 0
+        if read_hundreds: words += [DIGITS[h], "trăm"]
+        if t == 0:
+            if u: words += (["lẻ"] if read_hundreds else []) + [DIGITS[u]]
+        else:
+            words += ["mười"] if t == 1 else [DIGITS[t], "mươi"]
+            if u == 1 and t > 1: words.append("mốt")
+            elif u == 5: words.append("lăm")
+            elif u: words.append(DIGITS[u])
+        unit = UNITS[len(groups) - 1 - idx]
+        if unit: words.append(unit)
+    text = ("âm " if n < 0 else "") + " ".join(words)
+    return text[0].upper() + text[1:] + " đồng"
+
+
+@pytest.mark.parametrize("amount, expected", [
+    (0, "Không đồng"),
+    (5, "Năm đồng"),
+    (10, "Mười đồng"),
+    (15, "Mười lăm đồng"),
+    (21, "Hai mươi mốt đồng"),
+    (105, "Một trăm lẻ năm đồng"),
+    (1005, "Một nghìn không trăm lẻ năm đồng"),
+    (1050, "Một nghìn không trăm năm mươi đồng"),
+    (1250000, "Một triệu hai trăm năm mươi nghìn đồng"),
+    (1000000001, "Một tỷ không trăm lẻ một đồng"),
+    (10 ** 12, "Một nghìn tỷ đồng"),
+    (10 ** 15, "Một triệu tỷ đồng"),
+    (-1500, "Âm một nghìn năm trăm đồng"),
+    (1234.6, "Một nghìn hai trăm ba mươi lăm đồng"),
+])
+def test_known_amounts(app, amount, expected):
+    assert app.read_money_vietnamese(amount) == expected
+
+
+def test_exhaustive_first_million(app):
+    for n in range(1_000_001):
+        assert app.read_money_vietnamese(n) == reference(n), n
+
+
+def test_every_group_value_at_every_position(app):
+    # Mỗi giá trị nhóm 0..999 ở từng vị trí, các nhóm còn lại = 0 hoặc ngẫu nhiên
+    rng = random.Random(27)
+    for pos in range(5):
+        for g in range(1000):
+            for n in (g * 1000 ** pos, g * 1000 ** pos + rng.randrange(1000 ** pos) if pos else g,
+                      rng.randrange(1, 1000) * 1000 ** 5 + g * 1000 ** pos):
+                if n <= 10 ** 15:
+                    assert app.read_money_vietnamese(n) == reference(n), n
+
+
+def test_random_amounts_up_to_10_15(app):
+    rng = random.Random(2027)
+    for _ in range(200_000):
+        n = int(10 ** rng.uniform(0, 15))
+        assert app.read_money_vietnamese(n) == reference(n), n
+    for k in range(16):
+        for n in (10 ** k - 1, 10 ** k, 10 ** k + 1):
+            assert app.read_money_vietnamese(n) == reference(n), n
+
+
+def test_read_many_matches_single(app):
+    rng = random.Random(7)
+    amounts = [rng.randrange(10 ** 12) for _ in range(500)] * 3 + [1005, 1234.6, -1500, 0]
+    expected = [app.read_money_vietnamese(a) for a in amounts]
+    assert app.read_money_vietnamese_many(amounts) == expected
+    series = pd.Series(amounts + [None], index=range(10, 10 + len(amounts) + 1), dtype=object)
+    out = app.read_money_vietnamese_many(series)
+    assert out.index.equals(series.index)
+    assert out.iloc[:-1].tolist() == expected and pd.isna(out.iloc[-1])
+    assert app.read_money_vietnamese_many([None, 5]) == [None, "Năm đồng"]
@@ -0,0 +1,81 @@
+import sqlite3
+from datetime import datetime
+
+from benchmarks.reconciliation import benchmark_reconciliation
+
+
+def _doc(app, id_, amount, day, seller, code='BK00001'):
+    date = datetime(2024, 3, 1).toordinal() + day if day is not None else None
+    return {'id': id_, 'amount': amount, 'date': date, 'tokens': app._seller_tokens(seller), 'cost_code': code}
+
+
+def test_subset_sum_finds_smallest_combination(app):
+    items = [('a', 1_000_000), ('b', 2_500_000), ('c', 1_500_000), ('d', 4_000_000)]
+    # 1-1 đã ghép ở lượt đầu, subset-sum chỉ tìm tổ hợp từ 2 phần tử
+    assert sorted(app.subset_sum_match(4_000_000, items)) == ['b', 'c']
+    assert sorted(app.subset_sum_match(5_000_000, items[:3])) == ['a', 'b', 'c']
+    assert app.subset_sum_match(4_200_000, items[:3]) is None
+    # Sai lệch nhỏ trong mức cho phép vẫn khớp
+    assert sorted(app.subset_sum_match(3_500_500, items[:3])) == ['a', 'b']
+
+
+def test_subset_sum_respects_max_size(app):
+    items = [(i, 1_000_000) for i in range(10)]
+    assert app.subset_sum_match(7_000_000, items, max_size=6) is None
+    assert len(app.subset_sum_match(6_000_000, items, max_size=6)) == 6
+
+
+def test_seller_similarity(app):
+    a = app._seller_tokens("Công ty TNHH Du lịch Hải Âu")
+    assert app.seller_similarity(a, app._seller_tokens("CÔNG TY TNHH DU LỊCH HẢI ÂU")) == 1.0
+    assert app.seller_similarity(a, app._seller_tokens("Hải Âu")) >= 0.8
+    assert app.seller_similarity(a, app._seller_tokens("Khách sạn Bình Minh")) < app.RECON_MIN_SELLER_SIM
+    assert app.seller_similarity(a, frozenset()) is None
+
+
+def test_match_one_to_one_many_to_one_and_split_payment(app):
+    invoices = [_doc(app, 1, 3_000_000, 0, "Hải Âu"),
+                _doc(app, 2, 1_200_000, 1, "Sao Mai"), _doc(app, 3, 800_000, 2, "Sao Mai"),
+                _doc(app, 4, 5_000_000, 3, "Bình Minh")]
+    uncs = [_doc(app, 11, 3_000_000, 5, "Hải Âu"),
+            _doc(app, 12, 2_000_000, 6, "Sao Mai"),
+            _doc(app, 13, 2_000_000, 4, "Bình Minh"), _doc(app, 14, 3_000_000, 10, "Bình Minh")]
+    links = {(u, i) for u, i, _, _ in app.match_unc_invoices(uncs, invoices)}
+    assert links == {(11, 1), (12, 2), (12, 3), (13, 4), (14, 4)}
+
+
+def test_match_skips_blocked_pairs_and_far_dates(app):
+    invoices = [_doc(app, 1, 3_000_000, 0, "Hải Âu"), _doc(app, 2, 3_000_000, 0, "Hải Âu")]
+    uncs = [_doc(app, 11, 3_000_000, 1, "Hải Âu"), _doc(app, 12, 3_000_000, app.RECON_DATE_WINDOW_DAYS + 10, "Hải Âu")]
+    links = app.match_unc_invoices(uncs, invoices, blocked=frozenset({(11, 1)}))
+    assert [(u, i) for u, i, _, _ in links] == [(11, 2)]
+
+
+def test_reconcile_is_incremental(app):
+    mem = sqlite3.connect(":memory:")
+    mem.row_factory = sqlite3.Row
+    mem.execute("CREATE TABLE invoices (id INTEGER PRIMARY KEY, type TEXT, status TEXT, date TEXT, invoice_number TEXT, seller_name TEXT, total_amount REAL, memo TEXT, cost_code TEXT)")
+    mem.execute("""CREATE TABLE unc_invoice_links (id INTEGER PRIMARY KEY AUTOINCREMENT, unc_id INTEGER NOT NULL, invoice_id INTEGER NOT NULL,
+        amount REAL, score REAL, method TEXT, cost_code TEXT, created_at TEXT, UNIQUE (unc_id, invoice_id))""")
+    mem.executemany("INSERT INTO invoices VALUES (?, 'IN', 'active', ?, ?, ?, ?, '', 'BK1')", [
+        (1, '01/03/2024', '0000001', 'Hải Âu', 3_000_000),
+        (2, '05/03/2024', 'UNC-2', 'HẢI ÂU', 1_000_000),
+    ])
+    assert app.reconcile_unc_invoices('BK1', conn=mem)['links'] == 0
+    # Trả nốt phần còn lại -> ghép cả 2 UNC vào hóa đơn
+    mem.execute("INSERT INTO invoices VALUES (3, 'IN', 'active', '10/03/2024', 'UNC-3', 'Hải Âu', 2000000, '', 'BK1')")
+    mem.commit()
+    app.reconcile_unc_invoices('BK1', conn=mem)
+    rows = {(r['unc_id'], r['invoice_id']): r['amount'] for r in mem.execute("SELECT * FROM unc_invoice_links")}
+    assert rows == {(2, 1): 1_000_000, (3, 1): 2_000_000}
+    assert app.reconcile_unc_invoices('BK1', conn=mem)['links'] == 0
+    mem.close()
+
+
+def test_synthetic_reconciliation_accuracy(app):
+    stats = benchmark_reconciliation(app, 5000)
+    assert stats['documents'] >= 5000
+    assert stats['per_code_precision_%'] >= 95
+    assert stats['per_code_recall_%'] >= 95
+    # Đối soát toàn bộ (không tách mã) dễ ghép nhầm hơn, chỉ kiểm tra không tụt hẳn
+    assert stats['global_precision_%'] >= 70
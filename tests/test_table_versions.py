@@ -0,0 +1,32 @@
+import pytest
+
+
+@pytest.mark.parametrize("sql, table", [
+    ("INSERT INTO tours (tour_code) VALUES (?)", "tours"),
+    ("  insert or replace into Customers VALUES (?)", "customers"),
+    ("UPDATE OR IGNORE invoices SET memo = ?", "invoices"),
+    ("DELETE FROM \"tour_items\" WHERE id = ?", "tour_items"),
+    ("WITH ids(id) AS (SELECT id FROM tours WHERE status = 'deleted') DELETE FROM tour_items WHERE tour_id IN (SELECT id FROM ids)", "tour_items"),
+    ("WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 3),\n m AS (SELECT (x * 2) AS y FROM n)\n"
+     "INSERT INTO derived_dirty (tbl, row_id) SELECT 'tours', y FROM m", "derived_dirty"),
+])
+def test_write_table_is_parsed(app, sql, table):
+    assert app._WRITE_TABLE_RE.match(sql).group(1).lower() == table
+
+
+def test_notify_bumps_real_table_and_trigger_targets(app):
+    versions = app._table_versions()
+    before = dict(versions)
+    app.notify_table_write("WITH x AS (SELECT 1) UPDATE invoices SET memo = memo WHERE id IN (SELECT * FROM x)")
+    for t in ("invoices", "report_cube_dirty", "documents", "unc_invoice_links", "derived_dirty", "search_fts"):
+        assert versions.get(t, 0) == before.get(t, 0) + 1, t
+    app.notify_table_write("payment_reminders")
+    assert versions["email_outbox"] == before.get("email_outbox", 0) + 1
+
+
+def test_unrecognised_sql_is_ignored(app):
+    versions = app._table_versions()
+    before = dict(versions)
+    for sql in ("CREATE INDEX IF NOT EXISTS idx_x ON tours(id)", "PRAGMA optimize", "SELECT 1"):
+        app.notify_table_write(sql)
+    assert versions == before
@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+from benchmarks.tour_profit import benchmark_tour_profit, tour_profit_rowwise
+
+
+def _tours():
+    return pd.DataFrame([
+        # Giá chốt tay, final_qty = 0 -> dùng guest_count
+        {'id': 1, 'tour_name': 'A', 'sale_name': 'An', 'start_date': '01/02/2024', 'guest_count': 10, 'final_qty': 0,
+         'final_tour_price': 1_000_000, 'child_price': 500_000, 'child_qty': 2, 'est_profit_percent': 10, 'est_tax_percent': 8},
+        # Không có giá chốt -> doanh thu từ dự toán
+        {'id': 2, 'tour_name': 'B', 'sale_name': 'Bình', 'start_date': '15/05/2024', 'guest_count': 20, 'final_qty': 18,
+         'final_tour_price': 0, 'child_price': 0, 'child_qty': 0, 'est_profit_percent': 15, 'est_tax_percent': 10},
+        # Không có dòng chi phí nào, thuế -100% (chia cho 0)
+        {'id': 3, 'tour_name': 'C', 'sale_name': 'Chi', 'start_date': '30/12/2024', 'guest_count': 5, 'final_qty': None,
+         'final_tour_price': None, 'child_price': None, 'child_qty': None, 'est_profit_percent': None, 'est_tax_percent': -100},
+    ])
+
+
+ITEMS = [(1, 'EST', 8_000_000), (1, 'ACT', 9_000_000), (2, 'EST', 10_000_000), (2, 'EST', 2_000_000), (2, 'ACT', 11_500_000), (1, 'ACT', None)]
+
+
+def test_matches_rowwise_calculation(app):
+    totals = pd.DataFrame(ITEMS, columns=['tour_id', 'item_type', 'total_amount']).fillna(0)
+    totals = totals.pivot_table(index='tour_id', columns='item_type', values='total_amount', aggfunc='sum', fill_value=0)
+    totals = totals.rename(columns={'EST': 'est_cost', 'ACT': 'act_cost'}).reset_index()
+    new = app.compute_tour_profit_frame(_tours(), totals)
+    old = tour_profit_rowwise(_tours().fillna(0), ITEMS)  # bản cũ không tự xử lý ô trống
+    cols = ['Doanh Thu Thuần', 'Chi Phí TT', 'Lợi Nhuận TT']
+    assert new[cols].to_numpy() == pytest.approx(old[cols].to_numpy())
+    assert new.loc[0, 'Doanh Thu Thuần'] == pytest.approx(11_000_000 / 1.08)
+    assert new.loc[1, 'Doanh Thu Thuần'] == pytest.approx(12_000_000 * 1.15)
+    assert new.loc[2, 'Lợi Nhuận TT'] == 0
+
+
+def test_profit_margin_handles_zero_revenue(app):
+    margin = app.profit_margin_pct(pd.Series([50.0, 10.0]), pd.Series([200.0, 0.0]))
+    assert margin.tolist() == [25.0, 0]
+
+
+def test_item_totals_query(app):
+    conn = app.get_connection()
+    conn.executemany("INSERT INTO tour_items (tour_id, item_type, total_amount) VALUES (?, ?, ?)",
+                     [(901, 'EST', 100), (901, 'EST', 50), (901, 'ACT', 70), (902, 'ACT', 10)])
+    conn.commit()
+    totals = app.get_tour_item_totals([901, 902]).set_index('tour_id')
+    assert totals.loc[901].tolist() == [150, 70]
+    assert totals.loc[902].tolist() == [0, 10]
+    assert app.get_tour_item_totals([]).empty
+
+
+def test_synthetic_tours_match_rowwise(app):
+    result = benchmark_tour_profit(app, 5_000)
+    assert result['max_abs_diff'] < 1e-6
+    assert result['same_periods']